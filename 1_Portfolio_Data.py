@@ -4,6 +4,7 @@ import plotly.express as px
 import time
 from plotly.subplots import make_subplots
 from auth_helper import get_connection, require_login,get_current_tenant
+from portfolio_queries import ROLLUP_REFRESH_QUERY, ROLLUPS, rollup_query
 
 CHART_FONT = "Sans-Serif"
 
@@ -27,181 +28,51 @@ st.title("Portfolio Data")
 conn = get_connection()
 tenant = get_current_tenant()
 most_recent_full_calendar_year = time.localtime().tm_year - 1
+# Aggregates are precomputed into rollup tables by both ingesters
+ROLLUP_TTL = 10 * 60
+
+def rollups_are_current():
+    """
+    True when the ingester has refreshed this tenant's rollup tables for the
+    current report year from the data as it is now. False if they are missing,
+    stale or not there yet.
+    """
+    try:
+        refresh_df = conn.query(ROLLUP_REFRESH_QUERY, params={"tenant": tenant}, ttl=ROLLUP_TTL)
+    except Exception:
+        return False
+    if refresh_df.empty:
+        st.caption(f"Figures are computed live: no rollups are stored for tenant '{tenant}'. The ingesters' DASHBOARD_TENANT should be set to this name.")
+        return False
+    return (
+        refresh_df['report_year'].iloc[0] == most_recent_full_calendar_year
+        and refresh_df['rollup_version'].iloc[0] == refresh_df['data_version'].iloc[0]
+    )
 
-def summary_query_builder(tenant):
-    if tenant=='washtenaw':
-        summary_query = """
-        WITH latest_year AS (
-            SELECT MAX(TRY_CAST([datayear] AS INT)) AS report_year
-            FROM [dbo].[PrimaryDataBase]
-            WHERE TRY_CAST([datayear] AS INT) IS NOT NULL
-            AND ISNULL([donotinclude], 0) <> 1
-        )
-        SELECT 
-            COALESCE(SUM(TRY_CAST([sqfootage] AS DECIMAL(10,2))), 0) as total_sqft,
-            AVG(TRY_CAST([siteeui] AS DECIMAL(10,2))) as avg_siteeui,
-            COALESCE(SUM(TRY_CAST([numbuildings] AS DECIMAL(10,2))), 0) as building_count
-        FROM [dbo].[PrimaryDataBase] e
-        CROSS JOIN latest_year ly
-        WHERE ISNULL(e.pmparentid, e.espmid) = e.espmid
-            AND TRY_CAST(e.[datayear] AS INT) = ly.report_year
-            AND ISNULL(e.[donotinclude], 0) <> 1
-        HAVING COALESCE(SUM(TRY_CAST([sqfootage] AS DECIMAL(10,2))), 0) > 0"""
-        return summary_query
-    else:
-        summary_query = """
-                WITH latest_year AS (
-                    SELECT MAX(TRY_CAST([datayear] AS INT)) AS report_year
-                    FROM [dbo].[PrimaryDataBase]
-                    WHERE TRY_CAST([datayear] AS INT) IS NOT NULL
-                    AND ISNULL([donotinclude], 0) <> 1
-                )
-                SELECT 
-                    COALESCE(SUM(TRY_CAST([sqfootage] AS DECIMAL(10,2))), 0) as total_sqft,
-                    AVG(TRY_CAST([siteeui] AS DECIMAL(10,2))) as avg_siteeui,
-                    COALESCE(SUM(TRY_CAST([numbuildings] AS DECIMAL(10,2))), 0) as building_count
-                FROM [dbo].[PrimaryDataBase] e
-                CROSS JOIN latest_year ly
-                WHERE ISNULL(e.pmparentid, e.espmid) = e.espmid
-                    AND TRY_CAST(e.[datayear] AS INT) = ly.report_year
-                    AND ISNULL(e.[donotinclude], 0) <> 1
-                HAVING COALESCE(SUM(TRY_CAST([sqfootage] AS DECIMAL(10,2))), 0) > 0"""
-        return summary_query
+def portfolio_rollup(name):
+    """
+    One aggregate of portfolio_queries.ROLLUPS: read from its rollup table when
+    that is current, otherwise computed from PrimaryDataBase as before.
+    """
+    if use_rollups:
+        try:
+            return conn.query(rollup_query(name), params={"tenant": tenant}, ttl=ROLLUP_TTL)
+        except Exception:
+            pass
+    _, query_builder, _ = ROLLUPS[name]
+    return conn.query(query_builder(most_recent_full_calendar_year))
 
-summary_df = conn.query(summary_query_builder(tenant))
+use_rollups = rollups_are_current()
 
-def energy_ok_buildings_query_builder(tenant):
-    if tenant == 'washtenaw':
-        energy_ok_buildings_query = f"""
-WITH property_rollup AS (
-    SELECT
-        d.espmid,
-        MIN(TRY_CAST(yj.[year joined] AS INT)) AS year_joined,
-        MAX(TRY_CAST(d.[numbuildings] AS DECIMAL(18,2))) AS energy_ok_buildings
-    FROM [dbo].[PrimaryDataBase] d
-    LEFT JOIN [dbo].[yearjoined] yj
-        ON d.espmid = yj.ESPMID
-    WHERE ISNULL(d.pmparentid, d.espmid) = d.espmid
-      AND ISNULL(d.[donotinclude], 0) <> 1
-    GROUP BY d.espmid
-),
-qualifying_properties AS (
-    SELECT
-        pr.espmid
-    FROM property_rollup pr
-    JOIN [dbo].[PrimaryDataBase] d
-        ON d.espmid = pr.espmid
-    WHERE ISNULL(d.pmparentid, d.espmid) = d.espmid
-      AND ISNULL(d.[donotinclude], 0) <> 1
-      AND pr.year_joined IS NOT NULL
-      AND pr.year_joined <= {most_recent_full_calendar_year}
-      AND TRY_CAST(d.[datayear] AS INT) BETWEEN pr.year_joined AND {most_recent_full_calendar_year}
-    GROUP BY pr.espmid, pr.year_joined
-    HAVING COUNT(DISTINCT TRY_CAST(d.[datayear] AS INT)) = {most_recent_full_calendar_year} - pr.year_joined + 1
-       AND COUNT(DISTINCT CASE
-            WHEN UPPER(ISNULL(d.[hasenergygaps], '')) = 'OK'
-             AND UPPER(ISNULL(d.[energylessthan12months], '')) = 'OK'
-            THEN TRY_CAST(d.[datayear] AS INT)
-        END) = {most_recent_full_calendar_year} - pr.year_joined + 1
-)
-SELECT
-    COALESCE(SUM(pr.energy_ok_buildings), 0) AS energy_ok_buildings
-FROM property_rollup pr
-JOIN qualifying_properties qp
-    ON pr.espmid = qp.espmid;
-"""
-        return energy_ok_buildings_query
-    else:
-        energy_ok_buildings_query = f"""
-WITH property_rollup AS (
-    SELECT
-        d.espmid,
-        MIN(TRY_CAST(d.[yearcreatedinespm] AS INT)) AS year_joined,
-        MAX(TRY_CAST(d.[numbuildings] AS DECIMAL(18,2))) AS energy_ok_buildings
-    FROM [dbo].[PrimaryDataBase] d
-    WHERE ISNULL(d.pmparentid, d.espmid) = d.espmid
-      AND ISNULL(d.[donotinclude], 0) <> 1
-    GROUP BY d.espmid
-),
-qualifying_properties AS (
-    SELECT
-        pr.espmid
-    FROM property_rollup pr
-    JOIN [dbo].[PrimaryDataBase] d
-        ON d.espmid = pr.espmid
-    WHERE ISNULL(d.pmparentid, d.espmid) = d.espmid
-      AND ISNULL(d.[donotinclude], 0) <> 1
-      AND pr.year_joined IS NOT NULL
-      AND pr.year_joined <= {most_recent_full_calendar_year}
-      AND TRY_CAST(d.[datayear] AS INT) BETWEEN pr.year_joined AND {most_recent_full_calendar_year}
-    GROUP BY pr.espmid, pr.year_joined
-    HAVING COUNT(DISTINCT TRY_CAST(d.[datayear] AS INT)) = {most_recent_full_calendar_year} - pr.year_joined + 1
-       AND COUNT(DISTINCT CASE
-            WHEN UPPER(ISNULL(d.[hasenergygaps], '')) = 'OK'
-             AND UPPER(ISNULL(d.[energylessthan12months], '')) = 'OK'
-            THEN TRY_CAST(d.[datayear] AS INT)
-        END) = {most_recent_full_calendar_year} - pr.year_joined + 1
-)
-SELECT
-    COALESCE(SUM(pr.energy_ok_buildings), 0) AS energy_ok_buildings
-FROM property_rollup pr
-JOIN qualifying_properties qp
-    ON pr.espmid = qp.espmid;
-"""
-        return energy_ok_buildings_query
+summary_df = portfolio_rollup('summary')
 
-energy_ok_buildings_df = conn.query(energy_ok_buildings_query_builder(tenant))
+energy_ok_buildings_df = portfolio_rollup('energy_ok_buildings')
 if not energy_ok_buildings_df.empty and pd.notna(energy_ok_buildings_df['energy_ok_buildings'].iloc[0]):
     energy_ok_buildings = int(round(float(energy_ok_buildings_df['energy_ok_buildings'].iloc[0])))
 else:
     energy_ok_buildings = 0
 
-def water_ok_buildings_query_builder(tenant):
-    if tenant == "washtenaw":
-        water_ok_buildings_query = f"""
-        WITH property_rollup AS (
-            SELECT
-                d.espmid,
-                MAX(TRY_CAST(yj.[year joined] AS INT)) AS year_joined,
-                MAX(TRY_CAST(d.[numbuildings] AS DECIMAL(18,2))) AS water_ok_buildings
-            FROM [dbo].[PrimaryDataBase] d
-            LEFT JOIN [dbo].[yearjoined] yj
-                ON d.espmid = yj.ESPMID
-            WHERE ISNULL(d.pmparentid, d.espmid) = d.espmid
-            AND ISNULL(d.[donotinclude], 0) <> 1
-            AND TRY_CAST(d.datayear AS INT) = {most_recent_full_calendar_year}
-            AND TRY_CAST(yj.[year joined] AS INT) <= {most_recent_full_calendar_year}
-            AND d.[waterlessthan12months] = 'ok'
-            AND d.[haswatergaps] = 'ok'
-            GROUP BY d.espmid
-        )
-        SELECT
-            COALESCE(SUM(WATER_ok_buildings), 0) AS water_ok_buildings
-        FROM property_rollup;
-        """
-        return water_ok_buildings_query
-    else:
-        water_ok_buildings_query = f"""
-                WITH property_rollup AS (
-                    SELECT
-                        d.espmid,
-                        MAX(TRY_CAST(d.[yearcreatedinespm] AS INT)) AS year_joined,
-                        MAX(TRY_CAST(d.[numbuildings] AS DECIMAL(18,2))) AS water_ok_buildings
-                    FROM [dbo].[PrimaryDataBase] d
-                    WHERE ISNULL(d.pmparentid, d.espmid) = d.espmid
-                    AND ISNULL(d.[donotinclude], 0) <> 1
-                    AND TRY_CAST(d.datayear AS INT) = {most_recent_full_calendar_year}
-                    AND TRY_CAST(d.[yearcreatedinespm] AS INT) <= {most_recent_full_calendar_year}
-                    AND d.[waterlessthan12months] = 'ok'
-                    AND d.[haswatergaps] = 'ok'
-                    GROUP BY d.espmid
-                )
-                SELECT
-                    COALESCE(SUM(WATER_ok_buildings), 0) AS water_ok_buildings
-                FROM property_rollup;
-                """
-        return water_ok_buildings_query
-water_ok_buildings_df = conn.query(water_ok_buildings_query_builder(tenant))
+water_ok_buildings_df = portfolio_rollup('water_ok_buildings')
 if not water_ok_buildings_df.empty and pd.notna(water_ok_buildings_df['water_ok_buildings'].iloc[0]):
     water_ok_buildings = int(round(float(water_ok_buildings_df['water_ok_buildings'].iloc[0])))
 else:
@@ -226,81 +97,7 @@ site_eui_first_slot = st.empty()
 
 # Building counts by year from DB:
 # include a property's building count when report_year >= year joined
-def buildings_by_year_query_builder(tenant):
-    if tenant == "washtenaw":
-        buildings_by_year_query = f"""
-WITH years AS (
-    SELECT 2018 AS report_year UNION ALL
-    SELECT 2019 UNION ALL
-    SELECT 2020 UNION ALL
-    SELECT 2021 UNION ALL
-    SELECT 2022 UNION ALL
-    SELECT 2023 UNION ALL
-    SELECT 2024 UNION ALL
-    SELECT {most_recent_full_calendar_year}
-),
-property_rollup AS (
-    SELECT
-        d.espmid,
-        MAX(TRY_CAST(yj.[year joined] AS INT)) AS year_joined,
-        MAX(TRY_CAST(d.[numbuildings] AS DECIMAL(18,2))) AS numbuildings,
-        MAX(TRY_CAST(d.[sqfootage] AS DECIMAL(18,2))) AS sqfootage
-    FROM [dbo].[PrimaryDataBase] d
-    LEFT JOIN [dbo].[yearjoined] yj
-        ON d.espmid = yj.ESPMID
-    WHERE ISNULL(d.pmparentid, d.espmid) = d.espmid
-      AND ISNULL(d.[donotinclude], 0) <> 1
-      AND TRY_CAST(d.datayear AS INT) < {most_recent_full_calendar_year + 1}
-    GROUP BY d.espmid
-)
-SELECT
-    y.report_year AS [year],
-    COALESCE(SUM(pr.numbuildings), 0) AS buildings,
-    COALESCE(SUM(pr.sqfootage), 0) AS total_sqft
-FROM years y
-LEFT JOIN property_rollup pr
-    ON pr.year_joined <= y.report_year
-GROUP BY y.report_year
-ORDER BY y.report_year
-"""
-        return buildings_by_year_query
-    else:
-        buildings_by_year_query = f"""
-WITH years AS (
-    SELECT 2018 AS report_year UNION ALL
-    SELECT 2019 UNION ALL
-    SELECT 2020 UNION ALL
-    SELECT 2021 UNION ALL
-    SELECT 2022 UNION ALL
-    SELECT 2023 UNION ALL
-    SELECT 2024 UNION ALL
-    SELECT {most_recent_full_calendar_year}
-),
-property_rollup AS (
-    SELECT
-        d.espmid,
-        MAX(TRY_CAST(d.[yearcreatedinespm] AS INT)) AS year_joined,
-        MAX(TRY_CAST(d.[numbuildings] AS DECIMAL(18,2))) AS numbuildings,
-        MAX(TRY_CAST(d.[sqfootage] AS DECIMAL(18,2))) AS sqfootage
-    FROM [dbo].[PrimaryDataBase] d
-    WHERE ISNULL(d.pmparentid, d.espmid) = d.espmid
-      AND ISNULL(d.[donotinclude], 0) <> 1
-      AND TRY_CAST(d.datayear AS INT) < {most_recent_full_calendar_year + 1}
-    GROUP BY d.espmid
-)
-SELECT
-    y.report_year AS [year],
-    COALESCE(SUM(pr.numbuildings), 0) AS buildings,
-    COALESCE(SUM(pr.sqfootage), 0) AS total_sqft
-FROM years y
-LEFT JOIN property_rollup pr
-    ON pr.year_joined <= y.report_year
-GROUP BY y.report_year
-ORDER BY y.report_year
-"""
-        return buildings_by_year_query
-
-buildings_df = conn.query(buildings_by_year_query_builder(tenant))
+buildings_df = portfolio_rollup('buildings_by_year')
 buildings_df["year"] = buildings_df["year"].astype(str)
 buildings_df["buildings"] = (
     pd.to_numeric(buildings_df["buildings"], errors="coerce")
@@ -393,129 +190,27 @@ st.plotly_chart(fig, width="content")
 
 
 
-def current_query_builder(tenant):
-    if tenant == "washtenaw":
-        return f"""
-SELECT
-    e.[usetype],
-    COALESCE(SUM(TRY_CAST(e.[sqfootage] AS DECIMAL(10,2))), 0) AS total_sqft,
-    AVG(TRY_CAST(e.[siteeui] AS DECIMAL(10,2))) AS avg_siteeui,
-    COUNT(DISTINCT e.[espmid]) AS property_count
-FROM [dbo].[PrimaryDataBase] e
-WHERE TRY_CONVERT(INT, e.[datayear]) = {most_recent_full_calendar_year}
-    AND ISNULL(e.pmparentid, e.espmid) = e.espmid
-    AND ISNULL(e.[donotinclude], 0) <> 1
-    AND EXISTS (
-        SELECT 1
-        FROM dbo.yearjoined y
-        WHERE y.espmid = e.espmid
-            AND TRY_CONVERT(INT, y.[year joined]) <= {most_recent_full_calendar_year}
-    )
-GROUP BY e.[usetype]
-HAVING COALESCE(SUM(TRY_CAST(e.[sqfootage] AS DECIMAL(10,2))), 0) > 0
-"""
+def current_query_builder():
     return f"""
 SELECT
     e.[usetype],
-    COALESCE(SUM(TRY_CAST(e.[sqfootage] AS DECIMAL(10,2))), 0) AS total_sqft,
+    COALESCE(SUM(CAST(e.[sqfootage] AS DECIMAL(10,2))), 0) AS total_sqft,
     AVG(TRY_CAST(e.[siteeui] AS DECIMAL(10,2))) AS avg_siteeui,
     COUNT(DISTINCT e.[espmid]) AS property_count
 FROM [dbo].[PrimaryDataBase] e
-WHERE TRY_CONVERT(INT, e.[datayear]) = {most_recent_full_calendar_year}
+WHERE e.[datayear_num] = {most_recent_full_calendar_year}
     AND ISNULL(e.pmparentid, e.espmid) = e.espmid
     AND ISNULL(e.[donotinclude], 0) <> 1
-    AND TRY_CONVERT(INT, e.[yearcreatedinespm]) <= {most_recent_full_calendar_year}
+    AND e.year_joined <= {most_recent_full_calendar_year}
 GROUP BY e.[usetype]
-HAVING COALESCE(SUM(TRY_CAST(e.[sqfootage] AS DECIMAL(10,2))), 0) > 0
+HAVING COALESCE(SUM(CAST(e.[sqfootage] AS DECIMAL(10,2))), 0) > 0
 """
 
 
-def pie_query_builder(tenant):
-    if tenant == "washtenaw":
-        return f"""
-WITH ranked AS (
-    SELECT
-        e.usetype,
-        COUNT(DISTINCT e.espmid) AS building_count,
-        SUM(TRY_CONVERT(INT, e.numbuildings)) AS building_sum,
-        ROW_NUMBER() OVER (
-            ORDER BY COUNT(DISTINCT e.espmid) DESC, e.usetype
-        ) AS usetype_rank
-    FROM [dbo].[PrimaryDataBase] e
-    WHERE ISNULL(e.pmparentid, e.espmid) = e.espmid
-        AND TRY_CONVERT(INT, e.datayear) = {most_recent_full_calendar_year}
-        AND ISNULL(e.[donotinclude], 0) <> 1
-        AND EXISTS (
-            SELECT 1
-            FROM dbo.yearjoined y
-            WHERE y.espmid = e.espmid
-                AND TRY_CONVERT(INT, y.[year joined]) <= {most_recent_full_calendar_year}
-        )
-    GROUP BY e.usetype
-)
-SELECT
-    {most_recent_full_calendar_year} AS datayear,
-    CASE
-        WHEN usetype_rank <= 10 THEN usetype
-        ELSE 'Other'
-    END AS usetype,
-    SUM(building_count) AS building_count,
-    SUM(building_sum) AS building_sum
-FROM ranked
-GROUP BY
-    CASE
-        WHEN usetype_rank <= 10 THEN usetype
-        ELSE 'Other'
-    END
-ORDER BY
-    CASE WHEN
-        CASE WHEN usetype_rank <= 10 THEN usetype ELSE 'Other' END = 'Other'
-        THEN 1 ELSE 0
-    END,
-    SUM(building_count) DESC;
-"""
-    return f"""
-WITH ranked AS (
-    SELECT
-        e.usetype,
-        COUNT(DISTINCT e.espmid) AS building_count,
-        SUM(TRY_CONVERT(INT, e.numbuildings)) AS building_sum,
-        ROW_NUMBER() OVER (
-            ORDER BY COUNT(DISTINCT e.espmid) DESC, e.usetype
-        ) AS usetype_rank
-    FROM [dbo].[PrimaryDataBase] e
-    WHERE ISNULL(e.pmparentid, e.espmid) = e.espmid
-        AND TRY_CONVERT(INT, e.datayear) = {most_recent_full_calendar_year}
-        AND ISNULL(e.[donotinclude], 0) <> 1
-        AND TRY_CONVERT(INT, e.[yearcreatedinespm]) <= {most_recent_full_calendar_year}
-    GROUP BY e.usetype
-)
-SELECT
-    {most_recent_full_calendar_year} AS datayear,
-    CASE
-        WHEN usetype_rank <= 10 THEN usetype
-        ELSE 'Other'
-    END AS usetype,
-    SUM(building_count) AS building_count,
-    SUM(building_sum) AS building_sum
-FROM ranked
-GROUP BY
-    CASE
-        WHEN usetype_rank <= 10 THEN usetype
-        ELSE 'Other'
-    END
-ORDER BY
-    CASE WHEN
-        CASE WHEN usetype_rank <= 10 THEN usetype ELSE 'Other' END = 'Other'
-        THEN 1 ELSE 0
-    END,
-    SUM(building_count) DESC;
-"""
 
 
-current_query = current_query_builder(tenant)
-pie_query = pie_query_builder(tenant)
-pie_data=conn.query(pie_query)                                                                                     #PIE CHART
+current_query = current_query_builder()
+pie_data=portfolio_rollup('usetype_pie')                                                                                     #PIE CHART
 
 fig_pie = px.pie(
     pie_data,
@@ -560,74 +255,7 @@ fig_pie.update_layout(
 st.plotly_chart(fig_pie, width="stretch")
 
 
-
-def yearly_query_builder(tenant):
-    if tenant == "washtenaw":
-        return f"""
-    SELECT
-        TRY_CAST(e.[datayear] AS INT) as datayear,
-        COALESCE(SUM(TRY_CAST(e.[sqfootage] AS DECIMAL(10,2))), 0) as total_sqft,
-        AVG(TRY_CAST(e.[weathernormalizedsiteeui] AS DECIMAL(10,2))) as avg_siteeui,
-        AVG(b.zerotool_baseline) as baseline,
-        AVG(b.zerotool_baseline) * (0.86 - 0.03 * (TRY_CAST(e.[datayear] AS INT) - 2018)) as target
-    FROM [dbo].[PrimaryDataBase] e
-    LEFT JOIN (
-        SELECT
-            TRY_CAST([espmid] AS BIGINT) AS espmid,
-            MAX(TRY_CAST([baseline] AS DECIMAL(10,2))) AS zerotool_baseline
-        FROM [dbo].[baselines]
-        GROUP BY TRY_CAST([espmid] AS BIGINT)
-    ) b
-        ON TRY_CAST(e.[espmid] AS BIGINT) = b.espmid
-    INNER JOIN (
-        SELECT
-            TRY_CONVERT(INT, [ESPMID]) AS espmid,
-            MIN(TRY_CONVERT(INT, [year joined])) AS yearjoined
-        FROM [dbo].[yearjoined]
-        GROUP BY TRY_CONVERT(INT, [ESPMID])
-    ) yj
-        ON TRY_CONVERT(INT, e.[espmid]) = yj.espmid
-    WHERE TRY_CAST(e.[datayear] AS INT) IN (2018, 2019, 2020, 2021, 2022, 2023, 2024, {most_recent_full_calendar_year})
-        AND ISNULL(e.pmparentid, e.espmid) = e.espmid
-        AND ISNULL(e.[donotinclude], 0) <> 1
-        AND e.hasenergygaps = 'OK'
-        AND e.energylessthan12months = 'OK'
-        AND e.weathernormalizedsiteeui IS NOT NULL
-        AND TRY_CAST(e.[datayear] AS INT) >= yj.yearjoined
-    GROUP BY TRY_CAST(e.[datayear] AS INT)
-    HAVING COALESCE(SUM(TRY_CAST(e.[sqfootage] AS DECIMAL(10,2))), 0) > 0
-    ORDER BY datayear
-"""
-    return f"""
-    SELECT
-        TRY_CAST(e.[datayear] AS INT) as datayear,
-        COALESCE(SUM(TRY_CAST(e.[sqfootage] AS DECIMAL(10,2))), 0) as total_sqft,
-        AVG(TRY_CAST(e.[weathernormalizedsiteeui] AS DECIMAL(10,2))) as avg_siteeui,
-        AVG(b.zerotool_baseline) as baseline,
-        AVG(b.zerotool_baseline) * (0.86 - 0.03 * (TRY_CAST(e.[datayear] AS INT) - 2018)) as target
-    FROM [dbo].[PrimaryDataBase] e
-    LEFT JOIN (
-        SELECT
-            TRY_CAST([espmid] AS BIGINT) AS espmid,
-            MAX(TRY_CAST([baseline] AS DECIMAL(10,2))) AS zerotool_baseline
-        FROM [dbo].[baselines]
-        GROUP BY TRY_CAST([espmid] AS BIGINT)
-    ) b
-        ON TRY_CAST(e.[espmid] AS BIGINT) = b.espmid
-    WHERE TRY_CAST(e.[datayear] AS INT) IN (2018, 2019, 2020, 2021, 2022, 2023, 2024, {most_recent_full_calendar_year})
-        AND ISNULL(e.pmparentid, e.espmid) = e.espmid
-        AND ISNULL(e.[donotinclude], 0) <> 1
-        AND e.hasenergygaps = 'OK'
-        AND e.energylessthan12months = 'OK'
-        AND e.weathernormalizedsiteeui IS NOT NULL
-        AND TRY_CAST(e.[yearcreatedinespm] AS INT) <= TRY_CAST(e.[datayear] AS INT)
-    GROUP BY TRY_CAST(e.[datayear] AS INT)
-    HAVING COALESCE(SUM(TRY_CAST(e.[sqfootage] AS DECIMAL(10,2))), 0) > 0
-    ORDER BY datayear
-"""
-
-
-df_yearly = conn.query(yearly_query_builder(tenant))
+df_yearly = portfolio_rollup('eui_by_year')
 df_yearly = df_yearly.sort_values('datayear')
 for col in ['avg_siteeui', 'baseline', 'target']:
     df_yearly[col] = pd.to_numeric(df_yearly[col], errors='coerce')
@@ -705,59 +333,7 @@ st.download_button(
 )
                                         #WUI GRAPH
 ### query buildings with water gaps 
-def wateryear_query_builder(tenant):
-    if tenant == "washtenaw":
-        return f"""
-    SELECT
-        TRY_CAST(e.[datayear] AS INT) as datayear,
-        AVG(TRY_CAST(e.[wui] AS DECIMAL(10,2))) as avg_wui,
-        AVG(TRY_CAST(wb.[wuibaseline] AS DECIMAL(10,2))) as baseline,
-        AVG(TRY_CAST(wb.[wuibaseline] AS DECIMAL(10,2))) * (0.86 - 0.03 * (TRY_CAST(e.[datayear] AS INT) - 2018)) as target
-    FROM [dbo].[PrimaryDataBase] e
-    LEFT JOIN [dbo].[wuibaselines] wb
-        ON e.[usetype] = wb.[usetype]
-    INNER JOIN (
-        SELECT
-            TRY_CONVERT(INT, [ESPMID]) AS espmid,
-            MIN(TRY_CONVERT(INT, [year joined])) AS yearjoined
-        FROM [dbo].[yearjoined]
-        GROUP BY TRY_CONVERT(INT, [ESPMID])
-    ) yj
-        ON TRY_CONVERT(INT, e.[espmid]) = yj.espmid
-    WHERE TRY_CAST(e.[datayear] AS INT) IN (2018, 2019, 2020, 2021, 2022, 2023, 2024, {most_recent_full_calendar_year})
-        AND ISNULL(e.pmparentid, e.espmid) = e.espmid
-        AND ISNULL(e.[donotinclude], 0) <> 1
-        AND e.haswatergaps = 'OK'
-        AND TRY_CAST(e.[wui] AS DECIMAL(10,2)) IS NOT NULL
-        AND e.waterlessthan12months = 'OK'
-        AND TRY_CAST(wb.[wuibaseline] AS DECIMAL(10,2)) IS NOT NULL
-        AND TRY_CAST(e.[datayear] AS INT) >= yj.yearjoined
-    GROUP BY TRY_CAST(e.[datayear] AS INT)
-    ORDER BY datayear
-"""
-    return f"""
-    SELECT
-        TRY_CAST(e.[datayear] AS INT) as datayear,
-        AVG(TRY_CAST(e.[wui] AS DECIMAL(10,2))) as avg_wui,
-        AVG(TRY_CAST(wb.[wuibaseline] AS DECIMAL(10,2))) as baseline,
-        AVG(TRY_CAST(wb.[wuibaseline] AS DECIMAL(10,2))) * (0.86 - 0.03 * (TRY_CAST(e.[datayear] AS INT) - 2018)) as target
-    FROM [dbo].[PrimaryDataBase] e
-    LEFT JOIN [dbo].[wuibaselines] wb
-        ON e.[usetype] = wb.[usetype]
-    WHERE TRY_CAST(e.[datayear] AS INT) IN (2018, 2019, 2020, 2021, 2022, 2023, 2024, {most_recent_full_calendar_year})
-        AND ISNULL(e.pmparentid, e.espmid) = e.espmid
-        AND ISNULL(e.[donotinclude], 0) <> 1
-        AND e.haswatergaps = 'OK'
-        AND TRY_CAST(e.[wui] AS DECIMAL(10,2)) IS NOT NULL
-        AND e.waterlessthan12months = 'OK'
-        AND TRY_CAST(wb.[wuibaseline] AS DECIMAL(10,2)) IS NOT NULL
-        AND TRY_CAST(e.[yearcreatedinespm] AS INT) <= TRY_CAST(e.[datayear] AS INT)
-    GROUP BY TRY_CAST(e.[datayear] AS INT)
-    ORDER BY datayear
-"""
-
-
-df_water = conn.query(wateryear_query_builder(tenant))
+df_water = portfolio_rollup('wui_by_year')
 df_water = df_water.sort_values('datayear')
 df_water[['avg_wui', 'baseline', 'target']] = df_water[['avg_wui', 'baseline', 'target']].apply(
     pd.to_numeric,
@@ -819,53 +395,9 @@ fig_wui_bar.update_xaxes(
     title_font=dict(size=16, color="black", family=CHART_FONT)                  
 )
 st.plotly_chart(fig_wui_bar, width="content")
-def wuibybuildingtype_query_builder(tenant):
-    if tenant == "washtenaw":
-        return f"""
-    SELECT TOP 10
-        e.usetype,
-        AVG(TRY_CAST(e.wui AS FLOAT)) AS averagewui,
-        COUNT(e.usetype) AS numproperties,
-        SUM(TRY_CAST(e.numbuildings AS INT)) AS numberofbuildingswithuse
-    FROM dbo.PrimaryDataBase e
-    INNER JOIN (
-        SELECT
-            TRY_CONVERT(INT, [ESPMID]) AS espmid,
-            MIN(TRY_CONVERT(INT, [year joined])) AS yearjoined
-        FROM dbo.yearjoined
-        GROUP BY TRY_CONVERT(INT, [ESPMID])
-    ) yj
-        ON TRY_CONVERT(INT, e.espmid) = yj.espmid
-    WHERE TRY_CAST(e.datayear AS INT) = {most_recent_full_calendar_year}
-      AND ISNULL(e.pmparentid, e.espmid) = e.espmid
-      AND ISNULL(e.[donotinclude], 0) <> 1
-      AND e.haswatergaps = 'OK'
-      AND e.waterlessthan12months = 'OK'
-      AND TRY_CAST(e.wui AS FLOAT) IS NOT NULL
-      AND TRY_CAST(e.datayear AS INT) >= yj.yearjoined
-    GROUP BY e.usetype
-    ORDER BY numberofbuildingswithuse DESC
-"""
-    return f"""
-    SELECT TOP 10
-        e.usetype,
-        AVG(TRY_CAST(e.wui AS FLOAT)) AS averagewui,
-        COUNT(e.usetype) AS numproperties,
-        SUM(TRY_CAST(e.numbuildings AS INT)) AS numberofbuildingswithuse
-    FROM dbo.PrimaryDataBase e
-    WHERE TRY_CAST(e.datayear AS INT) = {most_recent_full_calendar_year}
-      AND ISNULL(e.pmparentid, e.espmid) = e.espmid
-      AND ISNULL(e.[donotinclude], 0) <> 1
-      AND e.haswatergaps = 'OK'
-      AND e.waterlessthan12months = 'OK'
-      AND TRY_CAST(e.wui AS FLOAT) IS NOT NULL
-      AND TRY_CAST(e.[yearcreatedinespm] AS INT) <= {most_recent_full_calendar_year}
-    GROUP BY e.usetype
-    ORDER BY numberofbuildingswithuse DESC
-"""
 
 
-df_wui_by_type = conn.query(wuibybuildingtype_query_builder(tenant))
+df_wui_by_type = portfolio_rollup('wui_by_usetype')
 df_wui_by_type['averagewui'] = pd.to_numeric(df_wui_by_type['averagewui'], errors='coerce')
 df_wui_by_type['numberofbuildingswithuse'] = pd.to_numeric(df_wui_by_type['numberofbuildingswithuse'], errors='coerce')
 df_wui_by_type = df_wui_by_type.sort_values('numberofbuildingswithuse', ascending=False)
@@ -913,41 +445,7 @@ fig_wui_by_type.update_xaxes(
 st.plotly_chart(fig_wui_by_type, width="content")
                         ###Solar graph
 
-def solar_query_builder(tenant):
-    if tenant == "washtenaw":
-        return """
-SELECT
-    TRY_CONVERT(INT, e.datayear) AS datayear,
-    SUM(e.onSiteRenewableSystemGeneration) AS renewablesum
-FROM PrimaryDataBase e
-INNER JOIN (
-    SELECT
-        TRY_CONVERT(INT, espmid) AS espmid,
-        MIN(TRY_CONVERT(INT, [year joined])) AS yearjoined
-    FROM dbo.yearjoined
-    GROUP BY TRY_CONVERT(INT, espmid)
-) y
-    ON TRY_CONVERT(INT, e.espmid) = y.espmid
-WHERE e.onSiteRenewableSystemGeneration IS NOT NULL
-    AND ISNULL(e.pmparentid, e.espmid) = e.espmid
-    AND TRY_CONVERT(INT, e.datayear) >= y.yearjoined
-GROUP BY TRY_CONVERT(INT, e.datayear)
-ORDER BY TRY_CONVERT(INT, e.datayear);
-"""
-    return """
-SELECT
-    TRY_CONVERT(INT, e.datayear) AS datayear,
-    SUM(e.onSiteRenewableSystemGeneration) AS renewablesum
-FROM PrimaryDataBase e
-WHERE e.onSiteRenewableSystemGeneration IS NOT NULL
-    AND ISNULL(e.pmparentid, e.espmid) = e.espmid
-    AND TRY_CONVERT(INT, e.[yearcreatedinespm]) <= TRY_CONVERT(INT, e.datayear)
-GROUP BY TRY_CONVERT(INT, e.datayear)
-ORDER BY TRY_CONVERT(INT, e.datayear);
-"""
-
-
-solar_df = conn.query(solar_query_builder(tenant))
+solar_df = portfolio_rollup('solar_by_year')
 solar_df = solar_df.sort_values('datayear')
 solar_df['renewablesum'] = pd.to_numeric(solar_df['renewablesum'], errors='coerce')
 solar_df['datayear'] = solar_df['datayear'].astype(str)
@@ -995,193 +493,7 @@ fig_solar.update_xaxes(
 )
 st.plotly_chart(fig_solar, width="content")
 
-def ghg_query_builder(tenant):
-    if tenant == "washtenaw":
-        return """
-WITH emissions_factors AS (
-    SELECT 2021 AS datayear, CAST(0.596 AS DECIMAL(10,6)) AS factor UNION ALL
-    SELECT 2022, CAST(0.663 AS DECIMAL(10,6)) UNION ALL
-    SELECT 2023, CAST(0.628 AS DECIMAL(10,6)) UNION ALL
-    SELECT 2024, CAST(0.565 AS DECIMAL(10,6)) UNION ALL
-    SELECT 2025, CAST(0.506 AS DECIMAL(10,6))
-),
-base_data AS (
-    SELECT
-        TRY_CAST(e.datayear AS INT) AS datayear,
-        TRY_CAST(e.espmid AS BIGINT) AS espmid,
-        TRY_CAST(e.siteEnergyUseElectricityGridPurchaseKwh AS DECIMAL(18,4)) AS electricity_kwh,
-        TRY_CAST(e.greenPowerOffSite AS DECIMAL(18,4)) AS green_power_offsite,
-        TRY_CAST(e.onSiteRenewableSystemGeneration AS DECIMAL(18,4)) AS onsite_solar_kwh,
-        TRY_CAST(e.siteEnergyUseNaturalGas AS DECIMAL(18,4)) AS natural_gas,
-        TRY_CAST(e.sqfootage AS DECIMAL(18,4)) AS sqfootage
-    FROM dbo.PrimaryDataBase e
-    INNER JOIN (
-        SELECT
-            TRY_CAST([espmid] AS BIGINT) AS espmid,
-            MIN(TRY_CAST([year joined] AS INT)) AS yearjoined
-        FROM dbo.yearjoined
-        WHERE TRY_CAST([espmid] AS BIGINT) IS NOT NULL
-          AND TRY_CAST([year joined] AS INT) IS NOT NULL
-        GROUP BY TRY_CAST([espmid] AS BIGINT)
-    ) yj
-        ON TRY_CAST(e.espmid AS BIGINT) = yj.espmid
-    WHERE TRY_CAST(e.[datayear] AS INT) IN (2018, 2019, 2020, 2021, 2022, 2023, 2024, 2025)
-      AND ISNULL(e.pmparentid, e.espmid) = e.espmid
-      AND ISNULL(e.[donotinclude], 0) <> 1
-      AND e.hasenergygaps = 'OK'
-      AND e.energylessthan12months = 'OK'
-      AND TRY_CAST(e.sqfootage AS DECIMAL(18,4)) IS NOT NULL
-      AND TRY_CAST(e.[datayear] AS INT) >= yj.yearjoined
-)
-SELECT
-    b.datayear,
-    COUNT(DISTINCT b.espmid) AS building_count,
-    SUM(b.electricity_kwh) AS total_grid_purchase_kwh,
-    SUM(b.natural_gas) AS total_natural_gas,
-    SUM(b.sqfootage) AS total_sqft,
-
-    MAX(ef.factor) AS electricity_emissions_factor_actual,
-    SUM(
-        CASE
-            WHEN COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0) < 0 THEN 0
-            ELSE COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0)
-        END * ef.factor
-    ) AS electricity_emissions_actual,
-    SUM(COALESCE(b.natural_gas, 0) * 0.053072) AS natural_gas_emissions_actual,
-    (
-        SUM(
-            CASE
-                WHEN COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0) < 0 THEN 0
-                ELSE COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0)
-            END * ef.factor
-        )
-      + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
-    ) AS total_calculated_emissions_actual,
-    (
-        SUM(
-            CASE
-                WHEN COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0) < 0 THEN 0
-                ELSE COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0)
-            END * ef.factor
-        )
-      + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
-    ) / NULLIF(SUM(b.sqfootage), 0) AS total_calculated_emissions_actual_per_sqft,
-
-    CAST(0.71314946 AS DECIMAL(10,8)) AS electricity_emissions_factor_baseline,
-    SUM((COALESCE(b.electricity_kwh, 0) + COALESCE(b.onsite_solar_kwh, 0)) * 0.71314946) AS electricity_emissions_baseline,
-    SUM(COALESCE(b.natural_gas, 0) * 0.053072) AS natural_gas_emissions_baseline,
-    (
-        SUM((COALESCE(b.electricity_kwh, 0) + COALESCE(b.onsite_solar_kwh, 0)) * 0.71314946)
-      + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
-    ) AS total_calculated_emissions_baseline,
-    (
-        SUM((COALESCE(b.electricity_kwh, 0) + COALESCE(b.onsite_solar_kwh, 0)) * 0.71314946)
-      + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
-    ) / NULLIF(SUM(b.sqfootage), 0) AS total_calculated_emissions_baseline_per_sqft,
-
-    (0.5265 - 0.026 * (2025 - b.datayear)) AS ghg_target_reduction_pct,
-    (
-        (
-            SUM((COALESCE(b.electricity_kwh, 0) + COALESCE(b.onsite_solar_kwh, 0)) * 0.71314946)
-          + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
-        ) / NULLIF(SUM(b.sqfootage), 0)
-    ) * (1 - (0.5265 - 0.026 * (2025 - b.datayear))) AS ghg_emissions_target
-
-FROM base_data b
-INNER JOIN emissions_factors ef
-    ON b.datayear = ef.datayear
-GROUP BY b.datayear
-ORDER BY b.datayear;
-"""
-    return """
-WITH emissions_factors AS (
-    SELECT 2021 AS datayear, CAST(0.596 AS DECIMAL(10,6)) AS factor UNION ALL
-    SELECT 2022, CAST(0.663 AS DECIMAL(10,6)) UNION ALL
-    SELECT 2023, CAST(0.628 AS DECIMAL(10,6)) UNION ALL
-    SELECT 2024, CAST(0.565 AS DECIMAL(10,6)) UNION ALL
-    SELECT 2025, CAST(0.506 AS DECIMAL(10,6))
-),
-base_data AS (
-    SELECT
-        TRY_CAST(e.datayear AS INT) AS datayear,
-        TRY_CAST(e.espmid AS BIGINT) AS espmid,
-        TRY_CAST(e.siteEnergyUseElectricityGridPurchaseKwh AS DECIMAL(18,4)) AS electricity_kwh,
-        TRY_CAST(e.greenPowerOffSite AS DECIMAL(18,4)) AS green_power_offsite,
-        TRY_CAST(e.onSiteRenewableSystemGeneration AS DECIMAL(18,4)) AS onsite_solar_kwh,
-        TRY_CAST(e.siteEnergyUseNaturalGas AS DECIMAL(18,4)) AS natural_gas,
-        TRY_CAST(e.sqfootage AS DECIMAL(18,4)) AS sqfootage
-    FROM dbo.PrimaryDataBase e
-    WHERE TRY_CAST(e.[datayear] AS INT) IN (2018, 2019, 2020, 2021, 2022, 2023, 2024, 2025)
-      AND ISNULL(e.pmparentid, e.espmid) = e.espmid
-      AND ISNULL(e.[donotinclude], 0) <> 1
-      AND e.hasenergygaps = 'OK'
-      AND e.energylessthan12months = 'OK'
-      AND TRY_CAST(e.sqfootage AS DECIMAL(18,4)) IS NOT NULL
-      AND TRY_CAST(e.[yearcreatedinespm] AS INT) <= TRY_CAST(e.[datayear] AS INT)
-)
-SELECT
-    b.datayear,
-    COUNT(DISTINCT b.espmid) AS building_count,
-    SUM(b.electricity_kwh) AS total_grid_purchase_kwh,
-    SUM(b.natural_gas) AS total_natural_gas,
-    SUM(b.sqfootage) AS total_sqft,
-
-    MAX(ef.factor) AS electricity_emissions_factor_actual,
-    SUM(
-        CASE
-            WHEN COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0) < 0 THEN 0
-            ELSE COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0)
-        END * ef.factor
-    ) AS electricity_emissions_actual,
-    SUM(COALESCE(b.natural_gas, 0) * 0.053072) AS natural_gas_emissions_actual,
-    (
-        SUM(
-            CASE
-                WHEN COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0) < 0 THEN 0
-                ELSE COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0)
-            END * ef.factor
-        )
-      + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
-    ) AS total_calculated_emissions_actual,
-    (
-        SUM(
-            CASE
-                WHEN COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0) < 0 THEN 0
-                ELSE COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0)
-            END * ef.factor
-        )
-      + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
-    ) / NULLIF(SUM(b.sqfootage), 0) AS total_calculated_emissions_actual_per_sqft,
-
-    CAST(0.71314946 AS DECIMAL(10,8)) AS electricity_emissions_factor_baseline,
-    SUM((COALESCE(b.electricity_kwh, 0) + COALESCE(b.onsite_solar_kwh, 0)) * 0.71314946) AS electricity_emissions_baseline,
-    SUM(COALESCE(b.natural_gas, 0) * 0.053072) AS natural_gas_emissions_baseline,
-    (
-        SUM((COALESCE(b.electricity_kwh, 0) + COALESCE(b.onsite_solar_kwh, 0)) * 0.71314946)
-      + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
-    ) AS total_calculated_emissions_baseline,
-    (
-        SUM((COALESCE(b.electricity_kwh, 0) + COALESCE(b.onsite_solar_kwh, 0)) * 0.71314946)
-      + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
-    ) / NULLIF(SUM(b.sqfootage), 0) AS total_calculated_emissions_baseline_per_sqft,
-
-    (0.5265 - 0.026 * (2025 - b.datayear)) AS ghg_target_reduction_pct,
-    (
-        (
-            SUM((COALESCE(b.electricity_kwh, 0) + COALESCE(b.onsite_solar_kwh, 0)) * 0.71314946)
-          + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
-        ) / NULLIF(SUM(b.sqfootage), 0)
-    ) * (1 - (0.5265 - 0.026 * (2025 - b.datayear))) AS ghg_emissions_target
-
-FROM base_data b
-INNER JOIN emissions_factors ef
-    ON b.datayear = ef.datayear
-GROUP BY b.datayear
-ORDER BY b.datayear;
-"""
-
-
-ghg_df=conn.query(ghg_query_builder(tenant))
+ghg_df=portfolio_rollup('ghg_by_year')
 ghg_df['datayear'] = ghg_df['datayear'].astype(str)
 ghg_plot_df = ghg_df.melt(
     id_vars=['datayear'],
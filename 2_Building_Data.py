@@ -265,13 +265,13 @@ usetype_averages_query = f"""
     SELECT 
     [usetype],
     AVG(TRY_CAST([siteeui] AS FLOAT)) as avg_eui,
-    AVG(TRY_CAST([wui] AS FLOAT)) as avg_wui,
+    AVG(CAST([wui_num] AS FLOAT)) as avg_wui,
     COUNT(DISTINCT [espmid]) as building_count,
     COUNT(*) as row_count
 FROM [dbo].[PrimaryDataBase]
 WHERE [usetype] = '{use_type}'
     AND [siteeui] IS NOT NULL 
-    AND [wui] IS NOT NULL
+    AND [wui_num] IS NOT NULL
 GROUP BY [usetype]
 """
 use_type_df = conn.query(usetype_averages_query)
@@ -415,7 +415,7 @@ def get_meter_data(table_name, espmid, energy_type):
         SELECT 
             [entryid],
             [meterid],
-            TRY_CAST([usage] AS FLOAT) as usage,
+            CAST([usage_num] AS FLOAT) as usage,
             [startdate],
             [enddate]
         FROM [dbo].[{table_name}]
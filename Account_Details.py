@@ -39,11 +39,11 @@ left JOIN [dbo].[portfolios] p
     ON e.[espmid] = p.[espmid]
 left JOIN [dbo].[Baselines] b
     ON e.[espmid] = b.[espmid]
-WHERE TRY_CONVERT(INT, e.datayear) = (
-      SELECT MAX(TRY_CONVERT(INT, e2.datayear))
+WHERE e.datayear_num = (
+      SELECT MAX(e2.datayear_num)
       FROM [dbo].[PrimaryDataBase] e2
       WHERE e2.espmid = e.espmid
-        AND TRY_CONVERT(INT, e2.datayear) IS NOT NULL
+        AND e2.datayear_num IS NOT NULL
       )
 """ 
 base_list = conn.query(base_list_query)
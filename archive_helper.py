@@ -0,0 +1,159 @@
+#Compressed archive of the raw ESPM payloads each ingestion run used, so a run can be replayed offline
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+ARCHIVE_DIR = os.environ.get("ESPM_ARCHIVE_DIR", os.path.join(".espm_cache", "archive"))
+# Only the newest few archived runs of each script are kept; older ones are deleted when a new run starts
+ARCHIVE_KEEP_RUNS = int(os.environ.get("ESPM_ARCHIVE_KEEP_RUNS", 14))
+
+
+def _slug(text):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "-", str(text)).strip("-")
+
+
+class PayloadArchive:
+    """
+    Raw payloads of one ingestion run, gzipped under ARCHIVE_DIR/<run id>/.
+
+    Every payload gets a line in manifest.jsonl with its kind (report,
+    consumption, ...), key, size, sha256 and whatever the caller needs to
+    replay it (espmid, meterid, table name, ...). Use
+    PayloadArchive.create(script, run_id) to record a run and
+    PayloadArchive.load(script, run_id) to read one back ("latest" picks the
+    newest run of that script).
+
+    Safe to share between worker threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.run_id = os.path.basename(path)
+        self._manifest = os.path.join(path, "manifest.jsonl")
+        self._lock = threading.Lock()
+        self.payloads = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+
+    @classmethod
+    def create(cls, script, run_id, base_dir=ARCHIVE_DIR):
+        path = os.path.join(base_dir, f"{_slug(script)}-{_slug(run_id)}")
+        os.makedirs(path, exist_ok=True)
+        cls._prune(script, base_dir, keep=path)
+        return cls(path)
+
+    @classmethod
+    def load(cls, script, run_id="latest", base_dir=ARCHIVE_DIR):
+        if run_id == "latest":
+            runs = cls.list_runs(script, base_dir)
+            if not runs:
+                raise FileNotFoundError(f"No archived runs of {script} under {base_dir}")
+            path = runs[-1]
+        else:
+            path = os.path.join(base_dir, run_id)
+            if not os.path.isdir(path):
+                path = os.path.join(base_dir, f"{_slug(script)}-{_slug(run_id)}")
+        if not os.path.exists(os.path.join(path, "manifest.jsonl")):
+            raise FileNotFoundError(f"No archive manifest in {path}")
+        return cls(path)
+
+    @staticmethod
+    def list_runs(script, base_dir=ARCHIVE_DIR):
+        """
+        Archived run directories of script, oldest first.
+        """
+        if not os.path.isdir(base_dir):
+            return []
+        prefix = f"{_slug(script)}-"
+        runs = [
+            os.path.join(base_dir, name)
+            for name in os.listdir(base_dir)
+            if name.startswith(prefix) and os.path.isdir(os.path.join(base_dir, name))
+        ]
+        return sorted(runs, key=os.path.getmtime)
+
+    def put(self, kind, key, content, **metadata):
+        """
+        Store one payload (bytes). metadata must be JSON serialisable.
+        """
+        if content is None:
+            return
+        relpath = f"{_slug(kind)}/{_slug(key)}.gz"
+        full_path = os.path.join(self.path, *relpath.split("/"))
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        compressed = gzip.compress(content, compresslevel=6)
+        with open(full_path, "wb") as f:
+            f.write(compressed)
+        entry = {
+            "kind": kind,
+            "key": str(key),
+            "file": relpath,
+            "size": len(content),
+            "sha256": hashlib.sha256(content).hexdigest(),
+            "archived_at": time.time(),
+            **metadata,
+        }
+        with self._lock:
+            with open(self._manifest, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.payloads += 1
+            self.raw_bytes += len(content)
+            self.stored_bytes += len(compressed)
+
+    def describe(self, **info):
+        """
+        Record what this run covered (whether it fetched full histories, its date
+        window, ...) so a replay can tell a complete archive from a partial one.
+        info must be JSON serialisable.
+        """
+        self.put("run", "info", json.dumps(info, sort_keys=True).encode("utf-8"), **info)
+
+    def description(self):
+        """
+        What describe() recorded for this run, or None for runs archived without it.
+        """
+        entries = self.entries("run")
+        if not entries:
+            return None
+        return json.loads(self.read(entries[-1]))
+
+    def entries(self, kind=None):
+        """
+        Manifest entries, optionally of one kind, in the order they were archived.
+        A key archived twice (a resumed run) only comes back once, as its latest copy.
+        """
+        latest = {}
+        with open(self._manifest, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if kind is None or entry["kind"] == kind:
+                    latest.pop((entry["kind"], entry["key"]), None)
+                    latest[(entry["kind"], entry["key"])] = entry
+        return list(latest.values())
+
+    def read(self, entry):
+        with open(os.path.join(self.path, *entry["file"].split("/")), "rb") as f:
+            content = gzip.decompress(f.read())
+        if hashlib.sha256(content).hexdigest() != entry["sha256"]:
+            raise ValueError(f"Archived payload {entry['file']} in {self.path} does not match its checksum")
+        return content
+
+    def report(self):
+        print(
+            f"Payload archive {self.path}: {self.payloads} payloads, "
+            f"{self.raw_bytes / (1024 * 1024):.1f} MB raw, {self.stored_bytes / (1024 * 1024):.1f} MB on disk."
+        )
+
+    @classmethod
+    def _prune(cls, script, base_dir, keep):
+        runs = [run for run in cls.list_runs(script, base_dir) if os.path.abspath(run) != os.path.abspath(keep)]
+        for run in runs[:max(0, len(runs) - (ARCHIVE_KEEP_RUNS - 1))]:
+            shutil.rmtree(run, ignore_errors=True)
@@ -0,0 +1,277 @@
+#Micro-benchmark of the consumption/report XML parsing and consumption row building against the xmltodict and per-entry code they replaced
+
+import argparse
+import ast
+import datetime
+import gzip
+import hashlib
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import xmltodict
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from espm_helper import iter_consumption, iter_property_metrics
+
+parser = argparse.ArgumentParser(description="Time the ESPM XML parsers and build_consumption_rows() against the code they replaced.")
+parser.add_argument(
+    "--consumption",
+    nargs="+",
+    metavar="FILE",
+    help="Recorded consumptionData documents (.xml, or .gz straight out of a payload archive) instead of the synthetic meters",
+)
+parser.add_argument(
+    "--report",
+    nargs="+",
+    metavar="FILE",
+    help="Recorded report downloads (.xml or .gz) instead of the synthetic report",
+)
+parser.add_argument(
+    "--bills",
+    type=int,
+    nargs="+",
+    default=[12, 72, 1000, 20000],
+    help="Bills per synthetic meter (default 12 72 1000 20000)",
+)
+parser.add_argument(
+    "--properties",
+    type=int,
+    default=500,
+    help="Properties in the synthetic report, each with 4 years of 30 metrics (default 500)",
+)
+parser.add_argument("--repeat", type=int, default=7, help="Timing runs per case; the fastest counts (default 7)")
+
+
+def load_definitions(path, names, namespace):
+    """
+    Execute only the named top-level functions and assignments of a repo file into
+    namespace. full update.py connects and starts downloading on import, so the
+    shipped build_consumption_rows is lifted out of its source instead; db_helper
+    would need pyodbc just for row_hash.
+    """
+    with open(path, encoding="utf-8-sig") as f:
+        tree = ast.parse(f.read(), filename=path)
+    wanted = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name in names:
+            wanted.append(node)
+        elif isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id in names for target in node.targets):
+            wanted.append(node)
+    found = {node.name if isinstance(node, ast.FunctionDef) else node.targets[0].id for node in wanted}
+    missing = set(names) - found
+    if missing:
+        raise LookupError(f"{sorted(missing)} not found in {path}")
+    exec(compile(ast.Module(body=wanted, type_ignores=[]), path, "exec"), namespace)
+    return namespace
+
+
+shipped = {"hashlib": hashlib, "pd": pd, "np": np}
+load_definitions(os.path.join(REPO_DIR, "db_helper.py"), ["row_hash"], shipped)
+load_definitions(os.path.join(REPO_DIR, "full update.py"), ["SMALLDATETIME_MIN", "SMALLDATETIME_MAX", "build_consumption_rows"], shipped)
+build_consumption_rows = shipped["build_consumption_rows"]
+
+
+def read_payload(path):
+    with open(path, "rb") as f:
+        content = f.read()
+    return gzip.decompress(content) if path.endswith(".gz") else content
+
+
+def consumption_xml(bills, rng):
+    """
+    A consumptionData document shaped like ESPM's: daily bills from 2020-01-01.
+    """
+    start = datetime.date(2020, 1, 1)
+    entries = []
+    for index in range(bills):
+        startdate = start + datetime.timedelta(days=index)
+        entries.append(
+            f'<meterConsumption estimatedValue="false"><id>{100000 + index}</id>'
+            f'<startDate>{startdate.isoformat()}</startDate><endDate>{(startdate + datetime.timedelta(days=1)).isoformat()}</endDate>'
+            f'<usage>{rng.uniform(10, 5000):.2f}</usage><cost>{rng.uniform(5, 900):.2f}</cost>'
+            f'<audit><createdBy>bench</createdBy><createdDate>2024-01-01T00:00:00.000-05:00</createdDate></audit></meterConsumption>'
+        )
+    return f'<?xml version="1.0" encoding="UTF-8"?><meterData>{"".join(entries)}</meterData>'.encode("utf-8")
+
+
+def report_xml(properties, rng, years=4, metrics=30):
+    """
+    A custom report download shaped like ESPM's, with some xsi:nil values.
+    """
+    blocks = []
+    for espmid in range(1000000, 1000000 + properties):
+        for year in range(2021, 2021 + years):
+            values = []
+            for index in range(metrics):
+                if rng.random() < 0.1:
+                    value = '<value xsi:nil="true"/>'
+                else:
+                    value = f"<value>{rng.uniform(0, 100000):.2f}</value>"
+                values.append(f'<metric name="metric{index}" uom="kBtu" dataType="numeric">{value}</metric>')
+            blocks.append(f'<propertyMetrics propertyId="{espmid}" year="{year}">{"".join(values)}</propertyMetrics>')
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<reportData xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"><informationAndMetrics>'
+        f'{"".join(blocks)}</informationAndMetrics></reportData>'
+    ).encode("utf-8")
+
+
+def old_parse_consumption(content):
+    # full update.py before iter_consumption(): the whole document through xmltodict
+    d = xmltodict.parse(content)
+    meter_consumption = d.get('meterData', {}).get('meterConsumption')
+    if meter_consumption is None:
+        return []
+    if isinstance(meter_consumption, dict):
+        consumption_list = [meter_consumption]
+    else:
+        consumption_list = meter_consumption
+    return [
+        (entry.get('id'), entry.get('cost'), entry.get('usage'), entry.get('startDate'), entry.get('endDate'))
+        for entry in consumption_list
+        if isinstance(entry, dict)
+    ]
+
+
+def old_parse_report(content):
+    # espmreportingapproach.py before iter_property_metrics()
+    report_output = xmltodict.parse(content)
+    buildings = report_output['reportData']['informationAndMetrics']['propertyMetrics']
+    if isinstance(buildings, dict):
+        buildings = [buildings]
+    parsed = []
+    for building in buildings:
+        metrics = {}
+        for buildingvalue in building['metric']:
+            raw_value = buildingvalue.get('value')
+            metrics[buildingvalue.get('@name')] = None if isinstance(raw_value, dict) else raw_value
+        parsed.append((building['@propertyId'], building.get('@year'), metrics))
+    return parsed
+
+
+def old_build_rows(espmid, meter, entries):
+    # The per-entry strptime loop every meter branch of full update.py had before build_consumption_rows()
+    rows = []
+    for entryid, cost, usage, startdate_str, enddate_str in entries:
+        meterid = meter
+        startdate = None
+        enddate = None
+        if startdate_str:
+            try:
+                startdate_dt = datetime.datetime.strptime(startdate_str, '%Y-%m-%d')
+                startdate_dt = startdate_dt.replace(second=0, microsecond=0)
+                if startdate_dt >= datetime.datetime(1900, 1, 1) and startdate_dt <= datetime.datetime(2079, 6, 6, 23, 59):
+                    startdate = startdate_dt
+                else:
+                    print(f"Warning: startdate {startdate_str} is outside smalldatetime range")
+            except ValueError as e:
+                print(f"Warning: Could not parse startdate {startdate_str}: {e}")
+        if enddate_str:
+            try:
+                enddate_dt = datetime.datetime.strptime(enddate_str, '%Y-%m-%d')
+                enddate_dt = enddate_dt.replace(second=0, microsecond=0)
+                if enddate_dt >= datetime.datetime(1900, 1, 1) and enddate_dt <= datetime.datetime(2079, 6, 6, 23, 59):
+                    enddate = enddate_dt
+                else:
+                    print(f"Warning: enddate {enddate_str} is outside smalldatetime range")
+            except ValueError as e:
+                print(f"Warning: Could not parse enddate {enddate_str}: {e}")
+        if entryid and meterid:
+            unique_entryid = f"{meterid}_{entryid}"
+        elif entryid:
+            unique_entryid = f"{espmid}_{entryid}"
+        elif startdate_str and enddate_str:
+            unique_entryid = f"{meterid}_{startdate_str}_{enddate_str}"
+        elif startdate_str:
+            unique_entryid = f"{meterid}_{startdate_str}"
+        else:
+            unique_entryid = f"{meterid}_{espmid}_{len(rows)}"
+        rows.append({
+            'espmid': espmid,
+            'entryid': unique_entryid,
+            'meterid': str(meterid) if meterid else None,
+            'cost': str(cost) if cost else None,
+            'usage': str(usage) if usage else None,
+            'startdate': startdate,
+            'enddate': enddate,
+        })
+    return rows
+
+
+def best_ms(function, repeat):
+    return min(timeit.repeat(function, number=1, repeat=repeat)) * 1000
+
+
+def peak_mb(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+
+def row_key(row):
+    return row['entryid'], row['startdate'], row['enddate']
+
+
+def main():
+    args = parser.parse_args()
+    rng = random.Random(0)
+    repeat = max(1, args.repeat)
+    if args.consumption:
+        meters = [(os.path.basename(path), read_payload(path)) for path in args.consumption]
+    else:
+        meters = [(f"{bills} bills", consumption_xml(bills, rng)) for bills in args.bills]
+    if args.report:
+        reports = [(os.path.basename(path), read_payload(path)) for path in args.report]
+    else:
+        reports = [(f"{args.properties} props x 4 yrs x 30 metrics", report_xml(args.properties, rng))]
+
+    print("consumptionData parse (xmltodict / iter_consumption)")
+    for label, content in meters:
+        old_entries = old_parse_consumption(content)
+        new_entries = list(iter_consumption(content))
+        if old_entries != new_entries:
+            raise AssertionError(f"{label}: iter_consumption() disagrees with xmltodict")
+        old_ms = best_ms(lambda: old_parse_consumption(content), repeat)
+        new_ms = best_ms(lambda: list(iter_consumption(content)), repeat)
+        print(f"  {label:>30} {len(content) / 1024:9.0f} KB  {old_ms:9.2f} ms / {new_ms:9.2f} ms  ({old_ms / new_ms:.1f}x)")
+
+    print("report parse (xmltodict / iter_property_metrics), with tracemalloc peak")
+    for label, content in reports:
+        old_metrics = old_parse_report(content)
+        new_metrics = list(iter_property_metrics(content))
+        if old_metrics != new_metrics:
+            raise AssertionError(f"{label}: iter_property_metrics() disagrees with xmltodict")
+        old_ms = best_ms(lambda: old_parse_report(content), repeat)
+        new_ms = best_ms(lambda: list(iter_property_metrics(content)), repeat)
+        old_peak = peak_mb(lambda: old_parse_report(content))
+        new_peak = peak_mb(lambda: list(iter_property_metrics(content)))
+        print(
+            f"  {label:>30} {len(content) / (1024 * 1024):6.1f} MB  "
+            f"{old_ms:9.1f} ms, {old_peak:6.1f} MB peak / {new_ms:9.1f} ms, {new_peak:6.1f} MB peak"
+        )
+
+    # build_consumption_rows() also hashes every row (rowhash), which the old loop never did
+    print("consumption rows for one meter (per-entry strptime / build_consumption_rows)")
+    for label, content in meters:
+        entries = list(iter_consumption(content))
+        old_rows = old_build_rows(1, "2000001", entries)
+        new_rows = build_consumption_rows(1, "2000001", entries)
+        if list(map(row_key, old_rows)) != list(map(row_key, new_rows)):
+            raise AssertionError(f"{label}: build_consumption_rows() disagrees with the per-entry loop")
+        old_ms = best_ms(lambda: old_build_rows(1, "2000001", entries), repeat)
+        new_ms = best_ms(lambda: build_consumption_rows(1, "2000001", entries), repeat)
+        print(f"  {label:>30} {len(entries):9d} bills  {old_ms:9.2f} ms / {new_ms:9.2f} ms  ({old_ms / new_ms:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+#Pooled Azure SQL connections for the ingestion scripts
+
+import hashlib
+import os
+import threading
+import time
+
+import pyodbc
+
+# A connection that has sat unused this long is pinged with SELECT 1 before it is handed back out
+DB_IDLE_PING_SECONDS = float(os.environ.get("DB_IDLE_PING_SECONDS", 60))
+# Most connections open at once; acquire() waits for a release beyond this
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+
+
+def is_connection_error(error):
+    """
+    True when a pyodbc error means the link to SQL Server went away (08S01,
+    communication link failure, timeouts) rather than the statement being bad.
+    """
+    error_str = str(error).lower()
+    return ('communication link failure' in error_str or '08s01' in error_str or
+            'connection' in error_str or 'timeout' in error_str or 'timed out' in error_str)
+
+
+def row_hash(values):
+    """
+    SHA-256 of a row's payload columns, for the rowhash BINARY(32) columns the
+    MERGEs compare instead of every column. None hashes differently from ''.
+
+    Args:
+        values: the column values in a fixed order
+
+    Returns:
+        32 bytes
+    """
+    payload = "\x1f".join("\x00" if value is None else str(value) for value in values)
+    return hashlib.sha256(payload.encode("utf-8")).digest()
+
+
+def connect_with_retry(connection_string, max_retries=4, backoff_factor=2, timeout=30):
+    """
+    Attempt to connect to SQL Server with retry logic for timeouts.
+
+    Args:
+        connection_string: ODBC connection string
+        max_retries: Maximum number of connection attempts
+        backoff_factor: Multiplier for wait time between retries
+        timeout: Connection timeout in seconds
+
+    Returns:
+        pyodbc.Connection object if successful
+    """
+    for attempt in range(max_retries):
+        try:
+            print(f'Attempting to connect to SQL Server (attempt {attempt + 1}/{max_retries})...')
+            connection = pyodbc.connect(connection_string)
+            print('Connection Successful')
+            return connection
+        except pyodbc.Error as e:
+            # Only timeouts and dropped connections are worth another attempt
+            if is_connection_error(e):
+                if attempt < max_retries - 1:
+                    wait_time = backoff_factor ** attempt
+                    print(f'Connection error. Retrying in {wait_time} seconds...')
+                    time.sleep(wait_time)
+                else:
+                    print(f'Failed to connect after {max_retries} attempts.')
+                    raise
+            else:
+                raise
+
+    # Should not reach here, but just in case
+    raise pyodbc.OperationalError("Failed to establish connection after all retries")
+
+
+class PooledConnection:
+    """
+    One pyodbc connection and its fast_executemany cursor, checked out of a
+    ConnectionPool. Not shared between threads; each stage acquires its own.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.connection = None
+        self.cursor = None
+        self.last_used = 0.0
+        self.reconnect()
+
+    def reconnect(self):
+        self.close()
+        self.connection = connect_with_retry(self.pool.connection_string, max_retries=3, backoff_factor=2, timeout=30)
+        self.cursor = self.connection.cursor()
+        self.cursor.fast_executemany = True
+        self.last_used = time.monotonic()
+        self.pool._count("connects")
+
+    def ensure_alive(self, force=False):
+        """
+        Ping the connection if it has been idle for the pool's idle_ping_seconds,
+        or straight away when force is set (after a connection error), and
+        reconnect if the ping fails.
+
+        Returns:
+            (connection, cursor) tuple
+        """
+        if self.connection is None:
+            self.reconnect()
+        elif force or time.monotonic() - self.last_used >= self.pool.idle_ping_seconds:
+            self.pool._count("pings")
+            try:
+                self.cursor.execute("SELECT 1")
+                self.cursor.fetchone()
+            except pyodbc.Error:
+                print("Connection lost. Reconnecting...")
+                self.reconnect()
+                self.pool._count("reconnects")
+                print("Reconnection successful.")
+        self.last_used = time.monotonic()
+        return self.connection, self.cursor
+
+    def execute(self, query, params=None, max_retries=3):
+        """
+        Execute a statement, reconnecting and trying again on connection errors.
+        Only for statements that are safe to repeat on a fresh connection.
+        """
+        for attempt in range(max_retries):
+            connection, cursor = self.ensure_alive(force=attempt > 0)
+            try:
+                if params:
+                    cursor.execute(query, params)
+                else:
+                    cursor.execute(query)
+                self.last_used = time.monotonic()
+                return cursor
+            except pyodbc.Error as e:
+                if is_connection_error(e) and attempt < max_retries - 1:
+                    wait_time = 2 ** attempt
+                    print(f"Connection error during query. Retrying in {wait_time} seconds... (attempt {attempt + 1}/{max_retries})")
+                    time.sleep(wait_time)
+                else:
+                    if is_connection_error(e):
+                        print(f"Failed to execute query after {max_retries} attempts: {e}")
+                    raise
+
+    def close(self):
+        for handle in (self.cursor, self.connection):
+            if handle is not None:
+                try:
+                    handle.close()
+                except pyodbc.Error:
+                    pass
+        self.cursor = None
+        self.connection = None
+
+
+class ConnectionPool:
+    """
+    Hands out PooledConnections so parallel stages of an ingestion run each
+    get their own connection and cursor. Released connections are kept open
+    and reused; one is only pinged when it has been idle for
+    idle_ping_seconds, instead of before every statement.
+
+    Safe to share between worker threads.
+    """
+
+    def __init__(self, connection_string, max_size=DB_POOL_SIZE, idle_ping_seconds=DB_IDLE_PING_SECONDS):
+        self.connection_string = connection_string
+        self.max_size = max(1, max_size)
+        self.idle_ping_seconds = idle_ping_seconds
+        self._cond = threading.Condition()
+        self._idle = []
+        self._all = []
+        self._stats = {"connects": 0, "pings": 0, "reconnects": 0}
+
+    def acquire(self):
+        with self._cond:
+            while not self._idle and len(self._all) >= self.max_size:
+                self._cond.wait()
+            if self._idle:
+                pooled = self._idle.pop()
+            else:
+                pooled = None
+                # Hold the slot while connecting outside the lock
+                self._all.append(None)
+        if pooled is None:
+            try:
+                pooled = PooledConnection(self)
+            except Exception:
+                with self._cond:
+                    self._all.remove(None)
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._all[self._all.index(None)] = pooled
+            return pooled
+        try:
+            pooled.ensure_alive()
+        except Exception:
+            self._discard(pooled)
+            raise
+        return pooled
+
+    def release(self, pooled):
+        if pooled.connection is None:
+            self._discard(pooled)
+            return
+        with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            pooled_connections = [pooled for pooled in self._all if pooled is not None]
+            self._all = []
+            self._idle = []
+            self._cond.notify_all()
+        for pooled in pooled_connections:
+            pooled.close()
+
+    def report(self):
+        with self._cond:
+            stats = dict(self._stats)
+        print(
+            f"Database pool: {stats['connects']} connections opened, "
+            f"{stats['pings']} idle pings, {stats['reconnects']} reconnects."
+        )
+
+    def _count(self, name):
+        with self._cond:
+            self._stats[name] += 1
+
+    def _discard(self, pooled):
+        pooled.close()
+        with self._cond:
+            if pooled in self._all:
+                self._all.remove(pooled)
+            self._cond.notify()
+
+
+SCHEMA_VERSION_QUERY = """
+IF OBJECT_ID('schema_version') IS NULL
+    SELECT 0
+ELSE
+    SELECT ISNULL(MAX(version), 0) FROM schema_version
+"""
+
+
+def apply_migrations(db, migrations):
+    """
+    Bring the schema up to date from an ordered list of migrations.
+
+    The highest version applied is kept in the schema_version table, so when
+    the schema is current this is a single query. Otherwise every pending
+    statement runs in one transaction, under an exclusive application lock so
+    two scripts starting together apply each step once, and the new versions
+    are recorded in that same transaction. A failing step rolls all of them back.
+
+    A statement may instead be a function taking the PooledConnection, for a
+    batched backfill that commits as it goes. The steps before it are committed
+    first, and its version is only recorded once it returns.
+
+    Args:
+        db: PooledConnection to migrate on
+        migrations: (version, description, statements) tuples in increasing version order
+
+    Returns:
+        list of the versions applied, empty if there was nothing to do
+    """
+    if not migrations:
+        return []
+    connection, cursor = db.ensure_alive()
+    cursor.execute(SCHEMA_VERSION_QUERY)
+    if cursor.fetchone()[0] >= migrations[-1][0]:
+        return []
+
+    applied = []
+    locked = False
+    try:
+        # Held by the session rather than a transaction so it outlasts a backfill's commits
+        cursor.execute("""
+        DECLARE @lock_result INT;
+        EXEC @lock_result = sp_getapplock @Resource = 'schema_version', @LockMode = 'Exclusive', @LockOwner = 'Session', @LockTimeout = 600000;
+        IF @lock_result < 0
+            THROW 50000, 'Could not lock schema_version to apply migrations.', 1;
+        """)
+        locked = True
+        cursor.execute("""
+        IF OBJECT_ID('schema_version') IS NULL
+            CREATE TABLE schema_version (
+                version INT PRIMARY KEY,
+                description NVARCHAR(200),
+                appliedat DATETIME2 DEFAULT SYSUTCDATETIME()
+            )
+        """)
+        # Read again under the lock; another run may have migrated while this one waited
+        cursor.execute("SELECT ISNULL(MAX(version), 0) FROM schema_version")
+        current = cursor.fetchone()[0]
+        for version, description, statements in migrations:
+            if version <= current:
+                continue
+            print(f"Applying schema migration {version}: {description}")
+            for statement in statements:
+                if callable(statement):
+                    connection.commit()
+                    statement(db)
+                    connection, cursor = db.ensure_alive()
+                else:
+                    cursor.execute(statement)
+            cursor.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+            applied.append(version)
+        connection.commit()
+    except pyodbc.Error:
+        try:
+            connection.rollback()
+        except pyodbc.Error:
+            pass
+        raise
+    finally:
+        if locked:
+            try:
+                cursor.execute("EXEC sp_releaseapplock @Resource = 'schema_version', @LockOwner = 'Session'")
+                connection.commit()
+            except pyodbc.Error:
+                pass
+    db.last_used = time.monotonic()
+    return applied
@@ -7,7 +7,8 @@ import requests
 from requests.auth import HTTPBasicAuth 
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from auth_helper import get_connection, get_tenant_secret, require_login
+from auth_helper import get_connection, get_current_tenant, get_tenant_secret, require_login
+from espm_helper import ESPMResponseCache
 import xmltodict
 from datetime import datetime
 from xml.parsers.expat import ExpatError
@@ -42,6 +43,20 @@ adapter = HTTPAdapter(
 )
 session.mount("https://", adapter)
 session.mount("http://", adapter)
+
+
+@st.cache_resource
+def _espm_cache():
+    return ESPMResponseCache()
+
+
+# Every widget click reruns the page, so keep ESPM documents for a few minutes instead of refetching them
+espm_cache = _espm_cache()
+ESPM_METER_TTL = 10 * 60
+ESPM_CONSUMPTION_TTL = 2 * 60
+# metercatalog is refreshed by the ingester; entries older than this fall back to /meter/{id}
+METER_CATALOG_MAX_AGE_DAYS = 7
+tenant = get_current_tenant()
 st.title("Error Finder")
 
 conn = get_connection()
@@ -82,6 +97,63 @@ def _build_meter_df(meter_dict):
         )
     return df
 
+def _catalog_meters(espmid):
+    """
+    Fresh metercatalog entries for a property, keyed by meterid and shaped like
+    the parts of ESPM's meter document that findgaps() reads. Empty if the
+    catalog table isn't there yet.
+    """
+    try:
+        catalog_df = conn.query(
+            "SELECT meterid, inuse, inactivedate, metername, refreshedat FROM metercatalog WHERE espmid = :espmid",
+            params={"espmid": int(espmid)},
+            ttl=ESPM_METER_TTL,
+        )
+    except Exception:
+        return {}
+    cutoff = pd.Timestamp.now() - pd.Timedelta(days=METER_CATALOG_MAX_AGE_DAYS)
+    meters = {}
+    for row in catalog_df.itertuples(index=False):
+        if pd.isna(row.refreshedat) or pd.Timestamp(row.refreshedat) < cutoff:
+            continue
+        meters[str(row.meterid)] = {
+            "inUse": row.inuse,
+            "inactiveDate": pd.Timestamp(row.inactivedate).strftime("%Y-%m-%d") if pd.notna(row.inactivedate) else None,
+            "name": row.metername or "",
+        }
+    return meters
+
+
+def _stored_water_consumption(espmid):
+    """
+    Water bills the ingester has loaded for a property, as one DataFrame per
+    meter with the startDate/endDate columns findgaps() works on. Meters with
+    nothing stored (or no water table yet) are left out and fetched live.
+    """
+    try:
+        water_df = conn.query(
+            "SELECT meterid, startdate, enddate FROM water WHERE espmid = :espmid",
+            params={"espmid": int(espmid)},
+            ttl=ESPM_CONSUMPTION_TTL,
+        )
+    except Exception:
+        return {}
+    water_df = water_df.rename(columns={"startdate": "startDate", "enddate": "endDate"})
+    water_df["startDate"] = pd.to_datetime(water_df["startDate"], errors="coerce")
+    water_df["endDate"] = pd.to_datetime(water_df["endDate"], errors="coerce")
+    return {
+        str(meterid): group.drop(columns="meterid").reset_index(drop=True)
+        for meterid, group in water_df.groupby("meterid")
+    }
+
+
+def _meter_info(meterid, catalog):
+    if str(meterid) in catalog:
+        return catalog[str(meterid)]
+    response =espm_cache.get(session, f"https://portfoliomanager.energystar.gov/ws/meter/{meterid}",ttl=ESPM_METER_TTL,tenant=tenant,auth=HTTPBasicAuth(user, pw),timeout=60)
+    return xmltodict.parse(response.content).get("meter", {})
+
+
 def findgaps(selection):
     ###Finding the gaps
     ##list of dictionaries where each key is first the ID and then each different type of error (gap,overlap,no meter)
@@ -95,18 +167,20 @@ def findgaps(selection):
         haswatergaps = selection["haswatergaps"].iloc[0]
         energylessthan12months = selection["energylessthan12months"].iloc[0]
         waterlessthan12months = selection["waterlessthan12months"].iloc[0]
-        response =session.get(f"https://portfoliomanager.energystar.gov/ws/association/property/{espmid}/meter",auth=HTTPBasicAuth(user, pw),timeout=60)
+        response =espm_cache.get(session, f"https://portfoliomanager.energystar.gov/ws/association/property/{espmid}/meter",ttl=ESPM_METER_TTL,tenant=tenant,auth=HTTPBasicAuth(user, pw),timeout=60)
         dict_data= xmltodict.parse(response.content)
+        meter_catalog = _catalog_meters(espmid)
 
         if hasenergygaps == "Possible Issue" or energylessthan12months =="Possible Issue":
             for meter in dict_data['meterPropertyAssociationList']['energyMeterAssociation']['meters']['meterId']:
                 date2=datetime(int(datayear),1,1)
                 meterid=meter
-                response =session.get(f"https://portfoliomanager.energystar.gov/ws/meter/{meterid}",auth=HTTPBasicAuth(user, pw),timeout=60)
-                dict_data2= xmltodict.parse(response.content)
-                meter_info = dict_data2.get("meter", {})
-                response = session.get(
+                meter_info = _meter_info(meterid, meter_catalog)
+                response = espm_cache.get(
+                    session,
                     f"https://portfoliomanager.energystar.gov/ws/meter/{meterid}/consumptionData?startDate=2020-01-01",
+                    ttl=ESPM_CONSUMPTION_TTL,
+                    tenant=tenant,
                     auth=HTTPBasicAuth(user, pw),
                     timeout=60,
                 )
@@ -195,36 +269,43 @@ def findgaps(selection):
                     )
         
         if haswatergaps == "Possible Issue" or waterlessthan12months == "Possible Issue":
+            stored_water = _stored_water_consumption(espmid)
             for meter in dict_data['meterPropertyAssociationList']['waterMeterAssociation']['meters']['meterId']:
                 date2=datetime(int(datayear),1,1)
                 meterid=meter
-                response =session.get(f"https://portfoliomanager.energystar.gov/ws/meter/{meterid}",auth=HTTPBasicAuth(user, pw),timeout=60)
-                dict_data2= xmltodict.parse(response.content)
-                meter_info = dict_data2.get("meter", {})
-                response = session.get(
-                    f"https://portfoliomanager.energystar.gov/ws/meter/{meterid}/consumptionData?startDate=2020-01-01",
-                    auth=HTTPBasicAuth(user, pw),
-                    timeout=60,
-                )
+                meter_info = _meter_info(meterid, meter_catalog)
+                # Bills already loaded into the water table; ESPM is only asked about meters the ingester hasn't stored
+                df = stored_water.get(str(meterid))
+                response = None
+                if df is None:
+                    response = espm_cache.get(
+                        session,
+                        f"https://portfoliomanager.energystar.gov/ws/meter/{meterid}/consumptionData?startDate=2020-01-01",
+                        ttl=ESPM_CONSUMPTION_TTL,
+                        tenant=tenant,
+                        auth=HTTPBasicAuth(user, pw),
+                        timeout=60,
+                    )
                 if meter_info.get("inUse") == 'false':
                     if datetime.strptime(meter_info['inactiveDate'],"%Y-%m-%d")<date2:
                         pass
                     else:
                         errorlist.append(f"Inactive Water Meter {meterid} needs to have data added until its enddate or needs its enddate changed")
-                elif response.ok and response.content:
-                    try:
-                        dict_data3=xmltodict.parse(response.content)
-                    except ExpatError:
-                        errorlist.append(
-                            f"Water meter {meterid} returned non-XML consumption data (HTTP {response.status_code})"
-                        )
-                        continue
-                    meter_consumption = dict_data3.get("meterData", {}).get("meterConsumption")
-                    if not meter_consumption:
-                        continue
-                    df = pd.json_normalize(meter_consumption)
-                    df['startDate'] = pd.to_datetime(df['startDate'], format="%Y-%m-%d", errors="coerce")
-                    df['endDate'] = pd.to_datetime(df['endDate'], format="%Y-%m-%d", errors="coerce")
+                elif df is not None or (response.ok and response.content):
+                    if df is None:
+                        try:
+                            dict_data3=xmltodict.parse(response.content)
+                        except ExpatError:
+                            errorlist.append(
+                                f"Water meter {meterid} returned non-XML consumption data (HTTP {response.status_code})"
+                            )
+                            continue
+                        meter_consumption = dict_data3.get("meterData", {}).get("meterConsumption")
+                        if not meter_consumption:
+                            continue
+                        df = pd.json_normalize(meter_consumption)
+                        df['startDate'] = pd.to_datetime(df['startDate'], format="%Y-%m-%d", errors="coerce")
+                        df['endDate'] = pd.to_datetime(df['endDate'], format="%Y-%m-%d", errors="coerce")
                     df = df.sort_values("startDate").reset_index(drop=True)
                     df["prev_endDate"] = df["endDate"].shift(1)
                     df["gap_days"] = (df["startDate"] - df["prev_endDate"]).dt.days
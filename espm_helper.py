@@ -0,0 +1,287 @@
+#Shared helpers for talking to the ESPM web services (ingestion scripts and the Error Finder page)
+
+import io
+import os
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+import requests
+
+DEFAULT_TENANT = os.environ.get("ESPM_TENANT", "washtenaw")
+ESPM_CACHE_PATH = os.environ.get("ESPM_CACHE_PATH", os.path.join(".espm_cache", "responses.sqlite3"))
+ESPM_CACHE_MAX_BYTES = int(os.environ.get("ESPM_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# How long a response without ETag/Last-Modified is trusted before it is downloaded again
+ESPM_CACHE_TTL = int(os.environ.get("ESPM_CACHE_TTL", 12 * 60 * 60))
+XSI_NIL = "{http://www.w3.org/2001/XMLSchema-instance}nil"
+
+
+class ESPMResponseCache:
+    """
+    On-disk cache of ESPM GET responses, keyed by tenant and URL.
+
+    Entries that came back with an ETag or Last-Modified header are revalidated
+    with If-None-Match / If-Modified-Since once their TTL runs out, so a 304 costs
+    a round trip but no body. Entries without validators are served until the TTL
+    expires and then downloaded again. A ttl of 0 means always ask ESPM (a
+    conditional request if possible); such a response without validators could
+    never be served from the cache, so it is not stored. The file is capped at
+    max_bytes; the least recently used entries are evicted first.
+
+    Safe to share between worker threads.
+    """
+
+    def __init__(self, path=ESPM_CACHE_PATH, max_bytes=ESPM_CACHE_MAX_BYTES, default_ttl=ESPM_CACHE_TTL, tenant=DEFAULT_TENANT):
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.tenant = tenant
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                tenant TEXT NOT NULL,
+                url TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (tenant, url)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_responses_accessed ON responses (accessed_at)")
+        self._conn.commit()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    def get(self, session, url, ttl=None, tenant=None, **kwargs):
+        """
+        GET url through the cache. kwargs are passed to session.get (auth, timeout, ...).
+
+        Returns a requests.Response; cached bodies come back as a 200 with the
+        stored content.
+        """
+        ttl = self.default_ttl if ttl is None else ttl
+        tenant = tenant or self.tenant
+        with self._lock:
+            entry = self._conn.execute(
+                "SELECT etag, last_modified, body, stored_at FROM responses WHERE tenant = ? AND url = ?",
+                (tenant, url),
+            ).fetchone()
+        now = time.time()
+
+        if entry is not None:
+            etag, last_modified, body, stored_at = entry
+            if ttl > 0 and now - stored_at < ttl:
+                self._touch(tenant, url, now, refreshed=False)
+                self._count_hit(len(body))
+                return self._cached_response(url, body)
+            headers = dict(kwargs.pop("headers", None) or {})
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+            kwargs["headers"] = headers
+
+        response = session.get(url, **kwargs)
+
+        if entry is not None and response.status_code == 304:
+            self._touch(tenant, url, now, refreshed=True)
+            with self._lock:
+                self.revalidated += 1
+            self._count_hit(len(entry[2]))
+            return self._cached_response(url, entry[2])
+
+        with self._lock:
+            self.misses += 1
+        if response.status_code == 200 and response.content:
+            if ttl > 0 or response.headers.get("ETag") or response.headers.get("Last-Modified"):
+                self._store(tenant, url, response, now)
+            elif entry is not None:
+                # Kept, it would only push out entries that can still be served
+                self._forget(tenant, url)
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes_saved": self.bytes_saved,
+            }
+
+    def report(self):
+        stats = self.stats()
+        total = stats["hits"] + stats["misses"]
+        hit_rate = (stats["hits"] / total * 100) if total else 0.0
+        print(
+            f"ESPM response cache: {stats['hits']} hits ({stats['revalidated']} revalidated with a 304), "
+            f"{stats['misses']} misses, {hit_rate:.1f}% hit rate, "
+            f"{stats['bytes_saved'] / (1024 * 1024):.1f} MB not downloaded, {stats['evictions']} evictions."
+        )
+
+    def _count_hit(self, size):
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += size
+
+    def _touch(self, tenant, url, now, refreshed):
+        with self._lock:
+            if refreshed:
+                self._conn.execute(
+                    "UPDATE responses SET accessed_at = ?, stored_at = ? WHERE tenant = ? AND url = ?",
+                    (now, now, tenant, url),
+                )
+            else:
+                self._conn.execute(
+                    "UPDATE responses SET accessed_at = ? WHERE tenant = ? AND url = ?",
+                    (now, tenant, url),
+                )
+            self._conn.commit()
+
+    def _store(self, tenant, url, response, now):
+        body = response.content
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT OR REPLACE INTO responses (tenant, url, etag, last_modified, body, size, stored_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    tenant,
+                    url,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                    sqlite3.Binary(body),
+                    len(body),
+                    now,
+                    now,
+                ),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _forget(self, tenant, url):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE tenant = ? AND url = ?", (tenant, url))
+            self._conn.commit()
+
+    def _evict(self):
+        # Caller holds the lock. Drop least recently used entries until we are under the size cap.
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        while total > self.max_bytes:
+            oldest = self._conn.execute(
+                "SELECT tenant, url, size FROM responses ORDER BY accessed_at LIMIT 100"
+            ).fetchall()
+            if not oldest:
+                break
+            for tenant, url, size in oldest:
+                if total <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM responses WHERE tenant = ? AND url = ?", (tenant, url))
+                total -= size
+                self.evictions += 1
+
+    @staticmethod
+    def _cached_response(url, body):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = body
+        response.url = url
+        response.headers["X-ESPM-Cache"] = "hit"
+        return response
+
+
+def _local_name(tag):
+    # Drop any {namespace} prefix so lookups work whether or not ESPM qualifies the tags
+    return tag.rsplit("}", 1)[-1]
+
+
+def _element_value(elem):
+    # xsi:nil="true" and empty elements both come back as None, matching what xmltodict gave us
+    if elem.get(XSI_NIL) == "true":
+        return None
+    text = (elem.text or "").strip()
+    return text or None
+
+
+def iter_consumption(content):
+    """
+    Stream the meterConsumption entries out of a consumptionData document.
+
+    Each entry is cleared as soon as it has been read, so memory stays flat no
+    matter how many bills the meter has. A single entry and a list of entries
+    come out the same way.
+
+    Yields:
+        (id, cost, usage, startDate, endDate) tuples of strings, None where missing
+    """
+    for _, elem in ElementTree.iterparse(io.BytesIO(content), events=("end",)):
+        if _local_name(elem.tag) != "meterConsumption":
+            continue
+        fields = {_local_name(child.tag): _element_value(child) for child in elem}
+        yield (
+            fields.get("id"),
+            fields.get("cost"),
+            fields.get("usage"),
+            fields.get("startDate"),
+            fields.get("endDate"),
+        )
+        elem.clear()
+
+
+def iter_property_metrics(content):
+    """
+    Stream the propertyMetrics blocks out of a downloaded report (type=XML).
+
+    Yields:
+        (propertyId, year, metrics) where metrics maps metric name to its value
+        string, or None for nil values
+    """
+    for _, elem in ElementTree.iterparse(io.BytesIO(content), events=("end",)):
+        if _local_name(elem.tag) != "propertyMetrics":
+            continue
+        metrics = {}
+        for metric in elem:
+            if _local_name(metric.tag) != "metric":
+                continue
+            value = None
+            for child in metric:
+                if _local_name(child.tag) == "value":
+                    value = _element_value(child)
+            metrics[metric.get("name")] = value
+        yield elem.get("propertyId"), elem.get("year"), metrics
+        elem.clear()
+
+
+def parse_report_status(content):
+    """
+    Read the status out of a /reports/{id}/status response.
+
+    Returns:
+        the reportStatus value upper-cased (for example IN_PROCESS or READY), or None
+    """
+    try:
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError:
+        return None
+    for elem in root.iter():
+        if _local_name(elem.tag) == "reportStatus":
+            # The value is either the element's own text or nested in a child
+            # element, as in <reportStatus><status>READY</status></reportStatus>
+            value = next((value for value in map(_element_value, elem.iter()) if value), None)
+            return value.upper() if value else None
+    return None
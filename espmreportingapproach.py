@@ -1,7 +1,9 @@
 ﻿import pyodbc
 import random
 import datetime
+import argparse
 import pandas as pd
+import numpy as np
 import requests
 import time
 import sqlite3
@@ -15,8 +17,67 @@ from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import os
 import io
+import json
+import itertools
+import operator
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from espm_helper import ESPMResponseCache, iter_property_metrics, parse_report_status
+from db_helper import ConnectionPool, apply_migrations, row_hash
+from schema_helper import MIGRATIONS, typed_assignments, typed_value
+from archive_helper import PayloadArchive
+from portfolio_queries import bump_data_version, dashboard_tenant, refresh_rollups, resolve_year_joined
 
 load_dotenv("secrets.env")
+
+parser = argparse.ArgumentParser(description="Pull the ESPM custom report into PrimaryDataBase.")
+parser.add_argument(
+    "--years",
+    type=int,
+    default=int(os.environ.get("ESPM_REPORT_YEARS", 2)),
+    help="Refresh only the trailing N calendar years (default 2, or ESPM_REPORT_YEARS); 0 means the full window",
+)
+parser.add_argument(
+    "--full-backfill",
+    action="store_true",
+    help="Request every year since FULL_WINDOW_START_YEAR instead of only the trailing years",
+)
+parser.add_argument(
+    "--replay",
+    nargs="?",
+    const="latest",
+    metavar="RUN_ID",
+    help="Rebuild PrimaryDataBase from an archived run's report XML (default latest) without calling ESPM",
+)
+args = parser.parse_args()
+# The dashboard tenant this database belongs to; picks the year_joined rule and keys the rollups
+TENANT = dashboard_tenant()
+REPLAY_RUN = args.replay
+# The report XML, property list and yearcreatedinespm lookups of every run are archived for --replay
+if REPLAY_RUN:
+    archive = PayloadArchive.load("espmreportingapproach", REPLAY_RUN)
+    print(f"Replaying archived run {archive.run_id}; ESPM will not be called.")
+else:
+    archive = PayloadArchive.create("espmreportingapproach", datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+# The report runs through the last finished calendar year. Older years rarely change once
+# finalized, so normally only the trailing --years are refreshed; the whole window is
+# requested on --full-backfill and automatically on ESPM_BACKFILL_DAY of every month.
+FULL_WINDOW_START_YEAR = 2021
+REPORT_TO_YEAR = datetime.date.today().year - 1
+BACKFILL_DAY = int(os.environ.get("ESPM_BACKFILL_DAY", 1))
+FULL_BACKFILL = args.full_backfill or args.years <= 0 or datetime.date.today().day == BACKFILL_DAY
+if FULL_BACKFILL:
+    REPORT_FROM_YEAR = FULL_WINDOW_START_YEAR
+else:
+    REPORT_FROM_YEAR = min(REPORT_TO_YEAR, max(FULL_WINDOW_START_YEAR, REPORT_TO_YEAR - args.years + 1))
+print(f"Report window: {REPORT_FROM_YEAR}-{REPORT_TO_YEAR}{' (full backfill)' if FULL_BACKFILL else ''}.")
+if REPLAY_RUN:
+    # A trailing-years run only archived those years' report rows, so replaying it leaves older years as they are
+    archived_window = archive.description() or {}
+    if not archived_window.get('full_window'):
+        print(f"Warning: {archive.run_id} was not a full-backfill run ({archived_window.get('from_year', '?')}-{archived_window.get('to_year', '?')}); this replay only rewrites the years it archived.")
+else:
+    archive.describe(full_window=FULL_BACKFILL, from_year=REPORT_FROM_YEAR, to_year=REPORT_TO_YEAR)
 user = os.environ.get("ENERGY_STAR_PORTFOLIO_MANAGER_USERNAME")
 pw = os.environ.get("ENERGY_STAR_PORTFOLIO_MANAGER_PASSWORD")
 retry_strategy = Retry(
@@ -25,14 +86,40 @@ retry_strategy = Retry(
     status_forcelist=[500, 502, 503, 504]
 )
 
+# Concurrent /property/{id} lookups for properties whose yearcreatedinespm isn't stored yet
+PROPERTY_FETCH_WORKERS = max(1, int(os.environ.get("ESPM_FETCH_WORKERS", 8)))
+
 session = requests.Session()
-adapter = HTTPAdapter(max_retries=retry_strategy)
+# Room for the property lookups plus one connection per report definition
+adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=PROPERTY_FETCH_WORKERS + 4)
 session.mount("https://", adapter)
+# Property documents are cached on disk between runs; the property list is always revalidated
+espm_cache = ESPMResponseCache()
+# Custom report definitions to generate with. The property list is split into shards of
+# REPORT_SHARD_SIZE ids and each report id works through shards one at a time, so the number
+# of ids is how many shards are in flight at once.
+REPORT_IDS = [int(report_id) for report_id in os.environ.get("ESPM_REPORT_IDS", "").split(",") if report_id.strip()] or [21829340]
+REPORT_SHARD_SIZE = max(1, int(os.environ.get("ESPM_REPORT_SHARD_SIZE", 350)))
+REPORT_SHARD_ATTEMPTS = max(1, int(os.environ.get("ESPM_REPORT_SHARD_ATTEMPTS", 3)))
+# Report status is polled starting at REPORT_POLL_SECONDS, doubling up to REPORT_MAX_POLL_SECONDS,
+# until the report is ready or REPORT_DEADLINE_SECONDS have passed since /generate
+REPORT_POLL_SECONDS = float(os.environ.get("ESPM_REPORT_POLL_SECONDS", 5))
+REPORT_MAX_POLL_SECONDS = float(os.environ.get("ESPM_REPORT_MAX_POLL_SECONDS", 60))
+REPORT_DEADLINE_SECONDS = float(os.environ.get("ESPM_REPORT_DEADLINE_SECONDS", 900))
+REPORT_READY_STATUSES = {"READY", "GENERATED", "COMPLETE", "COMPLETED"}
+REPORT_FAILED_STATUSES = {"FAILED", "ERROR"}
+# Statuses that mean keep polling. Any other status stops the polling and the download is
+# simply tried, as it is once the deadline passes, so an unexpected word never loses a shard.
+REPORT_PENDING_STATUSES = {"IN_PROCESS", "IN_PROGRESS", "PROCESSING", "GENERATING", "PENDING", "QUEUED", "SUBMITTED"}
 server='aa2030dashboardfree.database.windows.net'
 database='dashboarddb'
 username=os.environ.get("DATABASEUSER")
 password=os.environ.get("DATABASEPW")
 driver= '{ODBC Driver 18 for SQL Server}'
+connection_string = f'Driver={driver};Server=tcp:aa2030dashboardfree.database.windows.net,1433;Database=dashboarddb;Uid=CloudSA3d4fc968;Pwd={password};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;'
+# One pooled connection is checked out as db; connection/cursor point at it
+db_pool = ConnectionPool(connection_string)
+db = None
 connection = None
 cursor = None
 
@@ -64,128 +151,94 @@ def safe_to_decimal(value):
     except (TypeError, ValueError):
         return None
 
-def connect_with_retry(max_retries=4, backoff_factor=2, timeout=30):
+# ESPM report metric -> (PrimaryDataBase column, converter). None keeps the text as ESPM sent it;
+# 'int' and 'decimal' follow safe_to_int and safe_to_decimal, and 'float' keeps full precision.
+# A new metric only needs an entry here (and a column in PrimaryDataBase and the MERGE).
+REPORT_METRICS = {
+    'propertyName': ('buildingname', None),
+    'propGrossFloorArea': ('sqfootage', 'int'),
+    'address1': ('address', None),
+    'occupancy': ('occupancy', None),
+    'numberOfBuildings': ('numbuildings', None),
+    'primaryPropertyTypeSelfSelected': ('usetype', None),
+    'yearBuilt': ('yearbuilt', None),
+    'siteIntensity': ('siteeui', 'decimal'),
+    'siteIntensityWN': ('weathernormalizedsiteeui', 'float'),
+    'score': ('energystarscore', None),
+    'waterIntensityTotal': ('wui', None),
+    'energyCost': ('energycost', 'decimal'),
+    'energyCostIntensity': ('energycostintensity', 'decimal'),
+    'energyCostElectricityGridPurchase': ('energycostelectricitygridpurchase', 'decimal'),
+    'energyCostNaturalGas': ('energycostnaturalgas', 'decimal'),
+    'siteEnergyUseElectricityGridPurchaseKwh': ('siteEnergyUseElectricityGridPurchaseKwh', 'decimal'),
+    'siteEnergyUseNaturalGas': ('siteEnergyUseNaturalGas', 'decimal'),
+    'totalMarketBasedGHGEmissions': ('totalMarketBasedGHGEmissions', 'decimal'),
+    'greenPowerOffSite': ('greenPowerOffSite', 'decimal'),
+    'onSiteRenewableSystemElectricityExported': ('onSiteRenewableSystemElectricityExported', 'decimal'),
+    'onSiteRenewableSystemGeneration': ('onSiteRenewableSystemGeneration', 'decimal'),
+    'alertEnergyMeterGap': ('hasenergygaps', None),
+    'alertWaterMeterGap': ('haswatergaps', None),
+    'alertEnergyMeterLessThanTwelveMonthsMeterData': ('energylessthan12months', None),
+    'alertWaterMeterLessThanTwelveMonthsMeterData': ('waterlessthan12months', None),
+    'parentPropertyId': ('pmparentid', 'int'),
+}
+# Column order of #PrimaryDataBaseTEMP rows; espmid, yearcreatedinespm and datayear don't come from metrics
+REPORT_COLUMNS = [
+    'espmid', 'buildingname', 'sqfootage', 'address', 'occupancy', 'numbuildings', 'usetype', 'yearbuilt',
+    'yearcreatedinespm', 'datayear', 'siteeui', 'weathernormalizedsiteeui', 'energystarscore', 'wui',
+    'energycost', 'energycostintensity', 'energycostelectricitygridpurchase', 'energycostnaturalgas',
+    'siteEnergyUseElectricityGridPurchaseKwh', 'siteEnergyUseNaturalGas', 'totalMarketBasedGHGEmissions',
+    'greenPowerOffSite', 'onSiteRenewableSystemElectricityExported', 'onSiteRenewableSystemGeneration',
+    'hasenergygaps', 'haswatergaps', 'energylessthan12months', 'waterlessthan12months', 'pmparentid',
+]
+# Compiled once: metric name -> column, and column -> converter
+METRIC_COLUMNS = {metric_name: column for metric_name, (column, _) in REPORT_METRICS.items()}
+COLUMN_CONVERTERS = {column: converter for column, converter in REPORT_METRICS.values() if converter}
+
+def convert_report_column(values, converter):
     """
-    Attempt to connect to SQL Server with retry logic for timeouts.
-    
+    Convert a whole report column of metric strings in one pass with
+    pd.to_numeric. Commas are ignored and 'decimal' values are rounded with
+    Python's round(), as in safe_to_int / safe_to_decimal, so row hashes match
+    the values those give. Unlike them, anything that isn't a finite number
+    becomes None, and so does an 'int' outside the int64 range.
+
     Args:
-        max_retries: Maximum number of connection attempts
-        backoff_factor: Multiplier for wait time between retries
-        timeout: Connection timeout in seconds
-    
-    Returns:    
-        pyodbc.Connection object if successful
-    """
-    connection_string = f'Driver={driver};Server=tcp:aa2030dashboardfree.database.windows.net,1433;Database=dashboarddb;Uid=CloudSA3d4fc968;Pwd={password};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;'
-    
-    for attempt in range(max_retries):
-        try:
-            print(f'Attempting to connect to SQL Server (attempt {attempt + 1}/{max_retries})...')
-            connection = pyodbc.connect(connection_string)
-            print('Connection Successful')
-            return connection
-        except pyodbc.OperationalError as e:
-            error_str = str(e).lower()
-            # Check if it's a timeout or connection error
-            if 'timeout' in error_str or 'timed out' in error_str or 'connection' in error_str:
-                if attempt < max_retries - 1:
-                    wait_time = backoff_factor ** attempt
-                    print(f'Connection timeout. Retrying in {wait_time} seconds...')
-                    time.sleep(wait_time)
-                else:
-                    print(f'Failed to connect after {max_retries} attempts.')
-                    raise
-            else:
-                # Not a timeout error, re-raise immediately
-                raise
-        except pyodbc.Error as e:
-            # For other pyodbc errors, check if it's connection-related
-            error_str = str(e).lower()
-            if 'timeout' in error_str or 'timed out' in error_str or 'connection' in error_str:
-                if attempt < max_retries - 1:
-                    wait_time = backoff_factor ** attempt
-                    print(f'Connection error. Retrying in {wait_time} seconds...')
-                    time.sleep(wait_time)
-                else:
-                    print(f'Failed to connect after {max_retries} attempts.')
-                    raise
-            else:
-                # Not a connection-related error, re-raise immediately
-                raise
-    
-    # Should not reach here, but just in case
-    raise pyodbc.OperationalError("Failed to establish connection after all retries")
+        values: list of strings (or None)
+        converter: 'int', 'decimal' or 'float'
 
-def check_and_reconnect():
+    Returns:
+        list of int/float/None
     """
-    Check if connection is alive, reconnect if needed.
-    Returns: (connection, cursor) tuple
-    """
-    global connection, cursor
-    try:
-        # Try a simple query to check if connection is alive
-        cursor.execute("SELECT 1")
-        cursor.fetchone()
-        return connection, cursor
-    except (pyodbc.Error, AttributeError):
-        # Connection is dead or doesn't exist, reconnect
-        print("Connection lost. Reconnecting...")
-        try:
-            if connection:
-                try:
-                    connection.close()
-                except:
-                    pass
-            if cursor:
-                try:
-                    cursor.close()
-                except:
-                    pass
-        except:
-            pass
-        
-        connection = connect_with_retry(max_retries=3, backoff_factor=2, timeout=30)
-        cursor = connection.cursor()
-        cursor.fast_executemany = True
-        print("Reconnection successful.")
-        return connection, cursor
-
-def execute_with_retry(query, params=None, max_retries=3):
-    """
-    Execute a database query with retry logic for connection failures.
-    """
-    for attempt in range(max_retries):
-        try:
-            connection, cursor = check_and_reconnect()
-            if params:
-                cursor.execute(query, params)
-            else:
-                cursor.execute(query)
-            return cursor
-        except pyodbc.Error as e:
-            error_str = str(e).lower()
-            if ('communication link failure' in error_str or '08S01' in str(e) or 
-                'connection' in error_str or 'timeout' in error_str):
-                if attempt < max_retries - 1:
-                    wait_time = 2 ** attempt
-                    print(f"Connection error during query. Retrying in {wait_time} seconds... (attempt {attempt + 1}/{max_retries})")
-                    time.sleep(wait_time)
-                    # Force reconnection
-                    connection, cursor = check_and_reconnect()
-                else:
-                    print(f"Failed to execute query after {max_retries} attempts: {e}")
-                    raise
-            else:
-                # Not a connection error, re-raise immediately
-                raise
+    raw = pd.Series(values, dtype=object)
+    numeric = pd.to_numeric(raw, errors="coerce").to_numpy(dtype=float, copy=True)
+    # Only the few values that didn't parse as they were get the slower comma/whitespace clean-up
+    retry = np.isnan(numeric) & raw.notna().to_numpy()
+    if retry.any():
+        cleaned = raw[retry].astype(str).str.replace(",", "", regex=False).str.strip()
+        numeric[retry] = pd.to_numeric(cleaned, errors="coerce").to_numpy(dtype=float)
+    numeric[~np.isfinite(numeric)] = np.nan
+    if converter == 'int':
+        numeric = np.trunc(numeric)
+        # astype(np.int64) would silently wrap anything outside this range
+        numeric[(numeric < -2 ** 63) | (numeric >= 2 ** 63)] = np.nan
+    present = ~np.isnan(numeric)
+    converted = np.full(len(numeric), None, dtype=object)
+    if converter == 'int':
+        converted[present] = numeric[present].astype(np.int64).tolist()
+    elif converter == 'decimal':
+        # np.round scales and rints, so it rounds some halves differently (5325.585 -> 5325.58 where round() gives 5325.59)
+        converted[present] = [round(value, 2) for value in numeric[present].tolist()]
+    else:
+        converted[present] = numeric[present].tolist()
+    return converted.tolist()
+
 def chunks(items, size):
     for i in range(0, len(items), size):
         yield items[i:i + size]
-def generatereport(espmidlist):
+def generatereport(espmidlist, report_id):
     ##This property is bugged - isn't shared with us and I can't unshare it so it's in the list and causing problems 
     ids_xml = "\n".join(f"          <id>{espmid}</id>" for espmid in espmidlist)
-    currentyear=datetime.date.today().year
-    currentyear=currentyear-1
     report_xml = (
         '<?xml version="1.0" encoding="UTF-8"?>\n'
         "<report>\n"
@@ -193,11 +246,11 @@ def generatereport(espmidlist):
         "          <dateRange>\n"
         "               <fromPeriodEndingDate>\n"
         "                    <month>1</month>\n"
-        "                    <year>2021</year>\n"
+        f"                    <year>{REPORT_FROM_YEAR}</year>\n"
         "               </fromPeriodEndingDate>\n"
         "               <toPeriodEndingDate>\n"
         "                     <month>12</month>\n"
-        f"                    <year>{currentyear}</year>\n"
+        f"                    <year>{REPORT_TO_YEAR}</year>\n"
         "               </toPeriodEndingDate>\n"
         "                <interval>YEARLY</interval>\n"
         "          </dateRange>\n"
@@ -207,552 +260,319 @@ def generatereport(espmidlist):
         "     </properties>\n"
         "</report>"
     )
-    response = session.put(
-        "https://portfoliomanager.energystar.gov/ws/reports/21829340",
-        auth=HTTPBasicAuth(user, pw),
-        data=report_xml,
-        headers={"Content-Type": "application/xml"},
-        timeout=60,
-    ).content
-    response =session.post("https://portfoliomanager.energystar.gov/ws/reports/21829340/generate",auth=HTTPBasicAuth(user, pw),timeout=60)
-    results=response.content
-    print(results)
+    timings = {}
+    report_content = None
     try:
-        time.sleep(100)
-        max_download_attempts = 6
+        # A rejected PUT would leave the definition on its previous shard, and /generate
+        # would then produce that shard's rows again, so both must succeed
+        started = time.perf_counter()
+        response = session.put(
+            f"https://portfoliomanager.energystar.gov/ws/reports/{report_id}",
+            auth=HTTPBasicAuth(user, pw),
+            data=report_xml,
+            headers={"Content-Type": "application/xml"},
+            timeout=60,
+        )
+        response.raise_for_status()
+        timings['put'] = time.perf_counter() - started
+        started = time.perf_counter()
+        response =session.post(f"https://portfoliomanager.energystar.gov/ws/reports/{report_id}/generate",auth=HTTPBasicAuth(user, pw),timeout=60)
+        response.raise_for_status()
+        results=response.content
+        print(results)
+        timings['generate'] = time.perf_counter() - started
+        started = time.perf_counter()
+        polls = wait_for_report(report_id, time.monotonic() + REPORT_DEADLINE_SECONDS)
+        timings['wait'] = time.perf_counter() - started
+        started = time.perf_counter()
+        max_download_attempts = 3
         response = None
-        dict_data = None    
         for attempt in range(1, max_download_attempts + 1):
             response = session.get(
-                "https://portfoliomanager.energystar.gov/ws/reports/21829340/download?type=XML",
+                f"https://portfoliomanager.energystar.gov/ws/reports/{report_id}/download?type=XML",
                 auth=HTTPBasicAuth(user, pw),
                 timeout=60,
             )
             if response.status_code == 200 and response.content:
-                results = response.content
-                dict_data = xmltodict.parse(response.content)
+                # Keep the raw XML; iter_property_metrics() streams it without building a dict
+                report_content = response.content
                 break
             print(
                 f"Report download attempt {attempt}/{max_download_attempts} "
                 f"returned HTTP {response.status_code}. Retrying..."
             )
             if attempt < max_download_attempts:
-                time.sleep(100)
-        if dict_data is None:
+                time.sleep(REPORT_POLL_SECONDS * 2 ** (attempt - 1))
+        timings['download'] = time.perf_counter() - started
+        if report_content is None:
             raise RuntimeError(
                 f"Failed to download report after {max_download_attempts} attempts. "
-                f"Last HTTP status: {response.status_code if response else 'N/A'}"
+                f"Last HTTP status: {response.status_code if response is not None else 'N/A'}"
             )
+        print(
+            f"Report {report_id}: PUT {timings['put']:.1f}s, generate {timings['generate']:.1f}s, "
+            f"wait {timings['wait']:.1f}s ({polls} status checks), download {timings['download']:.1f}s, "
+            f"{len(report_content) / (1024 * 1024):.1f} MB."
+        )
     except Exception as e:
         print(f"The following exception occurred: {e}")
-    return dict_data
+        print(f"Report {report_id} phase timings so far: " + ", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in timings.items()))
+    return report_content
+
+def generate_sharded_reports(espmidlist):
+    """
+    Generate the custom report for espmidlist in shards of REPORT_SHARD_SIZE
+    properties, one shard at a time per id in REPORT_IDS and every id in
+    parallel. A shard that fails is retried on its own up to
+    REPORT_SHARD_ATTEMPTS times.
+
+    Returns:
+        the downloaded report XML of every shard that succeeded, in shard order
+    """
+    shards = list(chunks(espmidlist, REPORT_SHARD_SIZE))
+    shard_queue = queue.Queue()
+    for index, shard in enumerate(shards):
+        shard_queue.put((index, shard))
+    results = [None] * len(shards)
+
+    def run_shards(report_id):
+        while True:
+            try:
+                index, shard = shard_queue.get_nowait()
+            except queue.Empty:
+                return
+            for attempt in range(1, REPORT_SHARD_ATTEMPTS + 1):
+                print(f"Generating shard {index + 1}/{len(shards)} ({len(shard)} properties) on report {report_id}, attempt {attempt}/{REPORT_SHARD_ATTEMPTS}.")
+                results[index] = generatereport(shard, report_id)
+                if results[index] is not None:
+                    archive.put('report', f"shard-{index + 1:04d}", results[index], report_id=report_id, properties=len(shard))
+                    break
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(REPORT_IDS)) as executor:
+        list(executor.map(run_shards, REPORT_IDS))
+    failed = [index + 1 for index, content in enumerate(results) if content is None]
+    print(f"Generated {len(shards) - len(failed)}/{len(shards)} report shards in {time.perf_counter() - started:.1f}s on {len(REPORT_IDS)} report definitions.")
+    if failed:
+        print(f"Warning: report shards {failed} failed after {REPORT_SHARD_ATTEMPTS} attempts; their properties are not updated this run.")
+    return [content for content in results if content is not None]
+
+def wait_for_report(report_id, deadline):
+    """
+    Poll /reports/{id}/status until ESPM says the report is ready.
+
+    The first check comes after REPORT_POLL_SECONDS and the interval doubles up
+    to REPORT_MAX_POLL_SECONDS, with +/-20% jitter. A status request that fails
+    or can't be parsed just counts as not ready yet. Once the deadline passes, or
+    ESPM answers with a status outside the known ready/pending/failed sets, this
+    returns anyway and the caller goes on to its bounded download attempts.
+
+    Args:
+        report_id: custom report to watch
+        deadline: time.monotonic() value to give up at
+
+    Returns:
+        number of status checks it took
+    """
+    interval = REPORT_POLL_SECONDS
+    polls = 0
+    status = None
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print(f"Report {report_id} was not ready after {REPORT_DEADLINE_SECONDS:.0f}s (last status: {status}); trying the download anyway.")
+            return polls
+        time.sleep(min(interval * random.uniform(0.8, 1.2), remaining))
+        interval = min(interval * 2, REPORT_MAX_POLL_SECONDS)
+        polls += 1
+        try:
+            response = session.get(
+                f"https://portfoliomanager.energystar.gov/ws/reports/{report_id}/status",
+                auth=HTTPBasicAuth(user, pw),
+                timeout=60,
+            )
+        except requests.RequestException as e:
+            print(f"Report status check {polls} failed: {e}")
+            continue
+        if response.status_code != 200:
+            print(f"Report status check {polls} returned HTTP {response.status_code}.")
+            continue
+        status = parse_report_status(response.content)
+        if status in REPORT_READY_STATUSES:
+            return polls
+        if status in REPORT_FAILED_STATUSES:
+            raise RuntimeError(f"ESPM reports that report {report_id} failed to generate (status {status})")
+        if status is not None and status not in REPORT_PENDING_STATUSES:
+            print(f"Report {report_id} has unrecognised status {status}; trying the download.")
+            return polls
+
+def fetch_year_created(espmid):
+    """
+    Year a property was created in ESPM, from audit.createdDate on /property/{id}.
+    Returns None if the lookup fails.
+    """
+    try:
+        response=espm_cache.get(session, f'https://portfoliomanager.energystar.gov/ws/property/{espmid}',auth=(user,pw),timeout=60)
+        dict_data = xmltodict.parse(response.content)
+        created_date = dict_data.get('property', {}).get('audit', {}).get('createdDate')
+        return safe_to_int(created_date[:4] if isinstance(created_date, str) else created_date)
+    except Exception as e:
+        print(f"Could not read createdDate for espmid {espmid}: {e}")
+        return None
 
 def errordbhandling():
     espmyearsort="""
     CREATE INDEX ix_espmid_datayear
     ON PrimaryDataBase (espmid, datayear DESC);
     """
-    try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD has_issue bit")
-                print("Added 'has_issue' column to PrimaryDataBase table.")
-                connection.commit()
-    except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'has_issue' column: {e}")
+    # The has_issue column and its filtered ix_espm_issue index come from schema migration 4
     try:
         cursor.execute("UPDATE PrimaryDataBase SET has_issue = 0")
         cursor.execute("UPDATE PrimaryDataBase SET has_issue = 1 where hasenergygaps='possible issue' or haswatergaps = 'possible issue' or energylessthan12months = 'possible issue' or waterlessthan12months = 'Possible Issue'")
         connection.commit()
-        cursor.execute("CREATE INDEX ix_espm_issue ON PrimaryDataBase (espmid, datayear DESC) WHERE has_issue = 1 WITH (DROP_EXISTING = ON);")
-        connection.commit()
     except pyodbc.Error as e:
         print(e)
     
 
 try:
-    connection = connect_with_retry(max_retries=3, backoff_factor=2, timeout=30)
-    
-    # Create cursor with fast_executemany for better performance
-    cursor = connection.cursor()
-    # Enable fast_executemany for bulk operations (much faster for large datasets)
-    cursor.fast_executemany = True  
-
-    # Define the CREATE TABLE SQL query
-    create_table_query = """
-    CREATE TABLE PrimaryDataBase (
-        espmid INT NOT NULL,
-        buildingname NVARCHAR(100),
-        sqfootage INT,
-        address NVARCHAR(100),
-        occupancy NVARCHAR(100),
-        numbuildings NVARCHAR(100),
-        usetype NVARCHAR(100),
-        datayear NVARCHAR(100) NOT NULL,
-        yearbuilt NVARCHAR(100),
-        yearcreatedinespm INT,
-        siteeui FLOAT,
-        weathernormalizedsiteeui FLOAT,
-        energystarscore INT,
-        wui NVARCHAR(100),
-        energycost FLOAT,
-        energycostintensity FLOAT,
-        energycostelectricitygridpurchase FLOAT,
-        energycostnaturalgas FLOAT,
-        siteEnergyUseElectricityGridPurchaseKwh FLOAT,
-        siteEnergyUseNaturalGas FLOAT,
-        totalMarketBasedGHGEmissions FLOAT,
-        greenPowerOffSite FLOAT,
-        onSiteRenewableSystemElectricityExported FLOAT,
-        onSiteRenewableSystemGeneration FLOAT,
-        hasenergygaps NVARCHAR(100),
-        haswatergaps NVARCHAR(100),
-        energylessthan12months NVARCHAR(100),
-        waterlessthan12months NVARCHAR(100),
-        pmparentid INT,
-        CONSTRAINT PK_PrimaryDataBase PRIMARY KEY (espmid, datayear)
-    )
-    """ 
-    # Execute the query
-    try:
-        cursor.execute(create_table_query)
-        print("Table 'espm basics' created successfully!")
-        connection.commit()
-    except pyodbc.Error as create_error:
-        # Table might already exist, that's okay
-        if "already exists" in str(create_error).lower() or "There is already an object" in str(create_error):
-            print("Table 'ESPM basics' already exists (or creation failed), continuing...")
-            connection.rollback()
-            
-            # Add new columns if they don't exist (for existing tables)
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD occupancy NVARCHAR(100)")
-                print("Added 'occupancy' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'occupancy' column: {e}")
-            
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD numbuildings NVARCHAR(100)")
-                print("Added 'numbuildings' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'numbuildings' column: {e}")
-            
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD usetype NVARCHAR(100)")
-                print("Added 'usetype' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'usetype' column: {e}")
-
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD datayear NVARCHAR(100)")
-                print("Added 'datayear' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'datayear' column: {e}")
-
-            try:
-                cursor.execute("""
-                UPDATE PrimaryDataBase
-                SET datayear = 'UNKNOWN'
-                WHERE datayear IS NULL;
-                """)
-                connection.commit()
-            except pyodbc.Error as e:
-                print(f"Warning: Could not backfill NULL datayear values: {e}")
-
-            try:
-                cursor.execute("""
-                DECLARE @pk_name NVARCHAR(128);
-                SELECT @pk_name = kc.name
-                FROM sys.key_constraints kc
-                JOIN sys.tables t ON kc.parent_object_id = t.object_id
-                WHERE kc.[type] = 'PK' AND t.name = 'PrimaryDataBase';
-
-                IF @pk_name IS NOT NULL
-                    EXEC('ALTER TABLE PrimaryDataBase DROP CONSTRAINT [' + @pk_name + ']');
-
-                ALTER TABLE PrimaryDataBase ALTER COLUMN datayear NVARCHAR(100) NOT NULL;
-                ALTER TABLE PrimaryDataBase ADD CONSTRAINT PK_PrimaryDataBase PRIMARY KEY (espmid, datayear);
-                """)
-                connection.commit()
-                print("Updated primary key to (espmid, datayear) on PrimaryDataBase.")
-            except pyodbc.Error as e:
-                print(f"Warning: Could not update primary key on PrimaryDataBase: {e}")
-            
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD yearbuilt NVARCHAR(100)")
-                print("Added 'yearbuilt' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'yearbuilt' column: {e}")
-
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD yearcreatedinespm INT")
-                print("Added 'yearcreatedinespm' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'yearcreatedinespm' column: {e}")
-            
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD siteeui FLOAT")
-                print("Added 'siteeui' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'siteeui' column: {e}")
-
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD weathernormalizedsiteeui FLOAT")
-                print("Added 'weathernormalizedsiteeui' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'weathernormalizedsiteeui' column: {e}")
-
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD energystarscore INT")
-                print("Added 'energystarscore' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'energystarscore' column: {e}")
-
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD wui NVARCHAR(100)")
-                print("Added 'wui' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'wui' column: {e}")
-
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD energycost FLOAT")
-                print("Added 'energycost' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'energycost' column: {e}")
-
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD energycostintensity FLOAT")
-                print("Added 'energycostintensity' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'energycostintensity' column: {e}")
-
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD energycostelectricitygridpurchase FLOAT")
-                print("Added 'energycostelectricitygridpurchase' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'energycostelectricitygridpurchase' column: {e}")
-
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD energycostnaturalgas FLOAT")
-                print("Added 'energycostnaturalgas' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'energycostnaturalgas' column: {e}")
-
-            for column_name in [
-                "siteEnergyUseElectricityGridPurchaseKwh",
-                "siteEnergyUseNaturalGas",
-                "totalMarketBasedGHGEmissions",
-                "greenPowerOffSite",
-                "onSiteRenewableSystemElectricityExported",
-                "onSiteRenewableSystemGeneration",
-            ]:
-                try:
-                    cursor.execute(f"""
-                    IF COL_LENGTH('PrimaryDataBase', '{column_name}') IS NULL
-                        ALTER TABLE PrimaryDataBase ADD {column_name} FLOAT NULL;
-                    """)
-                    print(f"Ensured '{column_name}' column exists as FLOAT on PrimaryDataBase table.")
-                    connection.commit()
-                except pyodbc.Error as e:
-                    print(f"Warning: Could not ensure '{column_name}' FLOAT column: {e}")
-            
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD hasenergygaps NVARCHAR(100)")
-                print("Added 'hasenergygaps' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'hasenergygaps' column: {e}")
-            
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD haswatergaps NVARCHAR(100)")
-                print("Added 'haswatergaps' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'haswatergaps' column: {e}")
-
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD energylessthan12months NVARCHAR(100)")
-                print("Added 'energylessthan12months' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'energylessthan12months' column: {e}")
-
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD waterlessthan12months NVARCHAR(100)")
-                print("Added 'waterlessthan12months' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'waterlessthan12months' column: {e}")
-            
-            try:
-                cursor.execute("""
-                IF COL_LENGTH('PrimaryDataBase', 'sqfootage') IS NULL
-                BEGIN
-                    ALTER TABLE PrimaryDataBase ADD sqfootage INT NULL;
-                END
-                ELSE IF EXISTS (
-                    SELECT 1
-                    FROM sys.columns c
-                    JOIN sys.types t ON c.user_type_id = t.user_type_id
-                    WHERE c.object_id = OBJECT_ID('PrimaryDataBase')
-                      AND c.name = 'sqfootage'
-                      AND t.name <> 'int'
-                )
-                BEGIN
-                    UPDATE PrimaryDataBase
-                    SET sqfootage = NULL
-                    WHERE sqfootage IS NOT NULL
-                      AND TRY_CONVERT(INT, TRY_CONVERT(FLOAT, REPLACE(sqfootage, ',', ''))) IS NULL;
-
-                    UPDATE PrimaryDataBase
-                    SET sqfootage = TRY_CONVERT(INT, TRY_CONVERT(FLOAT, REPLACE(sqfootage, ',', '')))
-                    WHERE sqfootage IS NOT NULL;
-
-                    ALTER TABLE PrimaryDataBase ALTER COLUMN sqfootage INT NULL;
-                END
-                """)
-                print("Ensured 'sqfootage' column exists as INT on PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                print(f"Warning: Could not ensure 'sqfootage' INT column: {e}")
-
-            try:
-                cursor.execute("""
-                IF COL_LENGTH('PrimaryDataBase', 'siteeui') IS NULL
-                BEGIN
-                    ALTER TABLE PrimaryDataBase ADD siteeui FLOAT NULL;
-                END
-                ELSE IF EXISTS (
-                    SELECT 1
-                    FROM sys.columns c
-                    JOIN sys.types t ON c.user_type_id = t.user_type_id
-                    WHERE c.object_id = OBJECT_ID('PrimaryDataBase')
-                      AND c.name = 'siteeui'
-                      AND t.name <> 'float'
-                )
-                BEGIN
-                    UPDATE PrimaryDataBase
-                    SET siteeui = NULL
-                    WHERE siteeui IS NOT NULL
-                      AND TRY_CONVERT(FLOAT, TRY_CONVERT(FLOAT, REPLACE(siteeui, ',', ''))) IS NULL;
-
-                    UPDATE PrimaryDataBase
-                    SET siteeui = TRY_CONVERT(FLOAT, TRY_CONVERT(FLOAT, REPLACE(siteeui, ',', '')))
-                    WHERE siteeui IS NOT NULL;
-
-                    ALTER TABLE PrimaryDataBase ALTER COLUMN siteeui FLOAT NULL;
-                END
-                """)
-                print("Ensured 'siteeui' column exists as FLOAT on PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                print(f"Warning: Could not ensure 'siteeui' FLOAT column: {e}")
-
-            try:
-                cursor.execute("""
-                IF COL_LENGTH('PrimaryDataBase', 'weathernormalizedsiteeui') IS NULL
-                    ALTER TABLE PrimaryDataBase ADD weathernormalizedsiteeui FLOAT NULL;
-                ELSE IF EXISTS (
-                    SELECT 1
-                    FROM sys.columns c
-                    JOIN sys.types t ON c.user_type_id = t.user_type_id
-                    WHERE c.object_id = OBJECT_ID('PrimaryDataBase')
-                      AND c.name = 'weathernormalizedsiteeui'
-                      AND t.name <> 'float'
-                )
-                BEGIN
-                    UPDATE PrimaryDataBase
-                    SET weathernormalizedsiteeui = NULL
-                    WHERE weathernormalizedsiteeui IS NOT NULL
-                      AND TRY_CONVERT(FLOAT, TRY_CONVERT(FLOAT, REPLACE(weathernormalizedsiteeui, ',', ''))) IS NULL;
-
-                    UPDATE PrimaryDataBase
-                    SET weathernormalizedsiteeui = TRY_CONVERT(FLOAT, TRY_CONVERT(FLOAT, REPLACE(weathernormalizedsiteeui, ',', '')))
-                    WHERE weathernormalizedsiteeui IS NOT NULL;
-
-                    ALTER TABLE PrimaryDataBase ALTER COLUMN weathernormalizedsiteeui FLOAT NULL;
-                END
-                """)
-                print("Ensured 'weathernormalizedsiteeui' column exists as FLOAT on PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                print(f"Warning: Could not ensure 'weathernormalizedsiteeui' FLOAT column: {e}")
-
-            try:
-                cursor.execute("""
-                IF COL_LENGTH('PrimaryDataBase', 'energystarscore') IS NULL
-                    ALTER TABLE PrimaryDataBase ADD energystarscore INT NULL;
-                ELSE IF EXISTS (
-                    SELECT 1
-                    FROM sys.columns c
-                    JOIN sys.types t ON c.user_type_id = t.user_type_id
-                    WHERE c.object_id = OBJECT_ID('PrimaryDataBase')
-                      AND c.name = 'energystarscore'
-                      AND t.name <> 'int'
-                )
-                BEGIN
-                    UPDATE PrimaryDataBase
-                    SET energystarscore = NULL
-                    WHERE energystarscore IS NOT NULL
-                      AND TRY_CONVERT(INT, TRY_CONVERT(FLOAT, REPLACE(energystarscore, ',', ''))) IS NULL;
-
-                    UPDATE PrimaryDataBase
-                    SET energystarscore = TRY_CONVERT(INT, TRY_CONVERT(FLOAT, REPLACE(energystarscore, ',', '')))
-                    WHERE energystarscore IS NOT NULL;
-
-                    ALTER TABLE PrimaryDataBase ALTER COLUMN energystarscore INT NULL;
-                END
-                """)
-                print("Ensured 'energystarscore' column exists as INT on PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                print(f"Warning: Could not ensure 'energystarscore' INT column: {e}")
-
-            try:
-                cursor.execute("""
-                IF COL_LENGTH('PrimaryDataBase', 'yearcreatedinespm') IS NULL
-                    ALTER TABLE PrimaryDataBase ADD yearcreatedinespm INT NULL;
-                ELSE IF EXISTS (
-                    SELECT 1
-                    FROM sys.columns c
-                    JOIN sys.types t ON c.user_type_id = t.user_type_id
-                    WHERE c.object_id = OBJECT_ID('PrimaryDataBase')
-                      AND c.name = 'yearcreatedinespm'
-                      AND t.name <> 'int'
-                )
-                BEGIN
-                    UPDATE PrimaryDataBase
-                    SET yearcreatedinespm = NULL
-                    WHERE yearcreatedinespm IS NOT NULL
-                      AND TRY_CONVERT(INT, TRY_CONVERT(FLOAT, REPLACE(yearcreatedinespm, ',', ''))) IS NULL;
-
-                    UPDATE PrimaryDataBase
-                    SET yearcreatedinespm = TRY_CONVERT(INT, TRY_CONVERT(FLOAT, REPLACE(yearcreatedinespm, ',', '')))
-                    WHERE yearcreatedinespm IS NOT NULL;
-
-                    ALTER TABLE PrimaryDataBase ALTER COLUMN yearcreatedinespm INT NULL;
-                END
-                """)
-                print("Ensured 'yearcreatedinespm' column exists as INT on PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                print(f"Warning: Could not ensure 'yearcreatedinespm' INT column: {e}")
-
-            try:
-                cursor.execute("""
-                IF COL_LENGTH('PrimaryDataBase', 'pmparentid') IS NULL
-                BEGIN
-                    ALTER TABLE PrimaryDataBase ADD pmparentid INT NULL;
-                END
-                ELSE IF EXISTS (
-                    SELECT 1
-                    FROM sys.columns c
-                    JOIN sys.types t ON c.user_type_id = t.user_type_id
-                    WHERE c.object_id = OBJECT_ID('PrimaryDataBase')
-                      AND c.name = 'pmparentid'
-                      AND t.name <> 'int'
-                )
-                BEGIN
-                    UPDATE PrimaryDataBase
-                    SET pmparentid = NULL
-                    WHERE pmparentid IS NOT NULL
-                      AND TRY_CONVERT(INT, pmparentid) IS NULL;
-
-                    ALTER TABLE PrimaryDataBase ALTER COLUMN pmparentid INT NULL;
-                END
-                """)
-                print("Ensured 'pmparentid' column exists as INT on PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                print(f"Warning: Could not ensure 'pmparentid' INT column: {e}")
-        else:
-            raise  # Re-raise if it's a different error
-
+    # The main thread keeps one pooled connection for the whole run. Pooled cursors
+    # already have fast_executemany enabled for the bulk inserts.
+    db = db_pool.acquire()
+    connection, cursor = db.ensure_alive()
+
+    # Tables, columns and indexes come from the versioned steps in schema_helper.MIGRATIONS;
+    # when the schema is current this is one query instead of a round of ALTERs
+    applied_migrations = apply_migrations(db, MIGRATIONS)
+    if applied_migrations:
+        print(f"Applied schema migrations {applied_migrations}.")
+    else:
+        print("Database schema is up to date.")
 
     #Creates a list of ALL pmid's in the account
     idlist=[]
-    response = requests.get(f'https://portfoliomanager.energystar.gov/ws/account/216165/property/list', auth=HTTPBasicAuth(user, pw), timeout=60)
-    dict_data = xmltodict.parse(response.content)
+    if REPLAY_RUN:
+        property_list = archive.read(archive.entries('property-list')[-1])
+    else:
+        response = espm_cache.get(session, f'https://portfoliomanager.energystar.gov/ws/account/216165/property/list', ttl=0, auth=HTTPBasicAuth(user, pw), timeout=60)
+        property_list = response.content
+        archive.put('property-list', 'list', property_list)
+    dict_data = xmltodict.parse(property_list)
     for entry in dict_data['response']['links']['link']:
         idlist.append(entry['@id'])
-    placeholders = ",".join("?" for _ in idlist)
-    query = f"DELETE FROM PrimaryDataBase WHERE espmid NOT IN ({placeholders})"
-    cursor.execute(query, *idlist)
-    connection.commit()
+    # Drop properties that left the account. The live ids go into a keyed temp table and the
+    # delete is an anti-join against it, so there is no limit on how many ids can be bound.
+    if REPLAY_RUN:
+        # An archived list can be older than properties added since, so it never prunes
+        print("Replaying: skipping the prune.")
+    elif idlist:
+        cursor.execute("""
+        IF OBJECT_ID('tempdb..#LiveESPMIDs') IS NOT NULL
+            DROP TABLE #LiveESPMIDs;
+
+        CREATE TABLE #LiveESPMIDs (espmid INT PRIMARY KEY)
+        """)
+        cursor.executemany("INSERT INTO #LiveESPMIDs (espmid) VALUES (?)", [(int(espmid),) for espmid in set(idlist)])
+        cursor.execute("""
+            DELETE target
+            OUTPUT deleted.espmid
+            FROM PrimaryDataBase AS target
+            WHERE NOT EXISTS (SELECT 1 FROM #LiveESPMIDs AS live WHERE live.espmid = target.espmid)
+        """)
+        pruned = [row[0] for row in cursor.fetchall()]
+        if pruned:
+            bump_data_version(cursor, TENANT)
+        connection.commit()
+        cursor.execute("DROP TABLE #LiveESPMIDs")
+        pruned_ids = sorted(set(pruned))
+        if pruned_ids:
+            print(f"Pruned {len(pruned)} rows for {len(pruned_ids)} properties no longer in the account, e.g. {pruned_ids[:10]}")
+        else:
+            print("No properties to prune.")
+    else:
+        # An empty list is far more likely a bad response than an empty account
+        print("Property list came back empty; skipping the prune so PrimaryDataBase is not wiped.")
     #these are causing problems and we don't have access to them for some reason they still show up
     
-    batch_size = 350  # safe under the 2,000,000 limit
 
-    # Create temp table with same schema as PrimaryDataBase for session-scoped processing
+    # yearcreatedinespm never changes, so it is read from PrimaryDataBase where we already have it.
+    # New properties are looked up once each, concurrently, while the report shards generate.
+    year_created = {}
+    try:
+        # Plain reads go through db.execute, which reconnects and runs them again after a dropped link
+        stored_years = db.execute("SELECT espmid, MAX(yearcreatedinespm) FROM PrimaryDataBase WHERE yearcreatedinespm IS NOT NULL GROUP BY espmid").fetchall()
+        for stored_espmid, stored_year_created in stored_years:
+            year_created[str(stored_espmid)] = stored_year_created
+    except pyodbc.Error as e:
+        print(f"Could not read stored yearcreatedinespm, looking every property up: {e}")
+    if REPLAY_RUN:
+        for entry in archive.entries('year-created'):
+            for archived_espmid, archived_year in json.loads(archive.read(entry)).items():
+                year_created.setdefault(archived_espmid, archived_year)
+        report_outputs = [archive.read(entry) for entry in sorted(archive.entries('report'), key=lambda entry: entry['key'])]
+        print(f"Loaded {len(report_outputs)} archived report shards.")
+    else:
+        missing_year_created = [espmid for espmid in dict.fromkeys(str(espmid) for espmid in idlist) if espmid not in year_created]
+        print(f"yearcreatedinespm: {len(year_created)} stored, {len(missing_year_created)} to look up.")
+        with ThreadPoolExecutor(max_workers=PROPERTY_FETCH_WORKERS) as lookup_executor:
+            year_created_lookups = lookup_executor.map(fetch_year_created, missing_year_created)
+            report_outputs = generate_sharded_reports(idlist)
+            year_created.update(zip(missing_year_created, year_created_lookups))
+        archive.put('year-created', 'lookups', json.dumps({espmid: year_created[espmid] for espmid in missing_year_created}).encode("utf-8"))
+
+    # Rows whose hash matches what is stored are unchanged and never staged
+    stored_hashes = {}
+    for stored_espmid, stored_year, stored_hash in db.execute("SELECT espmid, datayear, rowhash FROM PrimaryDataBase WHERE rowhash IS NOT NULL").fetchall():
+        stored_hashes[(str(stored_espmid), str(stored_year))] = bytes(stored_hash)
+    unchanged_rows = 0
+
+    # Report rows are collected raw, then each numeric column is converted in one pass
+    report_rows = []
+    metric_column_names = list(dict.fromkeys(METRIC_COLUMNS.values()))
+    report_row_values = operator.itemgetter(*REPORT_COLUMNS)
+
+    # Shards cover disjoint properties, so their rows are simply read back to back
+    for espmid, datayear, metrics in itertools.chain.from_iterable(iter_property_metrics(content) for content in report_outputs):
+        if str(espmid) not in year_created:
+            year_created[str(espmid)] = None if REPLAY_RUN else fetch_year_created(espmid)
+        row = dict.fromkeys(metric_column_names)
+        for metric_name, metric_value in metrics.items():
+            column = METRIC_COLUMNS.get(metric_name)
+            if column is not None:
+                row[column] = metric_value
+        row['espmid'] = espmid
+        row['datayear'] = datayear
+        row['yearcreatedinespm'] = year_created[str(espmid)]
+        report_rows.append(report_row_values(row))
+    report_columns = dict(zip(REPORT_COLUMNS, (list(values) for values in zip(*report_rows))))
+    if not report_columns:
+        report_columns = {column: [] for column in REPORT_COLUMNS}
+    for column, converter in COLUMN_CONVERTERS.items():
+        report_columns[column] = convert_report_column(report_columns[column], converter)
+
+    ##create a list of tuples of all building data
+    buildingdatalist=[]
+    # Shards are disjoint, but a property reported twice must not break the temp table's key
+    seen_keys = set()
+    duplicate_rows = 0
+    for buildingdata in zip(*(report_columns[column] for column in REPORT_COLUMNS)):
+        espmid = buildingdata[0]
+        datayear = buildingdata[REPORT_COLUMNS.index('datayear')]
+        if (str(espmid), str(datayear)) in seen_keys:
+            duplicate_rows += 1
+            continue
+        seen_keys.add((str(espmid), str(datayear)))
+        rowhash = row_hash(buildingdata)
+        if stored_hashes.get((str(espmid), str(datayear))) == rowhash:
+            unchanged_rows += 1
+            continue
+        buildingdatalist.append(buildingdata + (rowhash,))
+    print(f"{len(buildingdatalist)} new or changed rows to stage, {unchanged_rows} unchanged.")
+    if duplicate_rows:
+        print(f"Warning: skipped {duplicate_rows} report rows repeating an (espmid, datayear) already read.")
+    # Create temp table with same schema as PrimaryDataBase for session-scoped processing. It is
+    # only created now, after the reports are in: the connection sat idle while they generated,
+    # and a temp table made before a reconnect would be gone.
+    connection, cursor = db.ensure_alive()
     create_temp_table_query = """
     IF OBJECT_ID('tempdb..#PrimaryDataBaseTEMP') IS NOT NULL
         DROP TABLE #PrimaryDataBaseTEMP;
@@ -787,156 +607,31 @@ try:
         energylessthan12months NVARCHAR(100),
         waterlessthan12months NVARCHAR(100),
         pmparentid INT,
+        rowhash BINARY(32),
         CONSTRAINT PK_PrimaryDataBaseTEMP PRIMARY KEY (espmid, datayear)
     )
     """
     cursor.execute(create_temp_table_query)
     print("Temp table '#PrimaryDataBaseTEMP' created successfully.")
-    report_output = generatereport(idlist)
-
-    ##create a list of tuples of all building data
-    buildingdatalist=[]
-
-    for building in report_output['reportData']['informationAndMetrics']['propertyMetrics']:
-        espmid=building['@propertyId']
-        response=session.get(f'https://portfoliomanager.energystar.gov/ws/property/{espmid}',auth=(user,pw))
-        dict_data = xmltodict.parse(response.content)
-        created_date = dict_data.get('property', {}).get('audit', {}).get('createdDate')
-        yearcreatedinespm = safe_to_int(created_date[:4] if isinstance(created_date, str) else created_date)
-        buildingname = None
-        sqfootage = None
-        address = None
-        occupancy = None
-        numbuildings = None
-        primarypropertytype = None
-        yearbuilt = None
-        datayear = None
-        siteeui = None
-        wui = None
-        hasenergygaps = None
-        haswatergaps = None
-        pmparentid = None
-        energylessthan12months=None
-        waterlessthan12months=None
-        energystarscore=None
-        weathernormalizedsiteeui=None
-        energycost=None
-        energycostintensity=None
-        energycostelectricitygridpurchase=None
-        energycostnaturalgas=None   
-        siteenergyuseelectricitygridpurchasekwh=None
-        siteenergyusenaturalgas=None
-        totalmarketbasedghgemissions=None
-        greenpoweroffsite=None
-        onsiterenewablesystemelectricityexported=None
-        onsiterenewablesystemgeneration=None
-
-        datayear = building.get('@year')
-        for buildingvalue in building['metric']:
-            metric_name = buildingvalue.get('@name')
-            raw_value = buildingvalue.get('value')
-            metric_value = None if isinstance(raw_value, dict) else raw_value
-
-            if metric_name == 'propertyName':
-                buildingname = metric_value
-            elif metric_name == 'propGrossFloorArea':
-                sqfootage = safe_to_int(metric_value)
-            elif metric_name == 'address1':
-                address = metric_value
-            elif metric_name == 'numberOfBuildings':
-                numbuildings = metric_value
-            elif metric_name == 'primaryPropertyTypeSelfSelected':
-                primarypropertytype = metric_value
-            elif metric_name == 'yearBuilt':
-                yearbuilt = metric_value
-            elif metric_name == 'siteIntensity':
-                siteeui = safe_to_decimal(metric_value)
-            elif metric_name == 'alertEnergyMeterGap':
-                hasenergygaps = metric_value
-            elif metric_name == 'waterIntensityTotal':
-                wui = metric_value
-            elif metric_name == 'alertWaterMeterGap':
-                haswatergaps = metric_value
-            elif metric_name == 'alertEnergyMeterLessThanTwelveMonthsMeterData':
-                energylessthan12months=metric_value
-            elif metric_name == 'alertWaterMeterLessThanTwelveMonthsMeterData':
-                waterlessthan12months=metric_value
-            elif metric_name == 'parentPropertyId':
-                try:
-                    pmparentid = int(metric_value) if metric_value is not None else None
-                except (TypeError, ValueError):
-                    pmparentid = None
-            elif metric_name == 'occupancy':
-                occupancy = metric_value
-            elif metric_name =='siteIntensityWN':
-                 try:
-                    weathernormalizedsiteeui = float(metric_value) if metric_value is not None else None
-                 except (TypeError, ValueError):
-                    weathernormalizedsiteeui = None
-            elif metric_name =='score':
-                energystarscore = metric_value
-            elif metric_name == 'energyCost':
-                energycost = safe_to_decimal(metric_value)
-            elif metric_name == 'energyCostIntensity':
-                energycostintensity = safe_to_decimal(metric_value)
-            elif metric_name == 'energyCostElectricityGridPurchase':
-                energycostelectricitygridpurchase = safe_to_decimal(metric_value)
-            elif metric_name == 'energyCostNaturalGas':
-                energycostnaturalgas = safe_to_decimal(metric_value)
-            elif metric_name == 'siteEnergyUseElectricityGridPurchaseKwh':
-                siteenergyuseelectricitygridpurchasekwh = safe_to_decimal(metric_value)
-            elif metric_name == 'siteEnergyUseNaturalGas':
-                siteenergyusenaturalgas = safe_to_decimal(metric_value)
-            elif metric_name == 'totalMarketBasedGHGEmissions':
-                totalmarketbasedghgemissions = safe_to_decimal(metric_value)
-            elif metric_name == 'greenPowerOffSite':
-                greenpoweroffsite = safe_to_decimal(metric_value)
-            elif metric_name == 'onSiteRenewableSystemElectricityExported':
-                onsiterenewablesystemelectricityexported = safe_to_decimal(metric_value)
-            elif metric_name == 'onSiteRenewableSystemGeneration':
-                onsiterenewablesystemgeneration = safe_to_decimal(metric_value)
-        buildingdatalist.append((espmid,buildingname,sqfootage,address,occupancy,numbuildings,primarypropertytype,yearbuilt,yearcreatedinespm,datayear,siteeui,weathernormalizedsiteeui,energystarscore,wui,energycost,energycostintensity,energycostelectricitygridpurchase,energycostnaturalgas,siteenergyuseelectricitygridpurchasekwh,siteenergyusenaturalgas,totalmarketbasedghgemissions,greenpoweroffsite,onsiterenewablesystemelectricityexported,onsiterenewablesystemgeneration,hasenergygaps,haswatergaps,energylessthan12months,waterlessthan12months,pmparentid))
-    temp_insert_query = """
-                INSERT INTO #PrimaryDataBaseTEMP (espmid, buildingname, sqfootage, address, occupancy, numbuildings, usetype, yearbuilt, yearcreatedinespm, datayear, siteeui, weathernormalizedsiteeui, energystarscore, wui, energycost, energycostintensity, energycostelectricitygridpurchase, energycostnaturalgas, siteEnergyUseElectricityGridPurchaseKwh, siteEnergyUseNaturalGas, totalMarketBasedGHGEmissions, greenPowerOffSite, onSiteRenewableSystemElectricityExported, onSiteRenewableSystemGeneration, hasenergygaps, haswatergaps, energylessthan12months, waterlessthan12months, pmparentid) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    temp_insert_query = f"""
+                INSERT INTO #PrimaryDataBaseTEMP ({', '.join(REPORT_COLUMNS)}, rowhash) 
+                VALUES ({', '.join('?' for _ in range(len(REPORT_COLUMNS) + 1))})
             """ 
    
     cursor.fast_executemany = True
-    cursor.executemany(temp_insert_query, buildingdatalist)
-    merge_query = """
+    if buildingdatalist:
+        cursor.executemany(temp_insert_query, buildingdatalist)
+    # numbuildings_num, occupancy_num, yearbuilt_num, wui_num and datayear_num are converted from the staged text
+    typed = typed_assignments('PrimaryDataBase', 'source') + [('datayear_num', typed_value('source.datayear', 'INT'))]
+    typed_set = ", ".join(f"{column} = {value}" for column, value in typed)
+    typed_insert_columns = ", ".join(column for column, _ in typed)
+    typed_insert_values = ", ".join(value for _, value in typed)
+    merge_query = f"""
                 MERGE PrimaryDataBase AS target
                 USING #PrimaryDataBaseTEMP AS source
                 ON target.espmid = source.espmid
                    AND target.datayear = source.datayear
-                WHEN MATCHED AND (
-                    ISNULL(target.buildingname, '') <> ISNULL(source.buildingname, '') OR
-                    ISNULL(target.sqfootage, -1) <> ISNULL(source.sqfootage, -1) OR
-                    ISNULL(target.address, '') <> ISNULL(source.address, '') OR
-                    ISNULL(target.occupancy, '') <> ISNULL(source.occupancy, '') OR
-                    ISNULL(target.numbuildings, '') <> ISNULL(source.numbuildings, '') OR
-                    ISNULL(target.usetype, '') <> ISNULL(source.usetype, '') OR
-                    ISNULL(target.yearbuilt, '') <> ISNULL(source.yearbuilt, '') OR
-                    ISNULL(target.yearcreatedinespm, -1) <> ISNULL(source.yearcreatedinespm, -1) OR
-                    ISNULL(target.siteeui, CAST(-1.0 AS FLOAT)) <> ISNULL(source.siteeui, CAST(-1.0 AS FLOAT)) OR
-                    ISNULL(target.weathernormalizedsiteeui, CAST(-1.0 AS FLOAT)) <> ISNULL(source.weathernormalizedsiteeui, CAST(-1.0 AS FLOAT)) OR
-                    ISNULL(target.energystarscore, -1) <> ISNULL(source.energystarscore, -1) OR
-                    ISNULL(target.wui, '') <> ISNULL(source.wui, '') OR
-                    ISNULL(target.energycost, CAST(-1.0 AS FLOAT)) <> ISNULL(source.energycost, CAST(-1.0 AS FLOAT)) OR
-                    ISNULL(target.energycostintensity, CAST(-1.0 AS FLOAT)) <> ISNULL(source.energycostintensity, CAST(-1.0 AS FLOAT)) OR
-                    ISNULL(target.energycostelectricitygridpurchase, CAST(-1.0 AS FLOAT)) <> ISNULL(source.energycostelectricitygridpurchase, CAST(-1.0 AS FLOAT)) OR
-                    ISNULL(target.energycostnaturalgas, CAST(-1.0 AS FLOAT)) <> ISNULL(source.energycostnaturalgas, CAST(-1.0 AS FLOAT)) OR
-                    ISNULL(target.siteEnergyUseElectricityGridPurchaseKwh, CAST(-1.0 AS FLOAT)) <> ISNULL(source.siteEnergyUseElectricityGridPurchaseKwh, CAST(-1.0 AS FLOAT)) OR
-                    ISNULL(target.siteEnergyUseNaturalGas, CAST(-1.0 AS FLOAT)) <> ISNULL(source.siteEnergyUseNaturalGas, CAST(-1.0 AS FLOAT)) OR
-                    ISNULL(target.totalMarketBasedGHGEmissions, CAST(-1.0 AS FLOAT)) <> ISNULL(source.totalMarketBasedGHGEmissions, CAST(-1.0 AS FLOAT)) OR
-                    ISNULL(target.greenPowerOffSite, CAST(-1.0 AS FLOAT)) <> ISNULL(source.greenPowerOffSite, CAST(-1.0 AS FLOAT)) OR
-                    ISNULL(target.onSiteRenewableSystemElectricityExported, CAST(-1.0 AS FLOAT)) <> ISNULL(source.onSiteRenewableSystemElectricityExported, CAST(-1.0 AS FLOAT)) OR
-                    ISNULL(target.onSiteRenewableSystemGeneration, CAST(-1.0 AS FLOAT)) <> ISNULL(source.onSiteRenewableSystemGeneration, CAST(-1.0 AS FLOAT)) OR
-                    ISNULL(target.hasenergygaps, '') <> ISNULL(source.hasenergygaps, '') OR
-                    ISNULL(target.haswatergaps, '') <> ISNULL(source.haswatergaps, '') OR
-                    ISNULL(target.energylessthan12months, '') <> ISNULL(source.energylessthan12months, '') OR
-                    ISNULL(target.waterlessthan12months, '') <> ISNULL(source.waterlessthan12months, '') OR
-                    ISNULL(target.pmparentid, -1) <> ISNULL(source.pmparentid, -1)
-                ) THEN
+                WHEN MATCHED AND (target.rowhash IS NULL OR target.rowhash <> source.rowhash) THEN
                     UPDATE SET
                         buildingname = source.buildingname,
                         sqfootage = source.sqfootage,
@@ -964,18 +659,35 @@ try:
                         haswatergaps = source.haswatergaps,
                         energylessthan12months = source.energylessthan12months,
                         waterlessthan12months = source.waterlessthan12months,
-                        pmparentid = source.pmparentid
+                        pmparentid = source.pmparentid,
+                        rowhash = source.rowhash,
+                        {typed_set}
                 WHEN NOT MATCHED THEN
-                    INSERT (espmid, buildingname, sqfootage, address, occupancy, numbuildings, usetype, datayear, yearbuilt, yearcreatedinespm, siteeui, weathernormalizedsiteeui, energystarscore, wui, energycost, energycostintensity, energycostelectricitygridpurchase, energycostnaturalgas, siteEnergyUseElectricityGridPurchaseKwh, siteEnergyUseNaturalGas, totalMarketBasedGHGEmissions, greenPowerOffSite, onSiteRenewableSystemElectricityExported, onSiteRenewableSystemGeneration, hasenergygaps, haswatergaps, energylessthan12months, waterlessthan12months, pmparentid)
-                    VALUES (source.espmid, source.buildingname, source.sqfootage, source.address, source.occupancy, source.numbuildings, source.usetype, source.datayear, source.yearbuilt, source.yearcreatedinespm, source.siteeui, source.weathernormalizedsiteeui, source.energystarscore, source.wui, source.energycost, source.energycostintensity, source.energycostelectricitygridpurchase, source.energycostnaturalgas, source.siteEnergyUseElectricityGridPurchaseKwh, source.siteEnergyUseNaturalGas, source.totalMarketBasedGHGEmissions, source.greenPowerOffSite, source.onSiteRenewableSystemElectricityExported, source.onSiteRenewableSystemGeneration, source.hasenergygaps, source.haswatergaps, source.energylessthan12months, source.waterlessthan12months, source.pmparentid);
+                    INSERT (espmid, buildingname, sqfootage, address, occupancy, numbuildings, usetype, datayear, yearbuilt, yearcreatedinespm, siteeui, weathernormalizedsiteeui, energystarscore, wui, energycost, energycostintensity, energycostelectricitygridpurchase, energycostnaturalgas, siteEnergyUseElectricityGridPurchaseKwh, siteEnergyUseNaturalGas, totalMarketBasedGHGEmissions, greenPowerOffSite, onSiteRenewableSystemElectricityExported, onSiteRenewableSystemGeneration, hasenergygaps, haswatergaps, energylessthan12months, waterlessthan12months, pmparentid, rowhash, {typed_insert_columns})
+                    VALUES (source.espmid, source.buildingname, source.sqfootage, source.address, source.occupancy, source.numbuildings, source.usetype, source.datayear, source.yearbuilt, source.yearcreatedinespm, source.siteeui, source.weathernormalizedsiteeui, source.energystarscore, source.wui, source.energycost, source.energycostintensity, source.energycostelectricitygridpurchase, source.energycostnaturalgas, source.siteEnergyUseElectricityGridPurchaseKwh, source.siteEnergyUseNaturalGas, source.totalMarketBasedGHGEmissions, source.greenPowerOffSite, source.onSiteRenewableSystemElectricityExported, source.onSiteRenewableSystemGeneration, source.hasenergygaps, source.haswatergaps, source.energylessthan12months, source.waterlessthan12months, source.pmparentid, source.rowhash, {typed_insert_values});
             """
     if buildingdatalist:
         cursor.execute(merge_query)
+        bump_data_version(cursor, TENANT)
         connection.commit()
         print("MERGE committed to PrimaryDataBase.")
         cursor.execute("DROP TABLE #PrimaryDataBaseTEMP")
         errordbhandling()
 
+    # The Portfolio Data page reads its aggregates from these rollup tables instead of
+    # recomputing them on every view, as long as their data version still matches.
+    # full update.py refreshes them too.
+    try:
+        rollup_started = time.perf_counter()
+        # year_joined is resolved first, by this tenant's rule, since every rollup filters on it
+        year_joined_rows = resolve_year_joined(db, TENANT)
+        print(f"Resolved year_joined for {TENANT}: {year_joined_rows} rows changed.")
+        rollup_rows = refresh_rollups(db, TENANT, REPORT_TO_YEAR)
+        print(f"Refreshed {len(rollup_rows)} portfolio rollup tables for {TENANT} ({sum(rollup_rows.values())} rows) in {time.perf_counter() - rollup_started:.1f}s.")
+    except pyodbc.Error as e:
+        # The page falls back to its live queries until a refresh succeeds
+        print(f"Could not refresh the portfolio rollups: {e}")
+
 
     ## Figure out how to get water and energy data for individual years.
     
@@ -985,9 +697,10 @@ except Exception as e:
         connection.rollback()
 finally:
     # Close the cursor and connection
-    if cursor:
-        cursor.close()
-    if connection:
-        connection.close()
+    db_pool.close()
     print("Connection closed.")
+    db_pool.report()
+    espm_cache.report()
+    if not REPLAY_RUN:
+        archive.report()
 
@@ -1,7 +1,9 @@
 ﻿import pyodbc
 import random
 import datetime
+import argparse
 import pandas as pd
+import numpy as np
 import requests
 import sqlite3
 from requests.auth import HTTPBasicAuth 
@@ -10,7 +12,87 @@ import xmltodict
 from requests.adapters import HTTPAdapter
 import os
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib3.util.retry import Retry
+from espm_helper import ESPMResponseCache, iter_consumption
+from journal_helper import RunJournal
+from archive_helper import PayloadArchive
+from db_helper import DB_POOL_SIZE, ConnectionPool, apply_migrations, is_connection_error, row_hash
+from schema_helper import CONSUMPTION_TABLES, METER_TYPE_TABLES, MIGRATIONS, WATER_TABLE, typed_assignments
+from portfolio_queries import bump_data_version, dashboard_tenant, refresh_rollups, resolve_year_joined
+
+parser = argparse.ArgumentParser(description="Pull ESPM property and meter data into the dashboard database.")
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=int(os.environ.get("ESPM_FETCH_WORKERS", 8)),
+    help="Number of properties fetched from ESPM at the same time (default 8, or ESPM_FETCH_WORKERS)",
+)
+parser.add_argument(
+    "--full-resync",
+    action="store_true",
+    help="Request every meter's full consumption history instead of only the window after its last stored bill",
+)
+parser.add_argument(
+    "--overlap-days",
+    type=int,
+    default=int(os.environ.get("ESPM_SYNC_OVERLAP_DAYS", 60)),
+    help="Days before a meter's latest stored enddate to request again, to pick up corrected bills (default 60)",
+)
+parser.add_argument(
+    "--batch-rows",
+    type=int,
+    default=int(os.environ.get("ESPM_WRITE_BATCH_ROWS", 5000)),
+    help="Consumption rows staged and MERGEd per database round (default 5000, or ESPM_WRITE_BATCH_ROWS)",
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Continue the last run that did not finish, skipping properties and meters it already wrote",
+)
+parser.add_argument(
+    "--meter-refresh-days",
+    type=int,
+    default=int(os.environ.get("ESPM_METER_REFRESH_DAYS", 7)),
+    help="Days a metercatalog entry is trusted before /meter/{id} is fetched again (default 7, 0 refetches every meter)",
+)
+parser.add_argument(
+    "--replay",
+    nargs="?",
+    const="latest",
+    metavar="RUN_ID",
+    help="Reload property details and consumption from an archived run's payloads (default latest) without calling ESPM; only a --full-resync run's archive holds whole histories",
+)
+args = parser.parse_args()
+FETCH_WORKERS = max(1, args.workers)
+FULL_RESYNC = args.full_resync
+# The dashboard tenant this database belongs to; picks the year_joined rule and keys the rollups
+TENANT = dashboard_tenant()
+SYNC_OVERLAP_DAYS = max(0, args.overlap_days)
+WRITE_BATCH_ROWS = max(1, args.batch_rows)
+METER_REFRESH_DAYS = max(0, args.meter_refresh_days)
+# Bounds of SQL Server smalldatetime, the type of startdate/enddate in the meter tables
+SMALLDATETIME_MIN = np.datetime64('1900-01-01T00:00')
+SMALLDATETIME_MAX = np.datetime64('2079-06-06T23:59')
+# Properties and meters are checkpointed here as their rows are committed
+REPLAY_RUN = args.replay
+journal = RunJournal("full update replay" if REPLAY_RUN else "full update", resume=args.resume)
+print(journal.describe())
+# Every payload a run downloads is archived so it can be replayed offline with --replay
+if REPLAY_RUN:
+    archive = PayloadArchive.load("full update", REPLAY_RUN)
+    print(f"Replaying archived run {archive.run_id}; ESPM will not be called.")
+    # An incremental run only downloads each meter's sync window, so its archive can re-apply
+    # those bills but cannot rebuild the consumption tables
+    if not (archive.description() or {}).get('full_history'):
+        print(f"Warning: {archive.run_id} was not a --full-resync run. Its archive only holds each meter's sync window, so this replay re-applies those bills and does not rebuild the consumption tables.")
+else:
+    archive = PayloadArchive.create("full update", f"run{journal.run_id}")
+    archive.describe(full_history=FULL_RESYNC, overlap_days=SYNC_OVERLAP_DAYS)
+# Earliest consumption date requested on a full resync or for a meter with nothing stored yet
+FULL_HISTORY_START = datetime.date(2020, 1, 1)
 
 user = ENERGY_STAR_PORTFOLIO_MANAGER_USERNAME
 pw = ENERGY_STAR_PORTFOLIO_MANAGER_PASSWORD
@@ -20,213 +102,811 @@ retry_strategy = Retry(
     status_forcelist=[500, 502, 503, 504]
 )
 session = requests.Session()
-adapter = HTTPAdapter(max_retries=retry_strategy)
+# Size the connection pool to the worker count so concurrent fetches reuse connections
+adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS)
 session.mount("https://", adapter)
+# Property and meter documents rarely change; consumption and the property list are always revalidated
+espm_cache = ESPMResponseCache()
 server='aa2030dashboardfree.database.windows.net'
 database='dashboarddb'
 username=DATABASEUSER
 password=DATABASEPW
 driver= '{ODBC Driver 18 for SQL Server}'
+connection_string = f'Driver={driver};Server=tcp:aa2030dashboardfree.database.windows.net,1433;Database=dashboarddb;Uid=CloudSA3d4fc968;Pwd={password};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;'
+db = None
 connection = None
 cursor = None
+meter_high_water_marks = {}
+# table name -> {entryid: rowhash} for the stored rows inside each meter's sync window
+stored_row_hashes = {}
+# meterid -> type/inUse/id etc. from the metercatalog table, read once before the meter stage
+meter_catalog = {}
+# Fetch workers put (table key, rows) for each meter here and the writer thread drains it.
+# The bound keeps fetching from running far ahead of the database.
+row_queue = queue.Queue(maxsize=FETCH_WORKERS * 4)
+# The main thread keeps one pooled connection checked out as db; connection/cursor point at it.
+# Every table writer and the metercatalog writer hold one of their own for the whole meter
+# stage, so a smaller DB_POOL_SIZE would leave acquire() waiting forever.
+db_pool = ConnectionPool(connection_string, max_size=max(DB_POOL_SIZE, len(CONSUMPTION_TABLES) + 2))
 
-def connect_with_retry(max_retries=4, backoff_factor=2, timeout=30):
+def load_meter_high_water_marks():
     """
-    Attempt to connect to SQL Server with retry logic for timeouts.
-    
-    Args:
-        max_retries: Maximum number of connection attempts
-        backoff_factor: Multiplier for wait time between retries
-        timeout: Connection timeout in seconds
-    
-    Returns:    
-        pyodbc.Connection object if successful
+    Read the latest stored enddate for every meterid in the consumption tables.
+    Tables that don't exist yet are skipped. Marks are kept per table so rows a
+    meter left in the wrong table don't cut short its history in the right one.
+
+    Returns:
+        dict of (table name, meterid (str)) -> datetime of the most recent stored enddate
     """
-    connection_string = f'Driver={driver};Server=tcp:aa2030dashboardfree.database.windows.net,1433;Database=dashboarddb;Uid=CloudSA3d4fc968;Pwd={password};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;'
-    
-    for attempt in range(max_retries):
+    marks = {}
+    for table_name in CONSUMPTION_TABLES:
         try:
-            print(f'Attempting to connect to SQL Server (attempt {attempt + 1}/{max_retries})...')
-            connection = pyodbc.connect(connection_string)
-            print('Connection Successful')
-            return connection
-        except pyodbc.OperationalError as e:
-            error_str = str(e).lower()
-            # Check if it's a timeout or connection error
-            if 'timeout' in error_str or 'timed out' in error_str or 'connection' in error_str:
-                if attempt < max_retries - 1:
-                    wait_time = backoff_factor ** attempt
-                    print(f'Connection timeout. Retrying in {wait_time} seconds...')
-                    time.sleep(wait_time)
-                else:
-                    print(f'Failed to connect after {max_retries} attempts.')
-                    raise
-            else:
-                # Not a timeout error, re-raise immediately
-                raise
+            # Plain reads, so db.execute may reconnect and run them again after a dropped link
+            rows = db.execute(f"SELECT meterid, MAX(enddate) FROM {table_name} WHERE enddate IS NOT NULL GROUP BY meterid").fetchall()
+            for meterid, max_enddate in rows:
+                if not meterid or max_enddate is None:
+                    continue
+                marks[(table_name, str(meterid))] = max_enddate
         except pyodbc.Error as e:
-            # For other pyodbc errors, check if it's connection-related
-            error_str = str(e).lower()
-            if 'timeout' in error_str or 'timed out' in error_str or 'connection' in error_str:
-                if attempt < max_retries - 1:
-                    wait_time = backoff_factor ** attempt
-                    print(f'Connection error. Retrying in {wait_time} seconds...')
-                    time.sleep(wait_time)
-                else:
-                    print(f'Failed to connect after {max_retries} attempts.')
-                    raise
-            else:
-                # Not a connection-related error, re-raise immediately
-                raise
-    
-    # Should not reach here, but just in case
-    raise pyodbc.OperationalError("Failed to establish connection after all retries")
+            print(f"Could not read high-water marks from {table_name}, requesting full history for its meters: {e}")
+            try:
+                db.connection.rollback()
+            except:
+                pass
+    return marks
+
+def load_stored_row_hashes():
+    """
+    Read the rowhash of the stored rows each meter's next sync will ask ESPM for
+    again (its last SYNC_OVERLAP_DAYS plus a billing period), so the writers can
+    drop refetched rows that haven't changed before staging them. Rows without
+    a hash yet are left out and go through the MERGE as usual.
+
+    Returns:
+        dict of table name -> {entryid: rowhash}
+    """
+    hashes = {}
+    for table_name in CONSUMPTION_TABLES:
+        hashes[table_name] = {}
+        try:
+            rows = db.execute(f"""
+                SELECT t.entryid, t.rowhash
+                FROM {table_name} t
+                JOIN (SELECT meterid, MAX(enddate) AS maxend FROM {table_name} GROUP BY meterid) m
+                    ON m.meterid = t.meterid
+                WHERE t.rowhash IS NOT NULL AND t.enddate >= DATEADD(day, -?, m.maxend)
+            """, (SYNC_OVERLAP_DAYS + 31,)).fetchall()
+            for entryid, stored_hash in rows:
+                hashes[table_name][entryid] = bytes(stored_hash)
+        except pyodbc.Error as e:
+            print(f"Could not read row hashes from {table_name}, every fetched row will be staged: {e}")
+            try:
+                db.connection.rollback()
+            except:
+                pass
+    return hashes
 
-def check_and_reconnect():
+def consumption_start_date(meterid, table_name):
+    """
+    startDate to request for a meter: a short overlap before its latest stored
+    enddate, or the full history start on --full-resync or for unseen meters.
     """
-    Check if connection is alive, reconnect if needed.
-    Returns: (connection, cursor) tuple
+    if FULL_RESYNC:
+        return FULL_HISTORY_START.isoformat()
+    mark = meter_high_water_marks.get((table_name, str(meterid)))
+    if mark is None:
+        return FULL_HISTORY_START.isoformat()
+    if isinstance(mark, datetime.datetime):
+        mark = mark.date()
+    start = mark - datetime.timedelta(days=SYNC_OVERLAP_DAYS)
+    return max(start, FULL_HISTORY_START).isoformat()
+
+def inactive_meter_complete(meterid, meter_info, table_name):
     """
-    global connection, cursor
+    True for an inactive meter whose stored bills already reach its inactiveDate
+    (within the sync overlap), so there is nothing left to ask ESPM for. Inactive
+    meters without that, such as a new property's retired meters, still have
+    their history loaded, as does every meter on --full-resync.
+    """
+    if FULL_RESYNC:
+        return False
+    mark = meter_high_water_marks.get((table_name, str(meterid)))
+    if mark is None:
+        return False
+    if isinstance(mark, datetime.datetime):
+        mark = mark.date()
+    inactivedate = meter_info.get('inactivedate')
+    if isinstance(inactivedate, datetime.datetime):
+        inactivedate = inactivedate.date()
+    return inactivedate is None or mark >= inactivedate - datetime.timedelta(days=SYNC_OVERLAP_DAYS)
+
+def load_meter_catalog():
+    """
+    Read the metercatalog entries that are still fresh enough to skip /meter/{id}.
+
+    Returns:
+        dict of meterid (str) -> catalog entry
+    """
+    catalog = {}
+    if METER_REFRESH_DAYS == 0:
+        return catalog
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=METER_REFRESH_DAYS)
     try:
-        # Try a simple query to check if connection is alive
-        cursor.execute("SELECT 1")
-        cursor.fetchone()
-        return connection, cursor
-    except (pyodbc.Error, AttributeError):
-        # Connection is dead or doesn't exist, reconnect
-        print("Connection lost. Reconnecting...")
+        rows = db.execute(
+            "SELECT meterid, espmid, type, inuse, inactivedate, metername FROM metercatalog WHERE refreshedat >= ?",
+            (cutoff,),
+        ).fetchall()
+        for meterid, espmid, meter_type, inuse, inactivedate, metername in rows:
+            catalog[str(meterid)] = {
+                'meterid': str(meterid),
+                'espmid': espmid,
+                'id': str(meterid),
+                'type': meter_type,
+                'inuse': inuse,
+                'inactivedate': inactivedate,
+                'metername': metername,
+            }
+    except pyodbc.Error as e:
+        print(f"Could not read metercatalog, fetching every meter from ESPM: {e}")
         try:
-            if connection:
-                try:
-                    connection.close()
-                except:
-                    pass
-            if cursor:
-                try:
-                    cursor.close()
-                except:
-                    pass
+            db.connection.rollback()
         except:
             pass
-        
-        connection = connect_with_retry(max_retries=3, backoff_factor=2, timeout=30)
-        cursor = connection.cursor()
-        cursor.fast_executemany = True
-        print("Reconnection successful.")
-        return connection, cursor
+    return catalog
 
-def execute_with_retry(query, params=None, max_retries=3):
+def lookup_meter(meterid, espmid):
     """
-    Execute a database query with retry logic for connection failures.
+    type, inUse and id for one meter. Uses the catalog entry if it is fresh,
+    otherwise fetches /meter/{id} and queues the result for the writer to save
+    back to metercatalog.
+
+    Returns:
+        catalog entry dict, or None if ESPM didn't return a meter
+    """
+    entry = meter_catalog.get(str(meterid))
+    if entry is not None:
+        return entry
+    response = espm_cache.get(session, f'https://portfoliomanager.energystar.gov/ws/meter/{meterid}', auth=HTTPBasicAuth(user, pw), timeout=60)  
+    dict_data = xmltodict.parse(response.content)
+    #Meter Data
+    # Check if 'meter' key exists in the response
+    if 'meter' not in dict_data:
+        print(f"Warning: 'meter' key not found in response for meter ID {meterid}")
+        print(f'ESPM ID of affected meter{espmid}')
+        print(f"Response keys: {list(dict_data.keys())}")
+        return None
+    meter = dict_data['meter']
+    try:
+        inactivedate = datetime.date.fromisoformat(meter.get('inactiveDate'))
+    except (TypeError, ValueError):
+        inactivedate = None
+    entry = {
+        'meterid': str(meterid),
+        'espmid': espmid,
+        'id': meter.get('id'),
+        'type': meter.get('type'),
+        'inuse': meter.get('inUse'),
+        'inactivedate': inactivedate,
+        'metername': meter.get('name'),
+    }
+    row_queue.put(('catalog', entry))
+    return entry
+
+def fetch_property_details(espmid):
+    """
+    Pull the basic attributes for one property. Returns None if the lookup fails.
+    """
+    try:
+        response=espm_cache.get(session, f'https://portfoliomanager.energystar.gov/ws/property/{espmid}', auth=HTTPBasicAuth(user, pw), timeout=60)
+        archive.put('property', str(espmid), response.content, espmid=espmid)
+    except Exception as e:
+        print(f"Error processing espmid {espmid}: {e}")
+        return None
+    return parse_property_details(espmid, response.content)
+
+def parse_property_details(espmid, content):
+    """
+    The basic attributes from one /property/{id} document. Returns None if it
+    can't be read.
+    """
+    try:
+        dict_data = xmltodict.parse(content)
+        name=dict_data['property']['name']
+        address=dict_data['property']['address']['@address1']
+        gfa=dict_data['property']['grossFloorArea']['value']
+        occupancy=dict_data['property']['occupancyPercentage']
+        numbuildings=dict_data['property']['numberOfBuildings']
+        usetype=dict_data['property']['primaryFunction']
+        yearbuilt=dict_data['property']['yearBuilt']
+
+        return {
+            'espmid': espmid,
+            'name': str(name) if name else None,
+            'address': str(address) if address else None,
+            'gfa': str(gfa) if gfa else None,
+            'occupancy': str(occupancy) if occupancy else None,
+            'numbuildings': str(numbuildings) if numbuildings else None,
+            'usetype': str(usetype) if usetype else None,
+            'yearbuilt': str(yearbuilt) if yearbuilt else None
+        }
+    except Exception as e:
+        print(f"Error processing espmid {espmid}: {e}")
+        return None
+
+def build_consumption_rows(espmid, meterid, entries):
+    """
+    Turn one meter's consumption entries into rows for the writer.
+
+    startDate and endDate for the whole meter are parsed in a single
+    pd.to_datetime call and checked against the smalldatetime range with
+    vectorized masks. Dates that don't parse or fall outside the range are
+    stored as NULL, and the meter gets one warning listing them instead of
+    one per value.
+
+    Args:
+        entries: (id, cost, usage, startDate, endDate) tuples from iter_consumption()
+    """
+    if not entries:
+        return []
+    count = len(entries)
+    raw_dates = [entry[3] for entry in entries] + [entry[4] for entry in entries]
+    parsed = pd.to_datetime(pd.Series(raw_dates, dtype=object), format='%Y-%m-%d', errors='coerce').to_numpy()
+    # NaT compares False, so unparseable dates drop out of the mask along with out-of-range ones
+    in_range = (parsed >= SMALLDATETIME_MIN) & (parsed <= SMALLDATETIME_MAX)
+    dates = np.where(in_range, parsed.astype('datetime64[us]').astype(object), None).tolist()
+    rejected = [raw_dates[i] for i in np.flatnonzero(~in_range) if raw_dates[i] is not None]
+    if rejected:
+        print(f"Warning: {len(rejected)} dates on meter {meterid} (espmid {espmid}) were unparseable or outside the smalldatetime range and are stored as NULL: {rejected[:5]}")
+
+    rows = []
+    for index, (entryid, cost, usage, startdate_str, enddate_str) in enumerate(entries):
+        # Prefix entry ids with the meter id so they stay unique across meters. Entries
+        # without an id fall back to their dates, then to their position in the response.
+        if entryid:
+            unique_entryid = f"{meterid}_{entryid}"
+        elif startdate_str and enddate_str:
+            unique_entryid = f"{meterid}_{startdate_str}_{enddate_str}"
+        elif startdate_str:
+            unique_entryid = f"{meterid}_{startdate_str}"
+        else:
+            unique_entryid = f"{meterid}_{espmid}_{index}"
+        rows.append({
+            'espmid': espmid,
+            'entryid': unique_entryid,
+            'meterid': str(meterid),
+            'cost': cost,
+            'usage': usage,
+            'startdate': dates[index],
+            'enddate': dates[count + index],
+            'rowhash': row_hash((espmid, meterid, cost, usage, dates[index], dates[count + index])),
+        })
+    return rows
+
+def fetch_meter_rows(espmid, meter, meter_info, table_name):
+    """
+    Download one meter's consumption after its high-water mark and build its rows.
+    Shared by every meter type; returns an empty list if there is nothing to load.
+    """
+    meter_id = meter_info['id']
+    if not meter_id:
+        print(f"Warning: No meter ID found for meter {meter}")
+        return []
+    response = espm_cache.get(session, f'https://portfoliomanager.energystar.gov/ws/meter/{meter_id}/consumptionData?startDate={consumption_start_date(meter, table_name)}', ttl=0, auth=HTTPBasicAuth(user, pw), timeout=60)
+    archive.put('consumption', f"{espmid}-{meter}", response.content, espmid=espmid, meterid=meter, table_name=table_name)
+    # Entries are streamed straight out of the XML and the meter's dates are parsed in one batch
+    rows = build_consumption_rows(espmid, meter, list(iter_consumption(response.content)))
+    if not rows:
+        print(f"No consumption data found for meter {meter}")
+    return rows
+
+def association_meter_ids(dict_data, association):
+    """
+    Meter ids listed under one association (energyMeterAssociation or
+    waterMeterAssociation), as a list even when ESPM returns a single id.
+    """
+    meter_list_data = dict_data.get('meterPropertyAssociationList', {}).get(association, {}).get('meters', {})
+    if not meter_list_data:
+        return []
+    meter_ids = meter_list_data.get('meterId')
+    if meter_ids is None:
+        return []
+    if isinstance(meter_ids, list):
+        return meter_ids
+    return [meter_ids]
+
+def fetch_property_consumption(espmid):
     """
+    Fetch every meter on one property and queue its consumption rows.
+
+    Runs on a worker thread. Each meter's rows are put on row_queue as soon as
+    they are built, so the writer can flush them while other meters are still
+    downloading. Energy meters go to the table METER_TYPE_TABLES maps their
+    type to (types without a table are skipped); every water meter goes to
+    WATER_TABLE. Errors are caught per meter and per property.
+
+    Meters the journal already has as written are skipped. If nothing failed, a
+    ('property', espmid) marker follows the rows so the writer can mark the
+    property done once they are committed.
+    """
+    failed = False
+    try:
+        response = espm_cache.get(session, f'https://portfoliomanager.energystar.gov/ws/association/property/{espmid}/meter', auth=HTTPBasicAuth(user, pw), timeout=60)
+        dict_data = xmltodict.parse(response.content)
+
+        # Energy and water associations are read independently, so a property
+        # without water meters still has its energy meters loaded
+        meter_id_list = association_meter_ids(dict_data, 'energyMeterAssociation')
+        if not meter_id_list:
+            print(f"No meter data found for espmid {espmid}")
+        watermeter_id_list = association_meter_ids(dict_data, 'waterMeterAssociation')
+        if not watermeter_id_list:
+            print(f"No water meter data found for espmid {espmid}")
+
+        meters = [(meter, None) for meter in meter_id_list] + [(meter, WATER_TABLE) for meter in watermeter_id_list]
+        for meter, table_name in meters:
+            if journal.meter_flushed(meter):
+                continue
+            try:
+                meter_info = lookup_meter(meter, espmid)
+                if meter_info is None:
+                    continue
+                if table_name is None:
+                    table_name = METER_TYPE_TABLES.get(meter_info['type'])
+                    if table_name is None:
+                        continue
+                # ESPM sends inUse as lowercase "false". Inactive meters are loaded up to
+                # their inactiveDate and only skipped once that history is stored.
+                if str(meter_info['inuse']).strip().lower() == "false" and inactive_meter_complete(meter, meter_info, table_name):
+                    continue
+                rows = fetch_meter_rows(espmid, meter, meter_info, table_name)
+                if rows:
+                    row_queue.put((table_name, rows))
+            except Exception as meter_error:
+                failed = True
+                print(f"Error processing meter {meter} for espmid {espmid}: {meter_error}")
+                continue
+    except Exception as espmid_error:
+        failed = True
+        print(f"Error processing espmid {espmid}: {espmid_error}")
+    finally:
+        if not failed:
+            row_queue.put(('property', espmid))
+
+def replay_consumption():
+    """
+    Queue consumption rows from the archived run instead of ESPM. Each payload is
+    built into rows exactly as fetch_meter_rows would, then every replayed
+    property gets its ('property', espmid) marker.
+    """
+    replayed = []
+    payloads = 0
+    for entry in archive.entries('consumption'):
+        espmid = entry['espmid']
+        if journal.property_done(espmid) or journal.meter_flushed(entry['meterid']):
+            continue
+        rows = build_consumption_rows(espmid, entry['meterid'], list(iter_consumption(archive.read(entry))))
+        payloads += 1
+        if rows:
+            row_queue.put((entry['table_name'], rows))
+        if espmid not in replayed:
+            replayed.append(espmid)
+    for espmid in replayed:
+        row_queue.put(('property', espmid))
+    print(f"Replayed {payloads} consumption payloads for {len(replayed)} properties.")
+
+def merge_consumption_batch(db, table_name, rows, max_retries=3):
+    """
+    Stage one batch of consumption rows in a temp table and MERGE it into table_name
+    on the pooled connection db. The batch is committed on its own, so rows already
+    written survive a later failure.
+
+    Returns:
+        number of rows inserted or updated
+    """
+    temp_table = f"#Temp{table_name}Data"
     for attempt in range(max_retries):
         try:
-            connection, cursor = check_and_reconnect()
-            if params:
-                cursor.execute(query, params)
-            else:
-                cursor.execute(query)
-            return cursor
+            # Ping first if the connection sat idle, or after a failed attempt
+            connection, cursor = db.ensure_alive(force=attempt > 0)
+            try:
+                cursor.execute(f"DROP TABLE {temp_table}")
+            except:
+                pass
+            cursor.execute(f"""
+                CREATE TABLE {temp_table} (
+                    entryid NVARCHAR(100) PRIMARY KEY,
+                    espmid INT,
+                    meterid NVARCHAR(100),
+                    cost NVARCHAR(100),
+                    usage NVARCHAR(100),
+                    startdate SMALLDATETIME,
+                    enddate SMALLDATETIME,
+                    rowhash BINARY(32)
+                )
+            """)
+            
+            temp_insert_query = f"""
+                INSERT INTO {temp_table} (entryid, espmid, meterid, cost, usage, startdate, enddate, rowhash) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """
+            insert_data = [
+                (
+                    row['entryid'],
+                    row['espmid'],
+                    row['meterid'],
+                    row['cost'],
+                    row['usage'],
+                    row['startdate'],
+                    row['enddate'],
+                    row['rowhash']
+                )
+                for row in rows
+            ]
+            
+            # Insert in batches of 1000 to reduce transaction time
+            batch_size = 1000
+            for i in range(0, len(insert_data), batch_size):
+                batch = insert_data[i:i + batch_size]
+                cursor.executemany(temp_insert_query, batch)
+            
+            # Use MERGE to insert or update the batch; one hash comparison decides whether a row changed.
+            # cost_num / usage_num are converted from the staged text in the same statement.
+            typed = typed_assignments(table_name, 'source')
+            typed_set = ", ".join(f"{column} = {value}" for column, value in typed)
+            typed_insert_columns = ", ".join(column for column, _ in typed)
+            typed_insert_values = ", ".join(value for _, value in typed)
+            merge_query = f"""
+                MERGE {table_name} AS target
+                USING {temp_table} AS source
+                ON target.entryid = source.entryid
+                WHEN MATCHED AND (target.rowhash IS NULL OR target.rowhash <> source.rowhash) THEN
+                    UPDATE SET
+                        espmid = source.espmid,
+                        meterid = source.meterid,
+                        cost = source.cost,
+                        usage = source.usage,
+                        startdate = source.startdate,
+                        enddate = source.enddate,
+                        rowhash = source.rowhash,
+                        {typed_set}
+                WHEN NOT MATCHED THEN
+                    INSERT (entryid, espmid, meterid, cost, usage, startdate, enddate, rowhash, {typed_insert_columns})
+                    VALUES (source.entryid, source.espmid, source.meterid, source.cost, source.usage, source.startdate, source.enddate, source.rowhash, {typed_insert_values});
+            """
+            cursor.execute(merge_query)
+            
+            # Get count of affected rows
+            cursor.execute("SELECT @@ROWCOUNT")
+            rows_affected = cursor.fetchone()[0]
+            
+            # A commit lost to a dropped connection is handled below like any other
+            # connection error: the whole batch is staged again on a fresh connection
+            connection.commit()
+            
+            # Drop temp table
+            try:
+                cursor.execute(f"DROP TABLE {temp_table}")
+            except:
+                pass
+            
+            return rows_affected
+            
         except pyodbc.Error as e:
-            error_str = str(e).lower()
-            if ('communication link failure' in error_str or '08S01' in str(e) or 
-                'connection' in error_str or 'timeout' in error_str):
+            # Ensure temp table is cleaned up
+            try:
+                cursor.execute(f"DROP TABLE {temp_table}")
+            except:
+                pass
+            
+            # Check if it's a connection error
+            if is_connection_error(e):
                 if attempt < max_retries - 1:
                     wait_time = 2 ** attempt
-                    print(f"Connection error during query. Retrying in {wait_time} seconds... (attempt {attempt + 1}/{max_retries})")
+                    print(f"Connection error during {table_name} batch insertion. Retrying in {wait_time} seconds... (attempt {attempt + 1}/{max_retries})")
                     time.sleep(wait_time)
-                    # Force reconnection
-                    connection, cursor = check_and_reconnect()
+                    # The next attempt pings and reconnects if needed
+                    try:
+                        connection.rollback()
+                    except:
+                        pass
+                    continue
                 else:
-                    print(f"Failed to execute query after {max_retries} attempts: {e}")
+                    print(f"Error updating {table_name} data after {max_retries} attempts: {e}")
+                    try:
+                        connection.rollback()
+                    except:
+                        pass
                     raise
             else:
                 # Not a connection error, re-raise immediately
+                print(f"Error updating {table_name} data: {e}")
+                try:
+                    connection.rollback()
+                except:
+                    pass
                 raise
 
-##Establish Database Columns 
-try:
-    connection = connect_with_retry(max_retries=3, backoff_factor=2, timeout=30)
-    
-    # Create cursor with fast_executemany for better performance
-    cursor = connection.cursor()
-    # Enable fast_executemany for bulk operations (much faster for large datasets)
-    cursor.fast_executemany = True
-
-    # Define the CREATE TABLE SQL query
-    create_table_query = """
-    CREATE TABLE PrimaryDataBase (
-        espmid INT PRIMARY KEY,
-        buildingname NVARCHAR(100),
-        sqfootage NVARCHAR(100),
-        address NVARCHAR(100),
-        occupancy NVARCHAR(100),
-        numbuildings NVARCHAR(100),
-        usetype NVARCHAR(100),
-        yearbuilt NVARCHAR(100)
-    )
+def merge_meter_catalog(db, entries):
     """
-    
-    # Execute the query
+    Upsert freshly fetched /meter/{id} results into metercatalog on the pooled
+    connection db. The catalog is only a cache, so a failure is reported and the
+    run carries on.
+    """
+    if not entries:
+        return
+    refreshedat = datetime.datetime.now()
     try:
-        cursor.execute(create_table_query)
-        print("Table 'espm basics' created successfully!")
+        connection, cursor = db.ensure_alive()
+        try:
+            cursor.execute("DROP TABLE #TempMeterCatalog")
+        except:
+            pass
+        cursor.execute("""
+            CREATE TABLE #TempMeterCatalog (
+                meterid NVARCHAR(100) PRIMARY KEY,
+                espmid INT,
+                type NVARCHAR(100),
+                inuse NVARCHAR(10),
+                inactivedate DATE,
+                metername NVARCHAR(200),
+                refreshedat DATETIME2
+            )
+        """)
+        cursor.executemany(
+            "INSERT INTO #TempMeterCatalog (meterid, espmid, type, inuse, inactivedate, metername, refreshedat) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (entry['meterid'], entry['espmid'], entry['type'], entry['inuse'], entry['inactivedate'], entry['metername'], refreshedat)
+                for entry in {entry['meterid']: entry for entry in entries}.values()
+            ],
+        )
+        cursor.execute("""
+            MERGE metercatalog AS target
+            USING #TempMeterCatalog AS source
+            ON target.meterid = source.meterid
+            WHEN MATCHED THEN
+                UPDATE SET
+                    espmid = source.espmid,
+                    type = source.type,
+                    inuse = source.inuse,
+                    inactivedate = source.inactivedate,
+                    metername = source.metername,
+                    refreshedat = source.refreshedat
+            WHEN NOT MATCHED THEN
+                INSERT (meterid, espmid, type, inuse, inactivedate, metername, refreshedat)
+                VALUES (source.meterid, source.espmid, source.type, source.inuse, source.inactivedate, source.metername, source.refreshedat);
+        """)
         connection.commit()
-    except pyodbc.Error as create_error:
-        # Table might already exist, that's okay
-        if "already exists" in str(create_error).lower() or "There is already an object" in str(create_error):
-            print("Table 'ESPM basics' already exists (or creation failed), continuing...")
+        cursor.execute("DROP TABLE #TempMeterCatalog")
+        print(f"Refreshed {len(entries)} entries in metercatalog.")
+    except pyodbc.Error as e:
+        print(f"Error updating metercatalog: {e}")
+        try:
             connection.rollback()
-            
-            # Add new columns if they don't exist (for existing tables)
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD occupancy NVARCHAR(100)")
-                print("Added 'occupancy' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'occupancy' column: {e}")
-            
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD numbuildings NVARCHAR(100)")
-                print("Added 'numbuildings' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'numbuildings' column: {e}")
-            
-            try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD usetype NVARCHAR(100)")
-                print("Added 'usetype' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
-                else:
-                    print(f"Warning: Could not add 'usetype' column: {e}")
-            
+        except:
+            pass
+
+def consumption_table_writer(table_name, table_queue, batch_rows, summary, errors, items_committed):
+    """
+    Writer for one consumption table, on its own pooled connection so the tables
+    are staged and MERGEd at the same time. Takes (espmid, rows) items off
+    table_queue and MERGEs once batch_rows rows are buffered; None means flush
+    what is left and stop.
+
+    Rows whose rowhash matches stored_row_hashes are unchanged and never staged.
+    Every committed batch is recorded in the journal, and the espmids of the items
+    it covered are passed to items_committed.
+
+    A failure stops this table only: the error is appended to errors and the rest
+    of its queue is drained unwritten, while the other tables keep going.
+    """
+    stats = summary[table_name]
+    # This table's own failure; errors is shared with the other writers
+    table_errors = []
+    stored_hashes = stored_row_hashes.get(table_name, {})
+    buffer = []
+    # MERGE fails if a batch holds the same entryid twice, so duplicates are dropped per batch
+    seen_entryids = set()
+    # One espmid per queue item whose rows are sitting in buffer
+    buffered_items = []
+    db = None
+
+    def fail(error):
+        print(f"Stopping {table_name} writes after an error: {error}")
+        table_errors.append(error)
+        errors.append(error)
+
+    try:
+        db = db_pool.acquire()
+    except Exception as e:
+        fail(e)
+
+    def flush():
+        nonlocal buffer, seen_entryids, buffered_items
+        if table_errors:
+            return
+        try:
+            if buffer:
+                started = time.perf_counter()
+                rows_affected = merge_consumption_batch(db, table_name, buffer)
+                stats['seconds'] += time.perf_counter() - started
+                stats['batches'] += 1
+                stats['rows'] += len(buffer)
+                stats['affected'] += rows_affected
+                print(f"Flushed {len(buffer)} rows to {table_name} ({rows_affected} inserted or updated).")
+                journal.mark_meters({(row['meterid'], row['espmid']) for row in buffer}, table_name)
+            items_committed(buffered_items)
+        except Exception as e:
+            fail(e)
+        buffer = []
+        seen_entryids = set()
+        buffered_items = []
+
+    try:
+        while True:
+            item = table_queue.get()
+            if item is None:
+                break
+            if table_errors:
+                continue
             try:
-                cursor.execute("ALTER TABLE PrimaryDataBase ADD yearbuilt NVARCHAR(100)")
-                print("Added 'yearbuilt' column to PrimaryDataBase table.")
-                connection.commit()
-            except pyodbc.Error as e:
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass  # Column already exists
+                espmid, rows = item
+                buffered_before = len(buffer)
+                for row in rows:
+                    entryid = row.get('entryid')
+                    if entryid and stored_hashes.get(entryid) == row['rowhash']:
+                        stats['unchanged'] += 1
+                    elif not entryid:
+                        # Skip entries with None entryid (shouldn't happen, but just in case)
+                        stats['duplicates'] += 1
+                        print(f"Warning: Found entry with None entryid, skipping. Meter: {row.get('meterid')}, ESPMID: {row.get('espmid')}")
+                    elif entryid in seen_entryids:
+                        stats['duplicates'] += 1
+                        print(f"Warning: Duplicate entryid found: {entryid}. Skipping duplicate entry.")
+                    else:
+                        seen_entryids.add(entryid)
+                        buffer.append(row)
+                if len(buffer) > buffered_before:
+                    buffered_items.append(espmid)
                 else:
-                    print(f"Warning: Could not add 'yearbuilt' column: {e}")
-        else:
-            raise  # Re-raise if it's a different error
-    
+                    # Nothing from this meter needs writing, so it is already as good as committed
+                    journal.mark_meters({(row['meterid'], row['espmid']) for row in rows}, table_name)
+                    items_committed([espmid])
+                if len(buffer) >= batch_rows:
+                    flush()
+            except Exception as e:
+                # Keep draining so the router is never left blocked on a full queue
+                fail(e)
+        flush()
+    finally:
+        if db is not None:
+            db_pool.release(db)
+
+def consumption_writer(batch_rows, summary, errors):
+    """
+    Writer stage of the meter pipeline. Takes items off row_queue and routes each
+    table's rows to that table's consumption_table_writer thread. A None item
+    means the fetch workers are finished; the table writers then flush what they
+    have left and this waits for them.
+
+    A ('property', espmid) marker is recorded in the journal once every item
+    routed for that property has been committed. ('catalog', entry) items are
+    saved to metercatalog in batches of 500.
+
+    A table writer that fails appends its error to errors and stops on its own;
+    the other tables keep writing, and properties with items in the failed
+    table are never marked done. If routing itself fails, row_queue is still
+    drained so fetch workers never block forever on a full queue.
+    """
+    lock = threading.Lock()
+    # espmid -> number of routed items not committed yet
+    outstanding = {}
+    waiting_properties = set()
+    catalog_entries = []
+
+    def mark_finished(espmids):
+        # Caller holds the lock
+        done = [espmid for espmid in espmids if espmid in waiting_properties and espmid not in outstanding]
+        waiting_properties.difference_update(done)
+        return done
+
+    def items_committed(espmids):
+        with lock:
+            for espmid in espmids:
+                outstanding[espmid] -= 1
+                if not outstanding[espmid]:
+                    del outstanding[espmid]
+            done = mark_finished(set(espmids))
+        if done:
+            journal.mark_properties(done)
+
+    table_queues = {table_name: queue.Queue(maxsize=FETCH_WORKERS * 4) for table_name in CONSUMPTION_TABLES}
+    table_writers = [
+        threading.Thread(
+            target=consumption_table_writer,
+            args=(table_name, table_queues[table_name], batch_rows, summary, errors, items_committed),
+            name=f"{table_name}-writer",
+        )
+        for table_name in CONSUMPTION_TABLES
+    ]
+    for table_writer in table_writers:
+        table_writer.start()
+    catalog_db = None
+    try:
+        while True:
+            item = row_queue.get()
+            if item is None:
+                break
+            key, rows = item
+            if key == 'property':
+                with lock:
+                    waiting_properties.add(rows)
+                    done = mark_finished([rows])
+                if done:
+                    journal.mark_properties(done)
+                continue
+            if key == 'catalog':
+                catalog_entries.append(rows)
+                if len(catalog_entries) >= 500:
+                    catalog_db = catalog_db or db_pool.acquire()
+                    merge_meter_catalog(catalog_db, catalog_entries)
+                    catalog_entries = []
+                continue
+            if not rows:
+                continue
+            espmid = rows[0]['espmid']
+            with lock:
+                outstanding[espmid] = outstanding.get(espmid, 0) + 1
+            table_queues[key].put((espmid, rows))
+    except Exception as e:
+        errors.append(e)
+        # Keep draining so the fetch workers are not left blocked on a full queue
+        while row_queue.get() is not None:
+            pass
+    finally:
+        for table_name in CONSUMPTION_TABLES:
+            table_queues[table_name].put(None)
+        for table_writer in table_writers:
+            table_writer.join()
+        try:
+            if catalog_entries:
+                catalog_db = catalog_db or db_pool.acquire()
+                merge_meter_catalog(catalog_db, catalog_entries)
+        finally:
+            if catalog_db is not None:
+                db_pool.release(catalog_db)
+
+##Establish Database Columns 
+try:
+    # The main thread keeps one pooled connection for the whole run. Pooled cursors
+    # already have fast_executemany enabled for the bulk inserts.
+    db = db_pool.acquire()
+    connection, cursor = db.ensure_alive()
+
+    # Tables, columns and indexes come from the versioned steps in schema_helper.MIGRATIONS;
+    # when the schema is current this is one query instead of a round of ALTERs
+    applied_migrations = apply_migrations(db, MIGRATIONS)
+    if applied_migrations:
+        print(f"Applied schema migrations {applied_migrations}.")
+    else:
+        print("Database schema is up to date.")
+    # Meter types map to tables in schema_helper; one without a migration creating it would lose its rows
+    missing_tables = []
+    for table_name in CONSUMPTION_TABLES:
+        cursor.execute("SELECT OBJECT_ID(?)", (table_name,))
+        if cursor.fetchone()[0] is None:
+            missing_tables.append(table_name)
+    if missing_tables:
+        raise RuntimeError(f"Consumption tables {missing_tables} have no migration creating them; add one with schema_helper.consumption_table_migration().")
 
 #Pull All ESPM ID's and input them into database
     idlist=[]
-    response = requests.get(f'https://portfoliomanager.energystar.gov/ws/account/216165/property/list', auth=HTTPBasicAuth(user, pw), timeout=60)
-    dict_data = xmltodict.parse(response.content)
+    if REPLAY_RUN:
+        property_list = archive.read(archive.entries('property-list')[-1])
+    else:
+        response = espm_cache.get(session, f'https://portfoliomanager.energystar.gov/ws/account/216165/property/list', ttl=0, auth=HTTPBasicAuth(user, pw), timeout=60)
+        property_list = response.content
+        archive.put('property-list', 'list', property_list)
+    dict_data = xmltodict.parse(property_list)
     print("This is the meter list info")
     for entry in dict_data['response']['links']['link']:
         idlist.append(entry['@id'])
@@ -320,34 +1000,25 @@ try:
     # data we need - sq footage,name,postal code,primary use type, gas data, electric data,water data,year built,#buildings # stories,, Migreenpower    
     # Collect all property data first
     property_data = []
-    for espmid in idlist:
-        try:
-            response=session.get(f'https://portfoliomanager.energystar.gov/ws/property/{espmid}', auth=HTTPBasicAuth(user, pw), timeout=60)
-            dict_data = xmltodict.parse(response.content)
-            name=dict_data['property']['name']
-            address=dict_data['property']['address']['@address1']
-            gfa=dict_data['property']['grossFloorArea']['value']
-            occupancy=dict_data['property']['occupancyPercentage']
-            numbuildings=dict_data['property']['numberOfBuildings']
-            usetype=dict_data['property']['primaryFunction']
-            yearbuilt=dict_data['property']['yearBuilt']
-            
-            
-            # Store data for bulk update
-            property_data.append({
-                'espmid': espmid,
-                'name': str(name) if name else None,
-                'address': str(address) if address else None,
-                'gfa': str(gfa) if gfa else None,
-                'occupancy': str(occupancy) if occupancy else None,
-                'numbuildings': str(numbuildings) if numbuildings else None,
-                'usetype': str(usetype) if usetype else None,
-                'yearbuilt': str(yearbuilt) if yearbuilt else None
-            })
-        except Exception as e:
-            print(f"Error processing espmid {espmid}: {e}")
-            continue
+    if REPLAY_RUN:
+        property_entries = archive.entries('property')
+        if not property_entries:
+            print("This archive has no property documents, skipping property details in the replay.")
+        for entry in property_entries:
+            prop = parse_property_details(entry['espmid'], archive.read(entry))
+            if prop:
+                property_data.append(prop)
+    elif journal.stage_done('property details'):
+        print("Property details were already written in this run, skipping.")
+    else:
+        # Fan the /property/{id} lookups out over the worker pool; map() keeps idlist order
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            for prop in executor.map(fetch_property_details, idlist):
+                if prop:
+                    property_data.append(prop)
     
+    # The lookups can leave the main connection idle long enough to need a ping
+    connection, cursor = db.ensure_alive()
     # Create temp table and perform bulk update if we have data
     if property_data:
         try:
@@ -385,8 +1056,12 @@ try:
             ]
             cursor.executemany(temp_insert_query, insert_data)
             
-            # Use MERGE to update only where values differ
-            merge_query = """
+            # Use MERGE to update only where values differ; the typed columns follow their text columns
+            typed = typed_assignments('PrimaryDataBase', 'source', columns=['numbuildings', 'occupancy', 'yearbuilt'])
+            typed_set = ", ".join(f"{column} = {value}" for column, value in typed)
+            typed_insert_columns = ", ".join(column for column, _ in typed)
+            typed_insert_values = ", ".join(value for _, value in typed)
+            merge_query = f"""
                 MERGE PrimaryDataBase AS target
                 USING #TempPropertyData AS source
                 ON target.espmid = source.espmid
@@ -406,16 +1081,21 @@ try:
                         occupancy = source.occupancy,
                         numbuildings = source.numbuildings,
                         usetype = source.usetype,
-                        yearbuilt = source.yearbuilt
+                        yearbuilt = source.yearbuilt,
+                        rowhash = NULL,
+                        {typed_set}
                 WHEN NOT MATCHED THEN
-                    INSERT (espmid, buildingname, sqfootage, address, occupancy, numbuildings, usetype, yearbuilt)
-                    VALUES (source.espmid, source.buildingname, source.sqfootage, source.address, source.occupancy, source.numbuildings, source.usetype, source.yearbuilt);
+                    INSERT (espmid, buildingname, sqfootage, address, occupancy, numbuildings, usetype, yearbuilt, {typed_insert_columns})
+                    VALUES (source.espmid, source.buildingname, source.sqfootage, source.address, source.occupancy, source.numbuildings, source.usetype, source.yearbuilt, {typed_insert_values});
             """
             cursor.execute(merge_query)
             
             # Get count of updated rows
             cursor.execute("SELECT @@ROWCOUNT")
             rows_affected = cursor.fetchone()[0]
+            # sqfootage, usetype and numbuildings feed the Portfolio Data rollups
+            if rows_affected:
+                bump_data_version(cursor, TENANT)
             
             connection.commit()
             
@@ -423,6 +1103,7 @@ try:
             cursor.execute("DROP TABLE #TempPropertyData")
             
             print(f"Successfully updated {rows_affected} rows in PrimaryDataBase table.")
+            journal.mark_stage('property details')
             
         except pyodbc.Error as e:
             # Ensure temp table is cleaned up
@@ -432,1189 +1113,85 @@ try:
                 pass
             print(f"Error updating property data: {e}")
             connection.rollback()
+    # Properties inserted above count toward the portfolio charts once they have a year_joined,
+    # and the property details just written feed the Portfolio Data rollups
+    try:
+        rollup_started = time.perf_counter()
+        year_joined_rows = resolve_year_joined(db, TENANT)
+        print(f"Resolved year_joined for {TENANT}: {year_joined_rows} rows changed.")
+        rollup_rows = refresh_rollups(db, TENANT, datetime.date.today().year - 1)
+        print(f"Refreshed {len(rollup_rows)} portfolio rollup tables for {TENANT} ({sum(rollup_rows.values())} rows) in {time.perf_counter() - rollup_started:.1f}s.")
+    except pyodbc.Error as e:
+        # The page falls back to its live queries until a refresh succeeds
+        print(f"Could not refresh the portfolio rollups: {e}")
+        connection.rollback()
     # format of new table - espmid,cost,usage,startdate,enddate
     # query all entries from specific date ranges
-    gasdata=[]
-    electricdata=[]
-    solardata=[]
-    for espmid in idlist:
-        try:
-            response = requests.get(f'https://portfoliomanager.energystar.gov/ws/association/property/{espmid}/meter', auth=HTTPBasicAuth(user, pw), timeout=60)
-            dict_data = xmltodict.parse(response.content)
-            
-            # Handle case where meterId might be a single value or a list
-            meter_list_data = dict_data.get('meterPropertyAssociationList', {}).get('energyMeterAssociation', {}).get('meters', {})
-            if not meter_list_data:
-                print(f"No meter data found for espmid {espmid}")
-                continue
-            
-            meter_ids = meter_list_data.get('meterId')
-            if meter_ids is None:
-                print(f"No meterId found for espmid {espmid}")
-                continue
-            
-            # Normalize to list: if it's a single value, make it a list
-            if isinstance(meter_ids, list):
-                meter_id_list = meter_ids
-            else:
-                meter_id_list = [meter_ids]
-            
-            watermeter_list_data = dict_data.get('meterPropertyAssociationList', {}).get('waterMeterAssociation', {}).get('meters', {})
-            if not watermeter_list_data:
-                print(f"No water meter data found for espmid {espmid}")
-                continue
-            
-            watermeter_ids = watermeter_list_data.get('meterId')
-            if watermeter_ids is None:
-                print(f"No water meterId found for espmid {espmid}")
-                continue
-            
-            # Normalize to list: if it's a single value, make it a list
-            if isinstance(watermeter_ids, list):
-                watermeter_id_list = meter_ids
-            else:
-                watermeter_id_list = [meter_ids]
-
-            for meter in meter_id_list:
-                try:
-                    response = requests.get(f'https://portfoliomanager.energystar.gov/ws/meter/{meter}', auth=HTTPBasicAuth(user, pw), timeout=60)  
-                    dict_data = xmltodict.parse(response.content)
-                    #Meter Data
-                    # Check if 'meter' key exists in the response
-                    if 'meter' not in dict_data:
-                        print(f"Warning: 'meter' key not found in response for meter ID {meter}")
-                        print(f'ESPM ID of affected meter{espmid}')
-                        print(f"Response keys: {list(dict_data.keys())}")
-                        continue
-                    if dict_data['meter'].get('inUse')=="False":
-                        
-                       continue 
-                    if dict_data['meter'].get('type') == 'Natural Gas':
-                        print("it's gas")
-                        meter_id = dict_data['meter'].get('id')
-                        if not meter_id:
-                            print(f"Warning: No meter ID found for meter {meter}")
-                            continue
-                        response = requests.get(f'https://portfoliomanager.energystar.gov/ws/meter/{meter_id}/consumptionData?startDate=2020-01-01',auth=HTTPBasicAuth(user, pw), timeout=60)
-                        d = xmltodict.parse(response.content)
-                        
-                        # Handle case where meterConsumption might be a single dict or a list
-                        meter_consumption = d.get('meterData', {}).get('meterConsumption')
-                        if meter_consumption is None:
-                            print(f"No consumption data found for meter {meter}")
-                            continue
-                        
-                        # Normalize to list: if it's a dict, make it a list with one item
-                        if isinstance(meter_consumption, dict):
-                            consumption_list = [meter_consumption]
-                        elif isinstance(meter_consumption, list):
-                            consumption_list = meter_consumption
-                        else:
-                            print(f"Unexpected data type for meterConsumption: {type(meter_consumption)}")
-                            continue
-                        
-                        for entry in consumption_list:
-                            # Ensure entry is a dictionary
-                            if not isinstance(entry, dict):
-                                print(f"Skipping entry - not a dictionary: {entry}")
-                                continue
-                            
-                            entryid=entry.get('id')
-                            meterid=meter
-                            cost=entry.get('cost',0)
-                            usage=entry.get('usage')
-                            startdate_str=entry.get('startDate')
-                            enddate_str=entry.get('endDate')
-                            
-                            # Convert date strings to datetime objects for smalldatetime
-                            startdate = None
-                            enddate = None
-                            
-                            if startdate_str:
-                                try:
-                                    # Parse ISO format date (YYYY-MM-DD) to datetime
-                                    startdate_dt = datetime.datetime.strptime(startdate_str, '%Y-%m-%d')
-                                    # Round to nearest minute (smalldatetime precision) and ensure valid range
-                                    startdate_dt = startdate_dt.replace(second=0, microsecond=0)
-                                    # Check if within smalldatetime range (1900-01-01 to 2079-06-06)
-                                    if startdate_dt >= datetime.datetime(1900, 1, 1) and startdate_dt <= datetime.datetime(2079, 6, 6, 23, 59):
-                                        startdate = startdate_dt
-                                    else:
-                                        print(f"Warning: startdate {startdate_str} is outside smalldatetime range")
-                                except ValueError as e:
-                                    print(f"Warning: Could not parse startdate {startdate_str}: {e}")
-                            
-                            if enddate_str:
-                                try:
-                                    # Parse ISO format date (YYYY-MM-DD) to datetime
-                                    enddate_dt = datetime.datetime.strptime(enddate_str, '%Y-%m-%d')
-                                    # Round to nearest minute (smalldatetime precision) and ensure valid range
-                                    enddate_dt = enddate_dt.replace(second=0, microsecond=0)
-                                    # Check if within smalldatetime range (1900-01-01 to 2079-06-06)
-                                    if enddate_dt >= datetime.datetime(1900, 1, 1) and enddate_dt <= datetime.datetime(2079, 6, 6, 23, 59):
-                                        enddate = enddate_dt
-                                    else:
-                                        print(f"Warning: enddate {enddate_str} is outside smalldatetime range")
-                                except ValueError as e:
-                                    print(f"Warning: Could not parse enddate {enddate_str}: {e}")
-                            
-                            # Create a unique entryid by combining meterid and entryid to prevent duplicates
-                            # This ensures uniqueness across different meters that might have the same entryid
-                            if entryid and meterid:
-                                unique_entryid = f"{meterid}_{entryid}"
-                            elif entryid:
-                                # If we have entryid but no meterid, still use entryid but add espmid for uniqueness
-                                unique_entryid = f"{espmid}_{entryid}"
-                            elif meterid:
-                                # If entryid is None, create one using meterid and dates
-                                if startdate_str and enddate_str:
-                                    unique_entryid = f"{meterid}_{startdate_str}_{enddate_str}"
-                                elif startdate_str:
-                                    unique_entryid = f"{meterid}_{startdate_str}"
-                                else:
-                                    # Fallback: use meterid, espmid, and index to ensure uniqueness
-                                    unique_entryid = f"{meterid}_{espmid}_{len(gasdata)}"
-
-                            
-                            gasdata.append({
-                                'espmid': espmid,
-                                'entryid': unique_entryid,
-                                'meterid': str(meterid) if meterid else None,
-                                'cost': str(cost) if cost else None,
-                                'usage': str(usage) if usage else None,
-                                'startdate': startdate,
-                                'enddate': enddate,
-                            })
-                    elif dict_data['meter'].get('type') == 'Electric':
-                        print("it's electric")
-                        meter_id = dict_data['meter'].get('id')
-                        if not meter_id:
-                            print(f"Warning: No meter ID found for meter {meter}")
-                            continue
-                        response = requests.get(f'https://portfoliomanager.energystar.gov/ws/meter/{meter_id}/consumptionData?startDate=2020-01-01',auth=HTTPBasicAuth(user, pw), timeout=60)
-                        d = xmltodict.parse(response.content)
-                        
-                        # Handle case where meterConsumption might be a single dict or a list
-                        meter_consumption = d.get('meterData', {}).get('meterConsumption')
-                        if meter_consumption is None:
-                            print(f"No consumption data found for meter {meter}")
-                            continue
-                        
-                        # Normalize to list: if it's a dict, make it a list with one item
-                        if isinstance(meter_consumption, dict):
-                            consumption_list = [meter_consumption]
-                        elif isinstance(meter_consumption, list):
-                            consumption_list = meter_consumption
-                        else:
-                            print(f"Unexpected data type for meterConsumption: {type(meter_consumption)}")
-                            continue
-                        
-                        for entry in consumption_list:
-                            # Ensure entry is a dictionary
-                            if not isinstance(entry, dict):
-                                print(f"Skipping entry - not a dictionary: {entry}")
-                                continue
-                            
-                            entryid=entry.get('id')
-                            meterid=meter
-                            cost=entry.get('cost',0)
-                            usage=entry.get('usage')
-                            startdate_str=entry.get('startDate')
-                            enddate_str=entry.get('endDate')
-                            
-                            # Convert date strings to datetime objects for smalldatetime
-                            startdate = None
-                            enddate = None
-                            
-                            if startdate_str:
-                                try:
-                                    # Parse ISO format date (YYYY-MM-DD) to datetime
-                                    startdate_dt = datetime.datetime.strptime(startdate_str, '%Y-%m-%d')
-                                    # Round to nearest minute (smalldatetime precision) and ensure valid range
-                                    startdate_dt = startdate_dt.replace(second=0, microsecond=0)
-                                    # Check if within smalldatetime range (1900-01-01 to 2079-06-06)
-                                    if startdate_dt >= datetime.datetime(1900, 1, 1) and startdate_dt <= datetime.datetime(2079, 6, 6, 23, 59):
-                                        startdate = startdate_dt
-                                    else:
-                                        print(f"Warning: startdate {startdate_str} is outside smalldatetime range")
-                                except ValueError as e:
-                                    print(f"Warning: Could not parse startdate {startdate_str}: {e}")
-                            
-                            if enddate_str:
-                                try:
-                                    # Parse ISO format date (YYYY-MM-DD) to datetime
-                                    enddate_dt = datetime.datetime.strptime(enddate_str, '%Y-%m-%d')
-                                    # Round to nearest minute (smalldatetime precision) and ensure valid range
-                                    enddate_dt = enddate_dt.replace(second=0, microsecond=0)
-                                    # Check if within smalldatetime range (1900-01-01 to 2079-06-06)
-                                    if enddate_dt >= datetime.datetime(1900, 1, 1) and enddate_dt <= datetime.datetime(2079, 6, 6, 23, 59):
-                                        enddate = enddate_dt
-                                    else:
-                                        print(f"Warning: enddate {enddate_str} is outside smalldatetime range")
-                                except ValueError as e:
-                                    print(f"Warning: Could not parse enddate {enddate_str}: {e}")
-                            
-                            # Create a unique entryid by combining meterid and entryid to prevent duplicates
-                            # This ensures uniqueness across different meters that might have the same entryid
-                            if entryid and meterid:
-                                unique_entryid = f"{meterid}_{entryid}"
-                            elif entryid:
-                                # If we have entryid but no meterid, still use entryid but add espmid for uniqueness
-                                unique_entryid = f"{espmid}_{entryid}"
-                            elif meterid:
-                                # If entryid is None, create one using meterid and dates
-                                if startdate_str and enddate_str:
-                                    unique_entryid = f"{meterid}_{startdate_str}_{enddate_str}"
-                                elif startdate_str:
-                                    unique_entryid = f"{meterid}_{startdate_str}"
-                                else:
-                                    # Fallback: use meterid, espmid, and index to ensure uniqueness
-                                    unique_entryid = f"{meterid}_{espmid}_{len(electricdata)}"
-
-                            
-                            electricdata.append({
-                                'espmid': espmid,
-                                'entryid': unique_entryid,
-                                'meterid': str(meterid) if meterid else None,
-                                'cost': str(cost) if cost else None,
-                                'usage': str(usage) if usage else None,
-                                'startdate': startdate,
-                                'enddate': enddate,
-                            })
-                    elif dict_data['meter'].get('type') == 'Electric on Site Solar':
-                        print("it's solar")
-                        meter_id = dict_data['meter'].get('id')
-                        if not meter_id:
-                            print(f"Warning: No meter ID found for meter {meter}")
-                            continue
-                        response = requests.get(f'https://portfoliomanager.energystar.gov/ws/meter/{meter_id}/consumptionData?startDate=2020-01-01',auth=HTTPBasicAuth(user, pw), timeout=60)
-                        d = xmltodict.parse(response.content)
-                        
-                        # Handle case where meterConsumption might be a single dict or a list
-                        meter_consumption = d.get('meterData', {}).get('meterConsumption')
-                        if meter_consumption is None:
-                            print(f"No consumption data found for meter {meter}")
-                            continue
-                        
-                        # Normalize to list: if it's a dict, make it a list with one item
-                        if isinstance(meter_consumption, dict):
-                            consumption_list = [meter_consumption]
-                        elif isinstance(meter_consumption, list):
-                            consumption_list = meter_consumption
-                        else:
-                            print(f"Unexpected data type for meterConsumption: {type(meter_consumption)}")
-                            continue
-                        
-                        for entry in consumption_list:
-                            # Ensure entry is a dictionary
-                            if not isinstance(entry, dict):
-                                print(f"Skipping entry - not a dictionary: {entry}")
-                                continue
-                            
-                            entryid=entry.get('id')
-                            meterid=meter
-                            cost=entry.get('cost',0)
-                            usage=entry.get('usage')
-                            startdate_str=entry.get('startDate')
-                            enddate_str=entry.get('endDate')
-                            
-                            # Convert date strings to datetime objects for smalldatetime
-                            startdate = None
-                            enddate = None
-                            
-                            if startdate_str:
-                                try:
-                                    # Parse ISO format date (YYYY-MM-DD) to datetime
-                                    startdate_dt = datetime.datetime.strptime(startdate_str, '%Y-%m-%d')
-                                    # Round to nearest minute (smalldatetime precision) and ensure valid range
-                                    startdate_dt = startdate_dt.replace(second=0, microsecond=0)
-                                    # Check if within smalldatetime range (1900-01-01 to 2079-06-06)
-                                    if startdate_dt >= datetime.datetime(1900, 1, 1) and startdate_dt <= datetime.datetime(2079, 6, 6, 23, 59):
-                                        startdate = startdate_dt
-                                    else:
-                                        print(f"Warning: startdate {startdate_str} is outside smalldatetime range")
-                                except ValueError as e:
-                                    print(f"Warning: Could not parse startdate {startdate_str}: {e}")
-                            
-                            if enddate_str:
-                                try:
-                                    # Parse ISO format date (YYYY-MM-DD) to datetime
-                                    enddate_dt = datetime.datetime.strptime(enddate_str, '%Y-%m-%d')
-                                    # Round to nearest minute (smalldatetime precision) and ensure valid range
-                                    enddate_dt = enddate_dt.replace(second=0, microsecond=0)
-                                    # Check if within smalldatetime range (1900-01-01 to 2079-06-06)
-                                    if enddate_dt >= datetime.datetime(1900, 1, 1) and enddate_dt <= datetime.datetime(2079, 6, 6, 23, 59):
-                                        enddate = enddate_dt
-                                    else:
-                                        print(f"Warning: enddate {enddate_str} is outside smalldatetime range")
-                                except ValueError as e:
-                                    print(f"Warning: Could not parse enddate {enddate_str}: {e}")
-                            
-                            # Create a unique entryid by combining meterid and entryid to prevent duplicates
-                            # This ensures uniqueness across different meters that might have the same entryid
-                            if entryid and meterid:
-                                unique_entryid = f"{meterid}_{entryid}"
-                            elif entryid:
-                                # If we have entryid but no meterid, still use entryid but add espmid for uniqueness
-                                unique_entryid = f"{espmid}_{entryid}"
-                            elif meterid:
-                                # If entryid is None, create one using meterid and dates
-                                if startdate_str and enddate_str:
-                                    unique_entryid = f"{meterid}_{startdate_str}_{enddate_str}"
-                                elif startdate_str:
-                                    unique_entryid = f"{meterid}_{startdate_str}"
-                                else:
-                                    # Fallback: use meterid, espmid, and index to ensure uniqueness
-                                    unique_entryid = f"{meterid}_{espmid}_{len(solardata)}"
-
-                            
-                            solardata.append({
-                                'espmid': espmid,
-                                'entryid': unique_entryid,
-                                'meterid': str(meterid) if meterid else None,
-                                'cost': str(cost) if cost else None,
-                                'usage': str(usage) if usage else None,
-                                'startdate': startdate,
-                                'enddate': enddate,
-                            })
-                except Exception as meter_error:
-                    print(f"Error processing meter {meter} for espmid {espmid}: {meter_error}")
-                    continue
-        except Exception as espmid_error:
-            print(f"Error processing espmid {espmid}: {espmid_error}")
-            continue
-    for meter in watermeter_id_list:
-                try:
-                    response = requests.get(f'https://portfoliomanager.energystar.gov/ws/meter/{meter}', auth=HTTPBasicAuth(user, pw), timeout=60)  
-                    dict_data = xmltodict.parse(response.content)
-                    #Meter Data
-                    # Check if 'meter' key exists in the response
-                    if 'meter' not in dict_data:
-                        print(f"Warning: 'meter' key not found in response for meter ID {meter}")
-                        print(f'ESPM ID of affected meter{espmid}')
-                        print(f"Response keys: {list(dict_data.keys())}")
-                        continue
-                    if dict_data['meter'].get('inUse')=="False":
-                        
-                       continue 
-                    meter_id = dict_data['meter'].get('id')
-                    if not meter_id:
-                        print(f"Warning: No meter ID found for meter {meter}")
-                        continue
-                    response = requests.get(f'https://portfoliomanager.energystar.gov/ws/meter/{meter_id}/consumptionData?startDate=2020-01-01',auth=HTTPBasicAuth(user, pw), timeout=60)
-                    d = xmltodict.parse(response.content)
-                    
-                    # Handle case where meterConsumption might be a single dict or a list
-                    meter_consumption = d.get('meterData', {}).get('meterConsumption')
-                    if meter_consumption is None:
-                        print(f"No consumption data found for meter {meter}")
-                        continue
-                    
-                    # Normalize to list: if it's a dict, make it a list with one item
-                    if isinstance(meter_consumption, dict):
-                        consumption_list = [meter_consumption]
-                    elif isinstance(meter_consumption, list):
-                        consumption_list = meter_consumption
-                    else:
-                        print(f"Unexpected data type for meterConsumption: {type(meter_consumption)}")
-                        continue
-                    
-                    for entry in consumption_list:
-                        # Ensure entry is a dictionary
-                        if not isinstance(entry, dict):
-                            print(f"Skipping entry - not a dictionary: {entry}")
-                            continue
-                        
-                        entryid=entry.get('id')
-                        meterid=meter
-                        cost=entry.get('cost',0)
-                        usage=entry.get('usage')
-                        startdate_str=entry.get('startDate')
-                        enddate_str=entry.get('endDate')
-                        
-                        # Convert date strings to datetime objects for smalldatetime
-                        startdate = None
-                        enddate = None
-                        
-                        if startdate_str:
-                            try:
-                                # Parse ISO format date (YYYY-MM-DD) to datetime
-                                startdate_dt = datetime.datetime.strptime(startdate_str, '%Y-%m-%d')
-                                # Round to nearest minute (smalldatetime precision) and ensure valid range
-                                startdate_dt = startdate_dt.replace(second=0, microsecond=0)
-                                # Check if within smalldatetime range (1900-01-01 to 2079-06-06)
-                                if startdate_dt >= datetime.datetime(1900, 1, 1) and startdate_dt <= datetime.datetime(2079, 6, 6, 23, 59):
-                                    startdate = startdate_dt
-                                else:
-                                    print(f"Warning: startdate {startdate_str} is outside smalldatetime range")
-                            except ValueError as e:
-                                print(f"Warning: Could not parse startdate {startdate_str}: {e}")
-                        
-                        if enddate_str:
-                            try:
-                                # Parse ISO format date (YYYY-MM-DD) to datetime
-                                enddate_dt = datetime.datetime.strptime(enddate_str, '%Y-%m-%d')
-                                # Round to nearest minute (smalldatetime precision) and ensure valid range
-                                enddate_dt = enddate_dt.replace(second=0, microsecond=0)
-                                # Check if within smalldatetime range (1900-01-01 to 2079-06-06)
-                                if enddate_dt >= datetime.datetime(1900, 1, 1) and enddate_dt <= datetime.datetime(2079, 6, 6, 23, 59):
-                                    enddate = enddate_dt
-                                else:
-                                    print(f"Warning: enddate {enddate_str} is outside smalldatetime range")
-                            except ValueError as e:
-                                print(f"Warning: Could not parse enddate {enddate_str}: {e}")
-                        
-                        # Create a unique entryid by combining meterid and entryid to prevent duplicates
-                        # This ensures uniqueness across different meters that might have the same entryid
-                        if entryid and meterid:
-                            unique_entryid = f"{meterid}_{entryid}"
-                        elif entryid:
-                            # If we have entryid but no meterid, still use entryid but add espmid for uniqueness
-                            unique_entryid = f"{espmid}_{entryid}"
-                        elif meterid:
-                            # If entryid is None, create one using meterid and dates
-                            if startdate_str and enddate_str:
-                                unique_entryid = f"{meterid}_{startdate_str}_{enddate_str}"
-                            elif startdate_str:
-                                unique_entryid = f"{meterid}_{startdate_str}"
-                            else:
-                                # Fallback: use meterid, espmid, and index to ensure uniqueness
-                                unique_entryid = f"{meterid}_{espmid}_{len(gasdata)}"
-
-                        
-                        gasdata.append({
-                            'espmid': espmid,
-                            'entryid': unique_entryid,
-                            'meterid': str(meterid) if meterid else None,
-                            'cost': str(cost) if cost else None,
-                            'usage': str(usage) if usage else None,
-                            'startdate': startdate,
-                            'enddate': enddate,
-                        })
-                except Exception as meter_error:
-                    print(f"Error processing meter {meter} for espmid {espmid}: {meter_error}")
-                    continue
-    # Ensure naturalgas table exists and has correct column sizes
-    # First, check if table exists and alter entryid column size if needed
-    # Check connection first
-    connection, cursor = check_and_reconnect()
+    # Only ask ESPM for bills after what is already stored, unless --full-resync was given
+    if FULL_RESYNC:
+        meter_high_water_marks = {}
+        stored_row_hashes = {}
+        print("Full resync requested: pulling consumption from 2020-01-01 for every meter.")
+    else:
+        meter_high_water_marks = load_meter_high_water_marks()
+        print(f"Loaded high-water marks for {len(meter_high_water_marks)} meters ({SYNC_OVERLAP_DAYS} day overlap).")
+        # A full resync refetches everything, so it leans on the MERGE's hash check alone
+        stored_row_hashes = load_stored_row_hashes()
+        print(f"Loaded {sum(len(hashes) for hashes in stored_row_hashes.values())} stored row hashes.")
+    meter_catalog = load_meter_catalog()
+    print(f"Loaded {len(meter_catalog)} meters from metercatalog (refreshed within {METER_REFRESH_DAYS} days).")
+    # The reads above may have reconnected db; keep connection/cursor on its live handles
+    connection, cursor = db.connection, db.cursor
+    # Rows stream from the fetch workers through row_queue to one writer thread per table,
+    # each MERGEing every WRITE_BATCH_ROWS rows on its own connection while ESPM requests are still in flight.
+    writer_summary = {table_name: {'rows': 0, 'batches': 0, 'affected': 0, 'duplicates': 0, 'unchanged': 0, 'seconds': 0.0} for table_name in CONSUMPTION_TABLES}
+    writer_errors = []
+    writer = threading.Thread(target=consumption_writer, args=(WRITE_BATCH_ROWS, writer_summary, writer_errors), name="consumption-writer")
+    writer.start()
+    pending_idlist = [espmid for espmid in idlist if not journal.property_done(espmid)]
+    if len(pending_idlist) < len(idlist):
+        print(f"Skipping {len(idlist) - len(pending_idlist)} properties already written in this run.")
     try:
-        # Try to alter the entryid column to be larger (if table exists)
-        cursor.execute("ALTER TABLE naturalgas ALTER COLUMN entryid NVARCHAR(100)")
-        try:
-            connection.commit()
-        except pyodbc.Error as commit_error:
-            if 'communication link failure' in str(commit_error).lower() or '08S01' in str(commit_error):
-                connection, cursor = check_and_reconnect()
-                connection.commit()
-            else:
-                raise
-        print("Updated 'entryid' column size in naturalgas table.")
-    except pyodbc.Error as alter_error:
-        error_str = str(alter_error).lower()
-        if "does not exist" in error_str or "invalid object" in error_str:
-            # Table doesn't exist, create it
-            try:
-                cursor.execute("""
-                    CREATE TABLE naturalgas (
-                        entryid NVARCHAR(100) PRIMARY KEY,
-                        espmid INT,
-                        meterid NVARCHAR(100),
-                        cost NVARCHAR(100),
-                        usage NVARCHAR(100),
-                        startdate SMALLDATETIME,
-                        enddate SMALLDATETIME
-                    )
-                """)
-                try:
-                    connection.commit()
-                except pyodbc.Error as commit_error:
-                    if 'communication link failure' in str(commit_error).lower() or '08S01' in str(commit_error):
-                        connection, cursor = check_and_reconnect()
-                        connection.commit()
-                    else:
-                        raise
-                print("Table 'naturalgas' created successfully!")
-            except pyodbc.Error as create_error:
-                try:
-                    connection.rollback()
-                except:
-                    pass
-                print(f"Error creating naturalgas table: {create_error}")
+        if REPLAY_RUN:
+            replay_consumption()
         else:
-            # Column might already be the right size, or other error
-            connection.rollback()
-            # Try to create table if it doesn't exist (in case of different error)
-            try:
-                cursor.execute("""
-                    CREATE TABLE naturalgas (
-                        entryid NVARCHAR(100) PRIMARY KEY,
-                        espmid INT,
-                        meterid NVARCHAR(100),
-                        cost NVARCHAR(100),
-                        usage NVARCHAR(100),
-                        startdate SMALLDATETIME,
-                        enddate SMALLDATETIME
-                    )
-                """)
-                try:
-                    connection.commit()
-                except pyodbc.Error as commit_error:
-                    if 'communication link failure' in str(commit_error).lower() or '08S01' in str(commit_error):
-                        connection, cursor = check_and_reconnect()
-                        connection.commit()
-                    else:
-                        raise
-                print("Table 'naturalgas' created successfully!")
-            except pyodbc.Error:
-                try:
-                    connection.rollback()
-                except:
-                    pass
-                # Table likely exists with wrong column size, let's try to fix it
-                pass
-    
-    # Ensure electric table exists and has correct column sizes
-    connection, cursor = check_and_reconnect()
+            # Each property's association, meter and consumption calls run on a worker thread
+            with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+                list(executor.map(fetch_property_consumption, pending_idlist))
+    finally:
+        # Tell the writer there is nothing more coming and wait for its last flush
+        row_queue.put(None)
+        writer.join()
+    if writer_errors:
+        raise writer_errors[0]
+    # Older runs appended the last property's energy bills to naturalgas under their own
+    # meter ids. metercatalog now has the type of every meter loaded above, so those rows are
+    # found through it; once they are gone this is an index seek per non-gas meter.
+    gas_meter_types = [meter_type for meter_type, table_name in METER_TYPE_TABLES.items() if table_name == 'naturalgas']
     try:
-        # Try to alter the entryid column to be larger (if table exists)
-        cursor.execute("ALTER TABLE electric ALTER COLUMN entryid NVARCHAR(100)")
+        connection, cursor = db.ensure_alive()
+        cursor.execute(f"""
+            DELETE n
+            FROM naturalgas n
+            JOIN metercatalog m ON m.meterid = n.meterid
+            WHERE m.type NOT IN ({', '.join('?' for _ in gas_meter_types)})
+        """, gas_meter_types)
+        if cursor.rowcount and cursor.rowcount > 0:
+            print(f"Removed {cursor.rowcount} misfiled non-gas rows from naturalgas.")
+        connection.commit()
+    except pyodbc.Error as e:
+        print(f"Could not remove misfiled rows from naturalgas: {e}")
         try:
-            connection.commit()
-        except pyodbc.Error as commit_error:
-            if 'communication link failure' in str(commit_error).lower() or '08S01' in str(commit_error):
-                connection, cursor = check_and_reconnect()
-                connection.commit()
-            else:
-                raise
-        print("Updated 'entryid' column size in electric table.")
-    except pyodbc.Error as alter_error:
-        error_str = str(alter_error).lower()
-        if "does not exist" in error_str or "invalid object" in error_str:
-            # Table doesn't exist, create it
-            try:
-                cursor.execute("""
-                    CREATE TABLE electric (
-                        entryid NVARCHAR(100) PRIMARY KEY,
-                        espmid INT,
-                        meterid NVARCHAR(100),
-                        cost NVARCHAR(100),
-                        usage NVARCHAR(100),
-                        startdate SMALLDATETIME,
-                        enddate SMALLDATETIME
-                    )
-                """)
-                try:
-                    connection.commit()
-                except pyodbc.Error as commit_error:
-                    if 'communication link failure' in str(commit_error).lower() or '08S01' in str(commit_error):
-                        connection, cursor = check_and_reconnect()
-                        connection.commit()
-                    else:
-                        raise
-                print("Table 'electric' created successfully!")
-            except pyodbc.Error as create_error:
-                try:
-                    connection.rollback()
-                except:
-                    pass
-                print(f"Error creating electric table: {create_error}")
-        else:
-            # Column might already be the right size, or other error
             connection.rollback()
-            # Try to create table if it doesn't exist (in case of different error)
-            try:
-                cursor.execute("""
-                    CREATE TABLE electric (
-                        entryid NVARCHAR(100) PRIMARY KEY,
-                        espmid INT,
-                        meterid NVARCHAR(100),
-                        cost NVARCHAR(100),
-                        usage NVARCHAR(100),
-                        startdate SMALLDATETIME,
-                        enddate SMALLDATETIME
-                    )
-                """)
-                try:
-                    connection.commit()
-                except pyodbc.Error as commit_error:
-                    if 'communication link failure' in str(commit_error).lower() or '08S01' in str(commit_error):
-                        connection, cursor = check_and_reconnect()
-                        connection.commit()
-                    else:
-                        raise
-                print("Table 'electric' created successfully!")
-            except pyodbc.Error:
-                try:
-                    connection.rollback()
-                except:
-                    pass
-                # Table likely exists with wrong column size, let's try to fix it
-                pass
-    
-    # Ensure solar table exists and has correct column sizes
-    connection, cursor = check_and_reconnect()
-    try:
-        # Try to alter the entryid column to be larger (if table exists)
-        cursor.execute("ALTER TABLE solar ALTER COLUMN entryid NVARCHAR(100)")
-        try:
-            connection.commit()
-        except pyodbc.Error as commit_error:
-            if 'communication link failure' in str(commit_error).lower() or '08S01' in str(commit_error):
-                connection, cursor = check_and_reconnect()
-                connection.commit()
-            else:
-                raise
-        print("Updated 'entryid' column size in solar table.")
-    except pyodbc.Error as alter_error:
-        error_str = str(alter_error).lower()
-        if "does not exist" in error_str or "invalid object" in error_str:
-            # Table doesn't exist, create it
-            try:
-                cursor.execute("""
-                    CREATE TABLE solar (
-                        entryid NVARCHAR(100) PRIMARY KEY,
-                        espmid INT,
-                        meterid NVARCHAR(100),
-                        cost NVARCHAR(100),
-                        usage NVARCHAR(100),
-                        startdate SMALLDATETIME,
-                        enddate SMALLDATETIME
-                    )
-                """)
-                try:
-                    connection.commit()
-                except pyodbc.Error as commit_error:
-                    if 'communication link failure' in str(commit_error).lower() or '08S01' in str(commit_error):
-                        connection, cursor = check_and_reconnect()
-                        connection.commit()
-                    else:
-                        raise
-                print("Table 'solar' created successfully!")
-            except pyodbc.Error as create_error:
-                try:
-                    connection.rollback()
-                except:
-                    pass
-                print(f"Error creating solar table: {create_error}")
+        except:
+            pass
+    for table_name in CONSUMPTION_TABLES:
+        stats = writer_summary[table_name]
+        if stats['rows'] or stats['duplicates'] or stats['unchanged']:
+            print(f"{table_name}: {stats['rows']} rows in {stats['batches']} batches, {stats['affected']} inserted or updated, {stats['unchanged']} unchanged, {stats['duplicates']} duplicates skipped, {stats['seconds']:.1f}s in MERGE.")
         else:
-            # Column might already be the right size, or other error
-            connection.rollback()
-            # Try to create table if it doesn't exist (in case of different error)
-            try:
-                cursor.execute("""
-                    CREATE TABLE solar (
-                        entryid NVARCHAR(100) PRIMARY KEY,
-                        espmid INT,
-                        meterid NVARCHAR(100),
-                        cost NVARCHAR(100),
-                        usage NVARCHAR(100),
-                        startdate SMALLDATETIME,
-                        enddate SMALLDATETIME
-                    )
-                """)
-                try:
-                    connection.commit()
-                except pyodbc.Error as commit_error:
-                    if 'communication link failure' in str(commit_error).lower() or '08S01' in str(commit_error):
-                        connection, cursor = check_and_reconnect()
-                        connection.commit()
-                    else:
-                        raise
-                print("Table 'solar' created successfully!")
-            except pyodbc.Error:
-                try:
-                    connection.rollback()
-                except:
-                    pass
-                # Table likely exists with wrong column size, let's try to fix it
-                pass
-    
-    # Insert gas data into database
-    if gasdata:
-        # Remove duplicates based on entryid before processing
-        # Keep only the first occurrence of each unique entryid
-        seen_entryids = set()
-        unique_gasdata = []
-        duplicates_removed = 0
-        for gas in gasdata:
-            entryid = gas.get('entryid')
-            if entryid and entryid not in seen_entryids:
-                seen_entryids.add(entryid)
-                unique_gasdata.append(gas)
-            elif not entryid:
-                # Skip entries with None entryid (shouldn't happen with our fix, but just in case)
-                duplicates_removed += 1
-                print(f"Warning: Found entry with None entryid, skipping. Meter: {gas.get('meterid')}, ESPMID: {gas.get('espmid')}")
-            else:
-                duplicates_removed += 1
-                print(f"Warning: Duplicate entryid found: {entryid}. Skipping duplicate entry.")
-        
-        if duplicates_removed > 0:
-            print(f"Removed {duplicates_removed} duplicate entries from gasdata.")
-        
-        gasdata = unique_gasdata
-        
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                # Check connection before starting
-                connection, cursor = check_and_reconnect()
-                try:
-                    cursor.execute("DROP TABLE #TempGasData")
-                except:
-                    pass
-                # Create temporary table with all gas data
-                cursor.execute("""
-                    CREATE TABLE #TempGasData (
-                        entryid NVARCHAR(100) PRIMARY KEY,
-                        espmid INT,
-                        meterid NVARCHAR(100),
-                        cost NVARCHAR(100),
-                        usage NVARCHAR(100),
-                        startdate SMALLDATETIME,
-                        enddate SMALLDATETIME
-                    )
-                """)
-                
-                # Insert all gas data into temp table in batches to avoid long transactions
-                temp_insert_query = """
-                    INSERT INTO #TempGasData (entryid, espmid, meterid, cost, usage, startdate, enddate) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """
-                insert_data = [
-                    (
-                        gas['entryid'],
-                        gas['espmid'],
-                        gas['meterid'],
-                        gas['cost'],
-                        gas['usage'],
-                        gas['startdate'],
-                        gas['enddate']
-                    )
-                    for gas in gasdata
-                ]
-                
-                # Insert in batches of 1000 to reduce transaction time
-                batch_size = 1000
-                for i in range(0, len(insert_data), batch_size):
-                    batch = insert_data[i:i + batch_size]
-                    cursor.executemany(temp_insert_query, batch)
-                
-                # Use MERGE to insert or update gas data
-                merge_query = """
-                    MERGE naturalgas AS target
-                    USING #TempGasData AS source
-                    ON target.entryid = source.entryid
-                    WHEN MATCHED AND (
-                        ISNULL(target.espmid, 0) <> ISNULL(source.espmid, 0) OR
-                        ISNULL(target.meterid, '') <> ISNULL(source.meterid, '') OR
-                        ISNULL(target.cost, '') <> ISNULL(source.cost, '') OR
-                        ISNULL(target.usage, '') <> ISNULL(source.usage, '') OR
-                        target.startdate <> source.startdate OR
-                        target.enddate <> source.enddate
-                    ) THEN
-                        UPDATE SET
-                            espmid = source.espmid,
-                            meterid = source.meterid,
-                            cost = source.cost,
-                            usage = source.usage,
-                            startdate = source.startdate,
-                            enddate = source.enddate
-                    WHEN NOT MATCHED THEN
-                        INSERT (entryid, espmid, meterid, cost, usage, startdate, enddate)
-                        VALUES (source.entryid, source.espmid, source.meterid, source.cost, source.usage, source.startdate, source.enddate);
-                """
-                cursor.execute(merge_query)
-                
-                # Get count of affected rows
-                cursor.execute("SELECT @@ROWCOUNT")
-                rows_affected = cursor.fetchone()[0]
-                
-                # Commit with retry
-                try:
-                    connection.commit()
-                except pyodbc.Error as commit_error:
-                    error_str = str(commit_error).lower()
-                    if 'communication link failure' in error_str or '08S01' in str(commit_error):
-                        connection, cursor = check_and_reconnect()
-                        # Retry commit
-                        connection.commit()
-                    else:
-                        raise
-                
-                # Drop temp table
-                try:
-                    cursor.execute("DROP TABLE #TempGasData")
-                except:
-                    pass
-                
-                print(f"Successfully processed {rows_affected} rows in naturalgas table.")
-                break  # Success, exit retry loop
-                
-            except pyodbc.Error as e:
-                error_str = str(e).lower()
-                # Ensure temp table is cleaned up
-                try:
-                    cursor.execute("DROP TABLE #TempGasData")
-                except:
-                    pass
-                
-                # Check if it's a connection error
-                if ('communication link failure' in error_str or '08S01' in str(e) or 
-                    'connection' in error_str or 'timeout' in error_str):
-                    if attempt < max_retries - 1:
-                        wait_time = 2 ** attempt
-                        print(f"Connection error during gas data insertion. Retrying in {wait_time} seconds... (attempt {attempt + 1}/{max_retries})")
-                        time.sleep(wait_time)
-                        # Reconnect for next attempt
-                        try:
-                            connection.rollback()
-                        except:
-                            pass
-                        connection, cursor = check_and_reconnect()
-                        continue
-                    else:
-                        print(f"Error updating gas data after {max_retries} attempts: {e}")
-                        try:
-                            connection.rollback()
-                        except:
-                            pass
-                        raise
-                else:
-                    # Not a connection error, re-raise immediately
-                    print(f"Error updating gas data: {e}")
-                    try:
-                        connection.rollback()
-                    except:
-                        pass
-                    raise
-    else:
-        print("No gas data to insert.")
-    
-    # Insert electric data into database
-    if electricdata:
-        # Remove duplicates based on entryid before processing
-        # Keep only the first occurrence of each unique entryid
-        seen_entryids = set()
-        unique_electricdata = []
-        duplicates_removed = 0
-        for electric in electricdata:
-            entryid = electric.get('entryid')
-            if entryid and entryid not in seen_entryids:
-                seen_entryids.add(entryid)
-                unique_electricdata.append(electric)
-            elif not entryid:
-                # Skip entries with None entryid (shouldn't happen with our fix, but just in case)
-                duplicates_removed += 1
-                print(f"Warning: Found entry with None entryid, skipping. Meter: {electric.get('meterid')}, ESPMID: {electric.get('espmid')}")
-            else:
-                duplicates_removed += 1
-                print(f"Warning: Duplicate entryid found: {entryid}. Skipping duplicate entry.")
-        
-        if duplicates_removed > 0:
-            print(f"Removed {duplicates_removed} duplicate entries from electricdata.")
-        
-        electricdata = unique_electricdata
-        
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                # Check connection before starting
-                connection, cursor = check_and_reconnect()
-                try:
-                    cursor.execute("DROP TABLE #TempElectricData")
-                except:
-                    pass
-                # Create temporary table with all electric data
-                cursor.execute("""
-                    CREATE TABLE #TempElectricData (
-                        entryid NVARCHAR(100) PRIMARY KEY,
-                        espmid INT,
-                        meterid NVARCHAR(100),
-                        cost NVARCHAR(100),
-                        usage NVARCHAR(100),
-                        startdate SMALLDATETIME,
-                        enddate SMALLDATETIME
-                    )
-                """)
-                
-                # Insert all electric data into temp table in batches to avoid long transactions
-                temp_insert_query = """
-                    INSERT INTO #TempElectricData (entryid, espmid, meterid, cost, usage, startdate, enddate) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """
-                insert_data = [
-                    (
-                        electric['entryid'],
-                        electric['espmid'],
-                        electric['meterid'],
-                        electric['cost'],
-                        electric['usage'],
-                        electric['startdate'],
-                        electric['enddate']
-                    )
-                    for electric in electricdata
-                ]
-                
-                # Insert in batches of 1000 to reduce transaction time
-                batch_size = 1000
-                for i in range(0, len(insert_data), batch_size):
-                    batch = insert_data[i:i + batch_size]
-                    cursor.executemany(temp_insert_query, batch)
-                
-                # Use MERGE to insert or update electric data
-                merge_query = """
-                    MERGE electric AS target
-                    USING #TempElectricData AS source
-                    ON target.entryid = source.entryid
-                    WHEN MATCHED AND (
-                        ISNULL(target.espmid, 0) <> ISNULL(source.espmid, 0) OR
-                        ISNULL(target.meterid, '') <> ISNULL(source.meterid, '') OR
-                        ISNULL(target.cost, '') <> ISNULL(source.cost, '') OR
-                        ISNULL(target.usage, '') <> ISNULL(source.usage, '') OR
-                        target.startdate <> source.startdate OR
-                        target.enddate <> source.enddate
-                    ) THEN
-                        UPDATE SET
-                            espmid = source.espmid,
-                            meterid = source.meterid,
-                            cost = source.cost,
-                            usage = source.usage,
-                            startdate = source.startdate,
-                            enddate = source.enddate
-                    WHEN NOT MATCHED THEN
-                        INSERT (entryid, espmid, meterid, cost, usage, startdate, enddate)
-                        VALUES (source.entryid, source.espmid, source.meterid, source.cost, source.usage, source.startdate, source.enddate);
-                """
-                cursor.execute(merge_query)
-                
-                # Get count of affected rows
-                cursor.execute("SELECT @@ROWCOUNT")
-                rows_affected = cursor.fetchone()[0]
-                
-                # Commit with retry
-                try:
-                    connection.commit()
-                except pyodbc.Error as commit_error:
-                    error_str = str(commit_error).lower()
-                    if 'communication link failure' in error_str or '08S01' in str(commit_error):
-                        connection, cursor = check_and_reconnect()
-                        # Retry commit
-                        connection.commit()
-                    else:
-                        raise
-                
-                # Drop temp table
-                try:
-                    cursor.execute("DROP TABLE #TempElectricData")
-                except:
-                    pass
-                
-                print(f"Successfully processed {rows_affected} rows in electric table.")
-                break  # Success, exit retry loop
-                
-            except pyodbc.Error as e:
-                error_str = str(e).lower()
-                # Ensure temp table is cleaned up
-                try:
-                    cursor.execute("DROP TABLE #TempElectricData")
-                except:
-                    pass
-                
-                # Check if it's a connection error
-                if ('communication link failure' in error_str or '08S01' in str(e) or 
-                    'connection' in error_str or 'timeout' in error_str):
-                    if attempt < max_retries - 1:
-                        wait_time = 2 ** attempt
-                        print(f"Connection error during electric data insertion. Retrying in {wait_time} seconds... (attempt {attempt + 1}/{max_retries})")
-                        time.sleep(wait_time)
-                        # Reconnect for next attempt
-                        try:
-                            connection.rollback()
-                        except:
-                            pass
-                        connection, cursor = check_and_reconnect()
-                        continue
-                    else:
-                        print(f"Error updating electric data after {max_retries} attempts: {e}")
-                        try:
-                            connection.rollback()
-                        except:
-                            pass
-                        raise
-                else:
-                    # Not a connection error, re-raise immediately
-                    print(f"Error updating electric data: {e}")
-                    try:
-                        connection.rollback()
-                    except:
-                        pass
-                    raise
-    else:
-        print("No electric data to insert.")
-    
-    # Insert solar data into database
-    if solardata:
-        # Remove duplicates based on entryid before processing
-        # Keep only the first occurrence of each unique entryid
-        seen_entryids = set()
-        unique_solardata = []
-        duplicates_removed = 0
-        for solar in solardata:
-            entryid = solar.get('entryid')
-            if entryid and entryid not in seen_entryids:
-                seen_entryids.add(entryid)
-                unique_solardata.append(solar)
-            elif not entryid:
-                # Skip entries with None entryid (shouldn't happen with our fix, but just in case)
-                duplicates_removed += 1
-                print(f"Warning: Found entry with None entryid, skipping. Meter: {solar.get('meterid')}, ESPMID: {solar.get('espmid')}")
-            else:
-                duplicates_removed += 1
-                print(f"Warning: Duplicate entryid found: {entryid}. Skipping duplicate entry.")
-        
-        if duplicates_removed > 0:
-            print(f"Removed {duplicates_removed} duplicate entries from solardata.")
-        
-        solardata = unique_solardata
-        
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                # Check connection before starting
-                connection, cursor = check_and_reconnect()
-                try:
-                    cursor.execute("DROP TABLE #TempSolarData")
-                except:
-                    pass
-                # Create temporary table with all solar data
-                cursor.execute("""
-                    CREATE TABLE #TempSolarData (
-                        entryid NVARCHAR(100) PRIMARY KEY,
-                        espmid INT,
-                        meterid NVARCHAR(100),
-                        cost NVARCHAR(100),
-                        usage NVARCHAR(100),
-                        startdate SMALLDATETIME,
-                        enddate SMALLDATETIME
-                    )
-                """)
-                
-                # Insert all solar data into temp table in batches to avoid long transactions
-                temp_insert_query = """
-                    INSERT INTO #TempSolarData (entryid, espmid, meterid, cost, usage, startdate, enddate) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """
-                insert_data = [
-                    (
-                        solar['entryid'],
-                        solar['espmid'],
-                        solar['meterid'],
-                        solar['cost'],
-                        solar['usage'],
-                        solar['startdate'],
-                        solar['enddate']
-                    )
-                    for solar in solardata
-                ]
-                
-                # Insert in batches of 1000 to reduce transaction time
-                batch_size = 1000
-                for i in range(0, len(insert_data), batch_size):
-                    batch = insert_data[i:i + batch_size]
-                    cursor.executemany(temp_insert_query, batch)
-                
-                # Use MERGE to insert or update solar data
-                merge_query = """
-                    MERGE solar AS target
-                    USING #TempSolarData AS source
-                    ON target.entryid = source.entryid
-                    WHEN MATCHED AND (
-                        ISNULL(target.espmid, 0) <> ISNULL(source.espmid, 0) OR
-                        ISNULL(target.meterid, '') <> ISNULL(source.meterid, '') OR
-                        ISNULL(target.cost, '') <> ISNULL(source.cost, '') OR
-                        ISNULL(target.usage, '') <> ISNULL(source.usage, '') OR
-                        target.startdate <> source.startdate OR
-                        target.enddate <> source.enddate
-                    ) THEN
-                        UPDATE SET
-                            espmid = source.espmid,
-                            meterid = source.meterid,
-                            cost = source.cost,
-                            usage = source.usage,
-                            startdate = source.startdate,
-                            enddate = source.enddate
-                    WHEN NOT MATCHED THEN
-                        INSERT (entryid, espmid, meterid, cost, usage, startdate, enddate)
-                        VALUES (source.entryid, source.espmid, source.meterid, source.cost, source.usage, source.startdate, source.enddate);
-                """
-                cursor.execute(merge_query)
-                
-                # Get count of affected rows
-                cursor.execute("SELECT @@ROWCOUNT")
-                rows_affected = cursor.fetchone()[0]
-                
-                # Commit with retry
-                try:
-                    connection.commit()
-                except pyodbc.Error as commit_error:
-                    error_str = str(commit_error).lower()
-                    if 'communication link failure' in error_str or '08S01' in str(commit_error):
-                        connection, cursor = check_and_reconnect()
-                        # Retry commit
-                        connection.commit()
-                    else:
-                        raise
-                
-                # Drop temp table
-                try:
-                    cursor.execute("DROP TABLE #TempSolarData")
-                except:
-                    pass
-                
-                print(f"Successfully processed {rows_affected} rows in solar table.")
-                break  # Success, exit retry loop
-                
-            except pyodbc.Error as e:
-                error_str = str(e).lower()
-                # Ensure temp table is cleaned up
-                try:
-                    cursor.execute("DROP TABLE #TempSolarData")
-                except:
-                    pass
-                
-                # Check if it's a connection error
-                if ('communication link failure' in error_str or '08S01' in str(e) or 
-                    'connection' in error_str or 'timeout' in error_str):
-                    if attempt < max_retries - 1:
-                        wait_time = 2 ** attempt
-                        print(f"Connection error during solar data insertion. Retrying in {wait_time} seconds... (attempt {attempt + 1}/{max_retries})")
-                        time.sleep(wait_time)
-                        # Reconnect for next attempt
-                        try:
-                            connection.rollback()
-                        except:
-                            pass
-                        connection, cursor = check_and_reconnect()
-                        continue
-                    else:
-                        print(f"Error updating solar data after {max_retries} attempts: {e}")
-                        try:
-                            connection.rollback()
-                        except:
-                            pass
-                        raise
-                else:
-                    # Not a connection error, re-raise immediately
-                    print(f"Error updating solar data: {e}")
-                    try:
-                        connection.rollback()
-                    except:
-                        pass
-                    raise
-    else:
-        print("No solar data to insert.")
+            print(f"No {table_name} data to insert.")
+    journal.finish()
 
 
 
@@ -1627,9 +1204,11 @@ except Exception as e:
         connection.rollback()
 finally:
     # Close the cursor and connection
-    if cursor:
-        cursor.close()
-    if connection:
-        connection.close()
+    db_pool.close()
     print("Connection closed.")
+    db_pool.report()
+    espm_cache.report()
+    if not REPLAY_RUN:
+        archive.report()
+    journal.close()
 
@@ -0,0 +1,158 @@
+#Local checkpoint journal for the ingestion scripts, so a crashed run can pick up where it stopped
+
+import os
+import sqlite3
+import threading
+import time
+
+JOURNAL_PATH = os.environ.get("ESPM_JOURNAL_PATH", os.path.join(".espm_cache", "journal.sqlite3"))
+# Finished runs older than the newest few are deleted when a new run starts
+JOURNAL_KEEP_RUNS = int(os.environ.get("ESPM_JOURNAL_KEEP_RUNS", 20))
+
+
+class RunJournal:
+    """
+    SQLite record of what one ingestion run has already finished.
+
+    A run moves through named stages (for example the property details MERGE),
+    and within the meter stage each property and meter is marked once its rows
+    have been committed to Azure SQL. A run that never reaches finish() stays
+    open, and RunJournal(script, resume=True) reopens the newest open run for
+    that script so the caller can skip whatever is already marked.
+
+    Safe to share between worker threads.
+    """
+
+    def __init__(self, script, resume=False, path=JOURNAL_PATH):
+        journal_dir = os.path.dirname(path)
+        if journal_dir:
+            os.makedirs(journal_dir, exist_ok=True)
+        self.script = script
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                script TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                finished_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS stages (
+                run_id INTEGER NOT NULL,
+                stage TEXT NOT NULL,
+                finished_at REAL NOT NULL,
+                PRIMARY KEY (run_id, stage)
+            );
+            CREATE TABLE IF NOT EXISTS properties (
+                run_id INTEGER NOT NULL,
+                espmid TEXT NOT NULL,
+                finished_at REAL NOT NULL,
+                PRIMARY KEY (run_id, espmid)
+            );
+            CREATE TABLE IF NOT EXISTS meters (
+                run_id INTEGER NOT NULL,
+                meterid TEXT NOT NULL,
+                espmid TEXT,
+                table_name TEXT,
+                finished_at REAL NOT NULL,
+                PRIMARY KEY (run_id, meterid)
+            );
+        """)
+
+        self.run_id = None
+        self.resumed = False
+        if resume:
+            row = self._conn.execute(
+                "SELECT run_id FROM runs WHERE script = ? AND finished_at IS NULL ORDER BY run_id DESC LIMIT 1",
+                (script,),
+            ).fetchone()
+            if row:
+                self.run_id = row[0]
+                self.resumed = True
+        if self.run_id is None:
+            cur = self._conn.execute("INSERT INTO runs (script, started_at) VALUES (?, ?)", (script, time.time()))
+            self.run_id = cur.lastrowid
+            self._prune()
+        self._conn.commit()
+
+        self._finished_properties = self._load("SELECT espmid FROM properties WHERE run_id = ?")
+        self._flushed_meters = self._load("SELECT meterid FROM meters WHERE run_id = ?")
+        self._finished_stages = self._load("SELECT stage FROM stages WHERE run_id = ?")
+
+    def describe(self):
+        if self.resumed:
+            return (
+                f"Resuming run {self.run_id}: {len(self._finished_properties)} properties and "
+                f"{len(self._flushed_meters)} meters already written."
+            )
+        return f"Starting run {self.run_id}."
+
+    def stage_done(self, stage):
+        with self._lock:
+            return stage in self._finished_stages
+
+    def mark_stage(self, stage):
+        self._write(
+            "INSERT OR REPLACE INTO stages (run_id, stage, finished_at) VALUES (?, ?, ?)",
+            [(self.run_id, stage, time.time())],
+        )
+        with self._lock:
+            self._finished_stages.add(stage)
+
+    def property_done(self, espmid):
+        with self._lock:
+            return str(espmid) in self._finished_properties
+
+    def mark_properties(self, espmids):
+        now = time.time()
+        self._write(
+            "INSERT OR REPLACE INTO properties (run_id, espmid, finished_at) VALUES (?, ?, ?)",
+            [(self.run_id, str(espmid), now) for espmid in espmids],
+        )
+        with self._lock:
+            self._finished_properties.update(str(espmid) for espmid in espmids)
+
+    def meter_flushed(self, meterid):
+        with self._lock:
+            return str(meterid) in self._flushed_meters
+
+    def mark_meters(self, meters, table_name):
+        """
+        meters: (meterid, espmid) pairs whose rows were committed to table_name
+        """
+        now = time.time()
+        self._write(
+            "INSERT OR REPLACE INTO meters (run_id, meterid, espmid, table_name, finished_at) VALUES (?, ?, ?, ?, ?)",
+            [(self.run_id, str(meterid), str(espmid), table_name, now) for meterid, espmid in meters],
+        )
+        with self._lock:
+            self._flushed_meters.update(str(meterid) for meterid, _ in meters)
+
+    def finish(self):
+        self._write("UPDATE runs SET finished_at = ? WHERE run_id = ?", [(time.time(), self.run_id)])
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _load(self, query):
+        return {row[0] for row in self._conn.execute(query, (self.run_id,))}
+
+    def _write(self, query, params):
+        if not params:
+            return
+        with self._lock:
+            self._conn.executemany(query, params)
+            self._conn.commit()
+
+    def _prune(self):
+        # Caller commits. Keep the newest JOURNAL_KEEP_RUNS runs of this script, open or not.
+        old_runs = [
+            row[0]
+            for row in self._conn.execute(
+                "SELECT run_id FROM runs WHERE script = ? ORDER BY run_id DESC LIMIT -1 OFFSET ?",
+                (self.script, JOURNAL_KEEP_RUNS),
+            )
+        ]
+        for table in ("meters", "properties", "stages", "runs"):
+            self._conn.executemany(f"DELETE FROM {table} WHERE run_id = ?", [(run_id,) for run_id in old_runs])
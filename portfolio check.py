@@ -19,19 +19,19 @@ SELECT
     e.espmid,
     e.buildingname,
     e.usetype,
-    TRY_CAST(e.datayear AS INT) AS datayear,
-    TRY_CAST(e.sqfootage AS DECIMAL(10,2)) AS total_sqft,
+    e.datayear_num AS datayear,
+    CAST(e.sqfootage AS DECIMAL(10,2)) AS total_sqft,
     TRY_CAST(e.siteeui AS DECIMAL(10,2)) AS avg_siteeui,
     CAST(p.portfolio AS NVARCHAR(255)) AS portfolio_name
 FROM PrimaryDataBase e
 INNER JOIN portfolios p
     ON e.espmid = p.espmid
 WHERE ISNULL(e.pmparentid, e.espmid) = e.espmid
-  AND TRY_CAST(e.datayear AS INT) IS NOT NULL
+  AND e.datayear_num IS NOT NULL
   AND e.hasenergygaps = 'OK'
   AND e.energylessthan12months = 'OK'
   AND TRY_CAST(e.siteeui AS DECIMAL(10,2)) IS NOT NULL
-  AND TRY_CAST(e.sqfootage AS DECIMAL(10,2)) > 0;
+  AND e.sqfootage > 0;
 """
 
 df = conn.query(new_query)
@@ -0,0 +1,520 @@
+#SQL behind the Portfolio Data page, and the rollup tables the ingester materializes from it
+
+import decimal
+import os
+
+
+def summary_query_builder(report_year):
+    return """
+        WITH latest_year AS (
+            SELECT MAX([datayear_num]) AS report_year
+            FROM [dbo].[PrimaryDataBase]
+            WHERE [datayear_num] IS NOT NULL
+            AND ISNULL([donotinclude], 0) <> 1
+        )
+        SELECT 
+            COALESCE(SUM(CAST([sqfootage] AS DECIMAL(10,2))), 0) as total_sqft,
+            AVG(TRY_CAST([siteeui] AS DECIMAL(10,2))) as avg_siteeui,
+            COALESCE(SUM(CAST([numbuildings_num] AS DECIMAL(10,2))), 0) as building_count
+        FROM [dbo].[PrimaryDataBase] e
+        CROSS JOIN latest_year ly
+        WHERE ISNULL(e.pmparentid, e.espmid) = e.espmid
+            AND e.[datayear_num] = ly.report_year
+            AND ISNULL(e.[donotinclude], 0) <> 1
+        HAVING COALESCE(SUM(CAST([sqfootage] AS DECIMAL(10,2))), 0) > 0"""
+
+
+def energy_ok_buildings_query_builder(report_year):
+    return f"""
+WITH property_rollup AS (
+    SELECT
+        d.espmid,
+        MIN(d.year_joined) AS year_joined,
+        MAX(CAST(d.[numbuildings_num] AS DECIMAL(18,2))) AS energy_ok_buildings
+    FROM [dbo].[PrimaryDataBase] d
+    WHERE ISNULL(d.pmparentid, d.espmid) = d.espmid
+      AND ISNULL(d.[donotinclude], 0) <> 1
+    GROUP BY d.espmid
+),
+qualifying_properties AS (
+    SELECT
+        pr.espmid
+    FROM property_rollup pr
+    JOIN [dbo].[PrimaryDataBase] d
+        ON d.espmid = pr.espmid
+    WHERE ISNULL(d.pmparentid, d.espmid) = d.espmid
+      AND ISNULL(d.[donotinclude], 0) <> 1
+      AND pr.year_joined IS NOT NULL
+      AND pr.year_joined <= {report_year}
+      AND d.[datayear_num] BETWEEN pr.year_joined AND {report_year}
+    GROUP BY pr.espmid, pr.year_joined
+    HAVING COUNT(DISTINCT d.[datayear_num]) = {report_year} - pr.year_joined + 1
+       AND COUNT(DISTINCT CASE
+            WHEN UPPER(ISNULL(d.[hasenergygaps], '')) = 'OK'
+             AND UPPER(ISNULL(d.[energylessthan12months], '')) = 'OK'
+            THEN d.[datayear_num]
+        END) = {report_year} - pr.year_joined + 1
+)
+SELECT
+    COALESCE(SUM(pr.energy_ok_buildings), 0) AS energy_ok_buildings
+FROM property_rollup pr
+JOIN qualifying_properties qp
+    ON pr.espmid = qp.espmid;
+"""
+
+
+def water_ok_buildings_query_builder(report_year):
+    return f"""
+WITH property_rollup AS (
+    SELECT
+        d.espmid,
+        MAX(d.year_joined) AS year_joined,
+        MAX(CAST(d.[numbuildings_num] AS DECIMAL(18,2))) AS water_ok_buildings
+    FROM [dbo].[PrimaryDataBase] d
+    WHERE ISNULL(d.pmparentid, d.espmid) = d.espmid
+    AND ISNULL(d.[donotinclude], 0) <> 1
+    AND d.datayear_num = {report_year}
+    AND d.year_joined <= {report_year}
+    AND d.[waterlessthan12months] = 'ok'
+    AND d.[haswatergaps] = 'ok'
+    GROUP BY d.espmid
+)
+SELECT
+    COALESCE(SUM(WATER_ok_buildings), 0) AS water_ok_buildings
+FROM property_rollup;
+"""
+
+
+def buildings_by_year_query_builder(report_year):
+    return f"""
+WITH years AS (
+    SELECT 2018 AS report_year UNION ALL
+    SELECT 2019 UNION ALL
+    SELECT 2020 UNION ALL
+    SELECT 2021 UNION ALL
+    SELECT 2022 UNION ALL
+    SELECT 2023 UNION ALL
+    SELECT 2024 UNION ALL
+    SELECT {report_year}
+),
+property_rollup AS (
+    SELECT
+        d.espmid,
+        MAX(d.year_joined) AS year_joined,
+        MAX(CAST(d.[numbuildings_num] AS DECIMAL(18,2))) AS numbuildings,
+        MAX(CAST(d.[sqfootage] AS DECIMAL(18,2))) AS sqfootage
+    FROM [dbo].[PrimaryDataBase] d
+    WHERE ISNULL(d.pmparentid, d.espmid) = d.espmid
+      AND ISNULL(d.[donotinclude], 0) <> 1
+      AND d.datayear_num < {report_year + 1}
+    GROUP BY d.espmid
+)
+SELECT
+    y.report_year AS [year],
+    COALESCE(SUM(pr.numbuildings), 0) AS buildings,
+    COALESCE(SUM(pr.sqfootage), 0) AS total_sqft
+FROM years y
+LEFT JOIN property_rollup pr
+    ON pr.year_joined <= y.report_year
+GROUP BY y.report_year
+ORDER BY y.report_year
+"""
+
+
+def pie_query_builder(report_year):
+    return f"""
+WITH ranked AS (
+    SELECT
+        e.usetype,
+        COUNT(DISTINCT e.espmid) AS building_count,
+        SUM(e.numbuildings_num) AS building_sum,
+        ROW_NUMBER() OVER (
+            ORDER BY COUNT(DISTINCT e.espmid) DESC, e.usetype
+        ) AS usetype_rank
+    FROM [dbo].[PrimaryDataBase] e
+    WHERE ISNULL(e.pmparentid, e.espmid) = e.espmid
+        AND e.datayear_num = {report_year}
+        AND ISNULL(e.[donotinclude], 0) <> 1
+        AND e.year_joined <= {report_year}
+    GROUP BY e.usetype
+)
+SELECT
+    {report_year} AS datayear,
+    CASE
+        WHEN usetype_rank <= 10 THEN usetype
+        ELSE 'Other'
+    END AS usetype,
+    SUM(building_count) AS building_count,
+    SUM(building_sum) AS building_sum
+FROM ranked
+GROUP BY
+    CASE
+        WHEN usetype_rank <= 10 THEN usetype
+        ELSE 'Other'
+    END
+ORDER BY
+    CASE WHEN
+        CASE WHEN usetype_rank <= 10 THEN usetype ELSE 'Other' END = 'Other'
+        THEN 1 ELSE 0
+    END,
+    SUM(building_count) DESC;
+"""
+
+
+def yearly_query_builder(report_year):
+    return f"""
+    SELECT
+        e.[datayear_num] as datayear,
+        COALESCE(SUM(CAST(e.[sqfootage] AS DECIMAL(10,2))), 0) as total_sqft,
+        AVG(TRY_CAST(e.[weathernormalizedsiteeui] AS DECIMAL(10,2))) as avg_siteeui,
+        AVG(b.zerotool_baseline) as baseline,
+        AVG(b.zerotool_baseline) * (0.86 - 0.03 * (e.[datayear_num] - 2018)) as target
+    FROM [dbo].[PrimaryDataBase] e
+    LEFT JOIN (
+        SELECT
+            TRY_CAST([espmid] AS BIGINT) AS espmid,
+            MAX(TRY_CAST([baseline] AS DECIMAL(10,2))) AS zerotool_baseline
+        FROM [dbo].[baselines]
+        GROUP BY TRY_CAST([espmid] AS BIGINT)
+    ) b
+        ON TRY_CAST(e.[espmid] AS BIGINT) = b.espmid
+    WHERE e.[datayear_num] IN (2018, 2019, 2020, 2021, 2022, 2023, 2024, {report_year})
+        AND ISNULL(e.pmparentid, e.espmid) = e.espmid
+        AND ISNULL(e.[donotinclude], 0) <> 1
+        AND e.hasenergygaps = 'OK'
+        AND e.energylessthan12months = 'OK'
+        AND e.weathernormalizedsiteeui IS NOT NULL
+        AND e.year_joined <= e.[datayear_num]
+    GROUP BY e.[datayear_num]
+    HAVING COALESCE(SUM(CAST(e.[sqfootage] AS DECIMAL(10,2))), 0) > 0
+    ORDER BY datayear
+"""
+
+
+def wateryear_query_builder(report_year):
+    return f"""
+    SELECT
+        e.[datayear_num] as datayear,
+        AVG(CAST(e.[wui_num] AS DECIMAL(10,2))) as avg_wui,
+        AVG(TRY_CAST(wb.[wuibaseline] AS DECIMAL(10,2))) as baseline,
+        AVG(TRY_CAST(wb.[wuibaseline] AS DECIMAL(10,2))) * (0.86 - 0.03 * (e.[datayear_num] - 2018)) as target
+    FROM [dbo].[PrimaryDataBase] e
+    LEFT JOIN [dbo].[wuibaselines] wb
+        ON e.[usetype] = wb.[usetype]
+    WHERE e.[datayear_num] IN (2018, 2019, 2020, 2021, 2022, 2023, 2024, {report_year})
+        AND ISNULL(e.pmparentid, e.espmid) = e.espmid
+        AND ISNULL(e.[donotinclude], 0) <> 1
+        AND e.haswatergaps = 'OK'
+        AND e.[wui_num] IS NOT NULL
+        AND e.waterlessthan12months = 'OK'
+        AND TRY_CAST(wb.[wuibaseline] AS DECIMAL(10,2)) IS NOT NULL
+        AND e.year_joined <= e.[datayear_num]
+    GROUP BY e.[datayear_num]
+    ORDER BY datayear
+"""
+
+
+def wuibybuildingtype_query_builder(report_year):
+    return f"""
+    SELECT TOP 10
+        e.usetype,
+        AVG(CAST(e.wui_num AS FLOAT)) AS averagewui,
+        COUNT(e.usetype) AS numproperties,
+        SUM(e.numbuildings_num) AS numberofbuildingswithuse
+    FROM dbo.PrimaryDataBase e
+    WHERE e.datayear_num = {report_year}
+      AND ISNULL(e.pmparentid, e.espmid) = e.espmid
+      AND ISNULL(e.[donotinclude], 0) <> 1
+      AND e.haswatergaps = 'OK'
+      AND e.waterlessthan12months = 'OK'
+      AND e.wui_num IS NOT NULL
+      AND e.year_joined <= {report_year}
+    GROUP BY e.usetype
+    ORDER BY numberofbuildingswithuse DESC
+"""
+
+
+def solar_query_builder(report_year):
+    return """
+SELECT
+    e.datayear_num AS datayear,
+    SUM(e.onSiteRenewableSystemGeneration) AS renewablesum
+FROM PrimaryDataBase e
+WHERE e.onSiteRenewableSystemGeneration IS NOT NULL
+    AND ISNULL(e.pmparentid, e.espmid) = e.espmid
+    AND e.year_joined <= e.datayear_num
+GROUP BY e.datayear_num
+ORDER BY e.datayear_num;
+"""
+
+
+def ghg_query_builder(report_year):
+    return """
+WITH emissions_factors AS (
+    SELECT 2021 AS datayear, CAST(0.596 AS DECIMAL(10,6)) AS factor UNION ALL
+    SELECT 2022, CAST(0.663 AS DECIMAL(10,6)) UNION ALL
+    SELECT 2023, CAST(0.628 AS DECIMAL(10,6)) UNION ALL
+    SELECT 2024, CAST(0.565 AS DECIMAL(10,6)) UNION ALL
+    SELECT 2025, CAST(0.506 AS DECIMAL(10,6))
+),
+base_data AS (
+    SELECT
+        e.datayear_num AS datayear,
+        TRY_CAST(e.espmid AS BIGINT) AS espmid,
+        TRY_CAST(e.siteEnergyUseElectricityGridPurchaseKwh AS DECIMAL(18,4)) AS electricity_kwh,
+        TRY_CAST(e.greenPowerOffSite AS DECIMAL(18,4)) AS green_power_offsite,
+        TRY_CAST(e.onSiteRenewableSystemGeneration AS DECIMAL(18,4)) AS onsite_solar_kwh,
+        TRY_CAST(e.siteEnergyUseNaturalGas AS DECIMAL(18,4)) AS natural_gas,
+        CAST(e.sqfootage AS DECIMAL(18,4)) AS sqfootage
+    FROM dbo.PrimaryDataBase e
+    WHERE e.[datayear_num] IN (2018, 2019, 2020, 2021, 2022, 2023, 2024, 2025)
+      AND ISNULL(e.pmparentid, e.espmid) = e.espmid
+      AND ISNULL(e.[donotinclude], 0) <> 1
+      AND e.hasenergygaps = 'OK'
+      AND e.energylessthan12months = 'OK'
+      AND e.sqfootage IS NOT NULL
+      AND e.year_joined <= e.[datayear_num]
+)
+SELECT
+    b.datayear,
+    COUNT(DISTINCT b.espmid) AS building_count,
+    SUM(b.electricity_kwh) AS total_grid_purchase_kwh,
+    SUM(b.natural_gas) AS total_natural_gas,
+    SUM(b.sqfootage) AS total_sqft,
+
+    MAX(ef.factor) AS electricity_emissions_factor_actual,
+    SUM(
+        CASE
+            WHEN COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0) < 0 THEN 0
+            ELSE COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0)
+        END * ef.factor
+    ) AS electricity_emissions_actual,
+    SUM(COALESCE(b.natural_gas, 0) * 0.053072) AS natural_gas_emissions_actual,
+    (
+        SUM(
+            CASE
+                WHEN COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0) < 0 THEN 0
+                ELSE COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0)
+            END * ef.factor
+        )
+      + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
+    ) AS total_calculated_emissions_actual,
+    (
+        SUM(
+            CASE
+                WHEN COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0) < 0 THEN 0
+                ELSE COALESCE(b.electricity_kwh, 0) - COALESCE(b.green_power_offsite, 0)
+            END * ef.factor
+        )
+      + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
+    ) / NULLIF(SUM(b.sqfootage), 0) AS total_calculated_emissions_actual_per_sqft,
+
+    CAST(0.71314946 AS DECIMAL(10,8)) AS electricity_emissions_factor_baseline,
+    SUM((COALESCE(b.electricity_kwh, 0) + COALESCE(b.onsite_solar_kwh, 0)) * 0.71314946) AS electricity_emissions_baseline,
+    SUM(COALESCE(b.natural_gas, 0) * 0.053072) AS natural_gas_emissions_baseline,
+    (
+        SUM((COALESCE(b.electricity_kwh, 0) + COALESCE(b.onsite_solar_kwh, 0)) * 0.71314946)
+      + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
+    ) AS total_calculated_emissions_baseline,
+    (
+        SUM((COALESCE(b.electricity_kwh, 0) + COALESCE(b.onsite_solar_kwh, 0)) * 0.71314946)
+      + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
+    ) / NULLIF(SUM(b.sqfootage), 0) AS total_calculated_emissions_baseline_per_sqft,
+
+    (0.5265 - 0.026 * (2025 - b.datayear)) AS ghg_target_reduction_pct,
+    (
+        (
+            SUM((COALESCE(b.electricity_kwh, 0) + COALESCE(b.onsite_solar_kwh, 0)) * 0.71314946)
+          + SUM(COALESCE(b.natural_gas, 0) * 0.053072)
+        ) / NULLIF(SUM(b.sqfootage), 0)
+    ) * (1 - (0.5265 - 0.026 * (2025 - b.datayear))) AS ghg_emissions_target
+
+FROM base_data b
+INNER JOIN emissions_factors ef
+    ON b.datayear = ef.datayear
+GROUP BY b.datayear
+ORDER BY b.datayear;
+"""
+
+
+def dashboard_tenant():
+    """
+    The tenant an ingester is loading, from the required DASHBOARD_TENANT setting.
+    It has to be the name the dashboard logs that tenant in as (its key under [auth]
+    in the Streamlit secrets, i.e. get_current_tenant()), since year_joined's rule
+    and the rollup rows are chosen by it. There is no default: guessing would apply
+    one tenant's rule to another tenant's database.
+    """
+    tenant = os.environ.get("DASHBOARD_TENANT", "").strip()
+    if not tenant:
+        raise RuntimeError("DASHBOARD_TENANT is not set; set it to this database's tenant as the dashboard names it (e.g. washtenaw).")
+    return tenant
+
+
+# Tenants that record when each property joined in their own dbo.yearjoined table (several
+# rows per property are allowed; the earliest counts). Every other tenant counts a property
+# from the year it was created in ESPM.
+YEARJOINED_TABLE_TENANTS = {'washtenaw'}
+
+
+def resolve_year_joined(db, tenant):
+    """
+    Set PrimaryDataBase.year_joined, the year each property counts toward the
+    portfolio from, by tenant's rule. Only rows whose value changed are written;
+    properties the rule has no year for are left NULL and drop out of the charts.
+
+    Args:
+        db: PooledConnection on the tenant's database
+        tenant: tenant name the page logs in as
+
+    Returns:
+        number of rows updated
+    """
+    if tenant in YEARJOINED_TABLE_TENANTS:
+        resolved = """
+            SELECT TRY_CONVERT(INT, [ESPMID]) AS espmid, MIN(TRY_CONVERT(INT, [year joined])) AS year_joined
+            FROM dbo.yearjoined
+            GROUP BY TRY_CONVERT(INT, [ESPMID])
+        """
+    else:
+        resolved = """
+            SELECT espmid, MIN(yearcreatedinespm) AS year_joined
+            FROM PrimaryDataBase
+            GROUP BY espmid
+        """
+    connection, cursor = db.ensure_alive()
+    cursor.execute(f"""
+    UPDATE d
+    SET year_joined = resolved.year_joined
+    FROM PrimaryDataBase d
+    LEFT JOIN ({resolved}) AS resolved
+        ON resolved.espmid = d.espmid
+    WHERE EXISTS (SELECT d.year_joined EXCEPT SELECT resolved.year_joined)
+    """)
+    updated = max(cursor.rowcount, 0)
+    if updated:
+        bump_data_version(cursor, tenant)
+    connection.commit()
+    return updated
+
+
+# Each Portfolio Data aggregate: name -> (rollup table, query builder, result columns in
+# SELECT order). The tables themselves come from schema migration 11; a new aggregate
+# needs a migration adding its table.
+ROLLUPS = {
+    'summary': ('rollup_summary', summary_query_builder, ['total_sqft', 'avg_siteeui', 'building_count']),
+    'energy_ok_buildings': ('rollup_energy_ok_buildings', energy_ok_buildings_query_builder, ['energy_ok_buildings']),
+    'water_ok_buildings': ('rollup_water_ok_buildings', water_ok_buildings_query_builder, ['water_ok_buildings']),
+    'buildings_by_year': ('rollup_buildings_by_year', buildings_by_year_query_builder, ['year', 'buildings', 'total_sqft']),
+    'usetype_pie': ('rollup_usetype_pie', pie_query_builder, ['datayear', 'usetype', 'building_count', 'building_sum']),
+    'eui_by_year': ('rollup_eui_by_year', yearly_query_builder, ['datayear', 'total_sqft', 'avg_siteeui', 'baseline', 'target']),
+    'wui_by_year': ('rollup_wui_by_year', wateryear_query_builder, ['datayear', 'avg_wui', 'baseline', 'target']),
+    'wui_by_usetype': ('rollup_wui_by_usetype', wuibybuildingtype_query_builder, ['usetype', 'averagewui', 'numproperties', 'numberofbuildingswithuse']),
+    'solar_by_year': ('rollup_solar_by_year', solar_query_builder, ['datayear', 'renewablesum']),
+    'ghg_by_year': ('rollup_ghg_by_year', ghg_query_builder, [
+        'datayear',
+        'building_count',
+        'total_grid_purchase_kwh',
+        'total_natural_gas',
+        'total_sqft',
+        'electricity_emissions_factor_actual',
+        'electricity_emissions_actual',
+        'natural_gas_emissions_actual',
+        'total_calculated_emissions_actual',
+        'total_calculated_emissions_actual_per_sqft',
+        'electricity_emissions_factor_baseline',
+        'electricity_emissions_baseline',
+        'natural_gas_emissions_baseline',
+        'total_calculated_emissions_baseline',
+        'total_calculated_emissions_baseline_per_sqft',
+        'ghg_target_reduction_pct',
+        'ghg_emissions_target',
+    ]),
+}
+
+# rollup_refresh.data_version counts the committed writes to what the rollups are computed
+# from, and rollup_version is the data_version they were last computed at. The page uses the
+# rollups only while the two are equal, so it reads one row instead of checking the data.
+ROLLUP_REFRESH_QUERY = "SELECT report_year, refreshedat, data_version, rollup_version FROM rollup_refresh WHERE tenant = :tenant"
+
+
+def bump_data_version(cursor, tenant):
+    """
+    Record a write to PrimaryDataBase (or the baselines tables) against tenant's
+    rollups, so the page stops using them until they are refreshed. Run it on the
+    writing cursor before the commit, so the write and the bump land together.
+    Manual edits such as donotinclude should be followed by an ingester run, which
+    refreshes the rollups anyway.
+    """
+    cursor.execute("""
+    MERGE rollup_refresh AS target
+    USING (SELECT ? AS tenant) AS source
+    ON target.tenant = source.tenant
+    WHEN MATCHED THEN
+        UPDATE SET data_version = target.data_version + 1
+    WHEN NOT MATCHED THEN
+        INSERT (tenant, data_version) VALUES (source.tenant, 1);
+    """, (tenant,))
+
+
+def rollup_query(name):
+    """
+    SELECT reading one aggregate back from its rollup table, in the order the
+    live query returned its rows. Takes a :tenant parameter.
+    """
+    table_name, _, columns = ROLLUPS[name]
+    return f"SELECT {', '.join(f'[{column}]' for column in columns)} FROM {table_name} WHERE tenant = :tenant ORDER BY rownum"
+
+
+def refresh_rollups(db, tenant, report_year):
+    """
+    Recompute every Portfolio Data aggregate from PrimaryDataBase and replace
+    tenant's rows in the rollup tables, all in one transaction so the page never
+    reads a half-refreshed set. rollup_refresh records the report year and the
+    data_version they were computed for; the page only uses them while both
+    still match.
+
+    Args:
+        db: PooledConnection on the tenant's database
+        tenant: tenant name the page logs in as
+        report_year: most recent full calendar year
+
+    Returns:
+        {rollup table: rows written}
+    """
+    connection, cursor = db.ensure_alive()
+    # Read before the aggregates, so a write committed while they run leaves the rollups looking stale
+    cursor.execute("SELECT data_version FROM rollup_refresh WHERE tenant = ?", (tenant,))
+    row = cursor.fetchone()
+    data_version = row[0] if row else 0
+    results = {}
+    for table_name, query_builder, columns in ROLLUPS.values():
+        cursor.execute(query_builder(report_year))
+        results[table_name] = [
+            tuple(float(value) if isinstance(value, decimal.Decimal) else value for value in row)
+            for row in cursor.fetchall()
+        ]
+    try:
+        for table_name, _, columns in ROLLUPS.values():
+            cursor.execute(f"DELETE FROM {table_name} WHERE tenant = ?", (tenant,))
+            rows = [(tenant, rownum, *row) for rownum, row in enumerate(results[table_name])]
+            if rows:
+                cursor.executemany(
+                    f"INSERT INTO {table_name} (tenant, rownum, {', '.join(f'[{column}]' for column in columns)}) "
+                    f"VALUES ({', '.join('?' for _ in range(len(columns) + 2))})",
+                    rows,
+                )
+        cursor.execute("""
+        MERGE rollup_refresh AS target
+        USING (SELECT ? AS tenant, ? AS report_year, ? AS rollup_version) AS source
+        ON target.tenant = source.tenant
+        WHEN MATCHED THEN
+            UPDATE SET report_year = source.report_year, rollup_version = source.rollup_version, refreshedat = SYSUTCDATETIME()
+        WHEN NOT MATCHED THEN
+            INSERT (tenant, report_year, data_version, rollup_version, refreshedat) VALUES (source.tenant, source.report_year, source.rollup_version, source.rollup_version, SYSUTCDATETIME());
+        """, (tenant, report_year, data_version))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    return {table_name: len(rows) for table_name, rows in results.items()}
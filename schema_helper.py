@@ -0,0 +1,407 @@
+#Versioned schema migrations for the dashboard database, applied by db_helper.apply_migrations
+
+import functools
+import os
+import time
+
+# ESPM meter type -> consumption table full update.py loads it into. The tables share one set
+# of columns and MERGE, so pulling in another utility (district steam, propane, ...) needs an
+# entry here and a migration creating its table with consumption_table_migration().
+METER_TYPE_TABLES = {
+    'Natural Gas': 'naturalgas',
+    'Electric': 'electric',
+    'Electric on Site Solar': 'solar',
+}
+# ESPM has many water meter types, so water meters are routed by their association instead
+WATER_TABLE = 'water'
+CONSUMPTION_TABLES = list(dict.fromkeys(METER_TYPE_TABLES.values())) + [WATER_TABLE]
+# The tables migrations 5, 7 and 8 were written for; they must not grow with CONSUMPTION_TABLES
+ORIGINAL_CONSUMPTION_TABLES = ['naturalgas', 'electric', 'solar', 'water']
+# Rows per UPDATE when a migration backfills an existing table
+BACKFILL_BATCH_ROWS = int(os.environ.get("SCHEMA_BACKFILL_BATCH_ROWS", 5000))
+
+# Numeric attributes that arrive as text, and the typed column kept next to each:
+# table -> {text column: (typed column, SQL type)}. The ingesters fill both and the
+# dashboards read the typed column, so their aggregates and filters run on native numbers.
+TYPED_COLUMNS = {
+    'PrimaryDataBase': {
+        'numbuildings': ('numbuildings_num', 'INT'),
+        'occupancy': ('occupancy_num', 'INT'),
+        'yearbuilt': ('yearbuilt_num', 'INT'),
+        'wui': ('wui_num', 'DECIMAL(18,4)'),
+    },
+    **{
+        table_name: {
+            'cost': ('cost_num', 'DECIMAL(19,4)'),
+            'usage': ('usage_num', 'DECIMAL(19,4)'),
+        }
+        for table_name in CONSUMPTION_TABLES
+    },
+}
+
+
+def typed_value(expression, sql_type):
+    """
+    SQL converting a numeric text expression to sql_type, or NULL when it is not
+    a number. Commas are ignored and INT values are truncated, as in safe_to_int.
+    """
+    cleaned = f"REPLACE({expression}, ',', '')"
+    if sql_type == 'INT':
+        return f"TRY_CONVERT(INT, TRY_CONVERT(FLOAT, {cleaned}))"
+    return f"COALESCE(TRY_CONVERT({sql_type}, {cleaned}), TRY_CONVERT({sql_type}, TRY_CONVERT(FLOAT, {cleaned})))"
+
+
+def typed_assignments(table_name, source, columns=None):
+    """
+    (typed column, expression) pairs filling the typed columns of table_name from
+    the text columns of the source alias, for MERGE UPDATE SET and INSERT lists.
+
+    Args:
+        table_name: a TYPED_COLUMNS table
+        source: alias of the staged rows
+        columns: text columns the source has, if not all of them
+    """
+    return [
+        (typed_column, typed_value(f"{source}.{column}", sql_type))
+        for column, (typed_column, sql_type) in TYPED_COLUMNS[table_name].items()
+        if columns is None or column in columns
+    ]
+
+
+def add_column(table_name, column_name, column_type):
+    return f"IF COL_LENGTH('{table_name}', '{column_name}') IS NULL ALTER TABLE {table_name} ADD {column_name} {column_type} NULL"
+
+
+def retype_column(column_name, column_type, converted):
+    """
+    Convert a PrimaryDataBase column created as text by older runs to column_type.
+    Values that do not convert become NULL. converted is the expression giving
+    the new value from the old one.
+    """
+    return f"""
+    IF EXISTS (
+        SELECT 1
+        FROM sys.columns c
+        JOIN sys.types t ON c.user_type_id = t.user_type_id
+        WHERE c.object_id = OBJECT_ID('PrimaryDataBase')
+          AND c.name = '{column_name}'
+          AND t.name <> '{column_type.lower()}'
+    )
+    BEGIN
+        UPDATE PrimaryDataBase
+        SET {column_name} = NULL
+        WHERE {column_name} IS NOT NULL
+          AND {converted} IS NULL;
+
+        UPDATE PrimaryDataBase
+        SET {column_name} = {converted}
+        WHERE {column_name} IS NOT NULL;
+
+        ALTER TABLE PrimaryDataBase ALTER COLUMN {column_name} {column_type} NULL;
+    END
+    """
+
+
+def consumption_table(table_name):
+    return [
+        f"""
+        IF OBJECT_ID('{table_name}') IS NULL
+            CREATE TABLE {table_name} (
+                entryid NVARCHAR(100) PRIMARY KEY,
+                espmid INT,
+                meterid NVARCHAR(100),
+                cost NVARCHAR(100),
+                usage NVARCHAR(100),
+                startdate SMALLDATETIME,
+                enddate SMALLDATETIME,
+                rowhash BINARY(32)
+            )
+        """,
+        add_column(table_name, 'rowhash', 'BINARY(32)'),
+        # (espmid, startdate) serves the per-building reads in the dashboard
+        f"""
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_{table_name}_espmid_startdate')
+            CREATE INDEX ix_{table_name}_espmid_startdate ON {table_name} (espmid, startdate) INCLUDE (meterid, enddate)
+        """,
+    ]
+
+
+def rollup_table(table_name, columns):
+    """
+    CREATE TABLE for one of portfolio_queries.ROLLUPS: a tenant's result rows of
+    one Portfolio Data aggregate, numbered in the order the live query returned them.
+
+    Args:
+        table_name: rollup table
+        columns: (column, SQL type) pairs in SELECT order
+    """
+    column_definitions = ",\n                ".join(f"[{column}] {column_type}" for column, column_type in columns)
+    return f"""
+        IF OBJECT_ID('{table_name}') IS NULL
+            CREATE TABLE {table_name} (
+                tenant NVARCHAR(100) NOT NULL,
+                rownum INT NOT NULL,
+                {column_definitions},
+                CONSTRAINT PK_{table_name} PRIMARY KEY (tenant, rownum)
+            )
+        """
+
+
+def consumption_table_migration(table_name):
+    """
+    Statements for a migration adding a consumption table after the original
+    ones: the table, its index and its typed columns. New tables have no rows,
+    so there is nothing to backfill.
+    """
+    return consumption_table(table_name) + [
+        add_column(table_name, typed_column, sql_type)
+        for typed_column, sql_type in TYPED_COLUMNS[table_name].values()
+    ]
+
+
+def backfill_in_batches(db, table_name, key, assignments):
+    """
+    Run UPDATE table_name SET assignments over the whole table, BACKFILL_BATCH_ROWS
+    keys at a time with a commit after each batch, so the dashboards keep reading
+    while it runs. Safe to run again after an interruption.
+
+    Args:
+        db: PooledConnection
+        table_name: table to update
+        key: leading key column the batches walk (espmid, entryid)
+        assignments: the SET list
+    """
+    connection, cursor = db.ensure_alive()
+    started = time.perf_counter()
+    batches = 0
+    updated = 0
+    last_key = None
+    while True:
+        if last_key is None:
+            cursor.execute(f"SELECT MAX({key}) FROM (SELECT TOP ({BACKFILL_BATCH_ROWS}) {key} FROM {table_name} ORDER BY {key}) AS batch")
+        else:
+            cursor.execute(f"SELECT MAX({key}) FROM (SELECT TOP ({BACKFILL_BATCH_ROWS}) {key} FROM {table_name} WHERE {key} > ? ORDER BY {key}) AS batch", (last_key,))
+        batch_end = cursor.fetchone()[0]
+        if batch_end is None:
+            break
+        if last_key is None:
+            cursor.execute(f"UPDATE {table_name} SET {assignments} WHERE {key} <= ?", (batch_end,))
+        else:
+            cursor.execute(f"UPDATE {table_name} SET {assignments} WHERE {key} > ? AND {key} <= ?", (last_key, batch_end))
+        updated += max(cursor.rowcount, 0)
+        connection.commit()
+        batches += 1
+        last_key = batch_end
+    print(f"Backfilled {table_name}: {updated} rows in {batches} batches, {time.perf_counter() - started:.1f}s.")
+
+
+def backfill_typed_columns(db, tables):
+    """
+    Fill the typed columns of rows written before they existed. Batches walk
+    espmid on PrimaryDataBase and entryid on the consumption tables.
+    """
+    for table_name in tables:
+        columns = TYPED_COLUMNS[table_name]
+        assignments = ", ".join(
+            f"{typed_column} = {typed_value(column, sql_type)}"
+            for column, (typed_column, sql_type) in columns.items()
+        )
+        backfill_in_batches(db, table_name, 'espmid' if table_name == 'PrimaryDataBase' else 'entryid', assignments)
+
+
+# Columns older databases may be missing, in the order they were introduced
+PRIMARYDATABASE_COLUMNS = [
+    ('buildingname', 'NVARCHAR(100)'),
+    ('sqfootage', 'INT'),
+    ('address', 'NVARCHAR(100)'),
+    ('occupancy', 'NVARCHAR(100)'),
+    ('numbuildings', 'NVARCHAR(100)'),
+    ('usetype', 'NVARCHAR(100)'),
+    ('datayear', 'NVARCHAR(100)'),
+    ('yearbuilt', 'NVARCHAR(100)'),
+    ('yearcreatedinespm', 'INT'),
+    ('siteeui', 'FLOAT'),
+    ('weathernormalizedsiteeui', 'FLOAT'),
+    ('energystarscore', 'INT'),
+    ('wui', 'NVARCHAR(100)'),
+    ('energycost', 'FLOAT'),
+    ('energycostintensity', 'FLOAT'),
+    ('energycostelectricitygridpurchase', 'FLOAT'),
+    ('energycostnaturalgas', 'FLOAT'),
+    ('siteEnergyUseElectricityGridPurchaseKwh', 'FLOAT'),
+    ('siteEnergyUseNaturalGas', 'FLOAT'),
+    ('totalMarketBasedGHGEmissions', 'FLOAT'),
+    ('greenPowerOffSite', 'FLOAT'),
+    ('onSiteRenewableSystemElectricityExported', 'FLOAT'),
+    ('onSiteRenewableSystemGeneration', 'FLOAT'),
+    ('hasenergygaps', 'NVARCHAR(100)'),
+    ('haswatergaps', 'NVARCHAR(100)'),
+    ('energylessthan12months', 'NVARCHAR(100)'),
+    ('waterlessthan12months', 'NVARCHAR(100)'),
+    ('pmparentid', 'INT'),
+]
+
+# (version, description, statements). Append new steps with the next version; never edit
+# or reorder one that has shipped, since databases record the versions they have applied.
+# Every step is guarded so it is a no-op on databases the old startup ALTERs already upgraded.
+# A statement can also be a function of the PooledConnection, for batched backfills.
+MIGRATIONS = [
+    (1, "PrimaryDataBase table and columns", [
+        """
+        IF OBJECT_ID('PrimaryDataBase') IS NULL
+            CREATE TABLE PrimaryDataBase (
+                espmid INT NOT NULL,
+                datayear NVARCHAR(100) NOT NULL,
+                CONSTRAINT PK_PrimaryDataBase PRIMARY KEY (espmid, datayear)
+            )
+        """,
+    ] + [add_column('PrimaryDataBase', column_name, column_type) for column_name, column_type in PRIMARYDATABASE_COLUMNS]),
+    (2, "PrimaryDataBase keyed on (espmid, datayear)", [
+        """
+        IF NOT EXISTS (
+            SELECT 1
+            FROM sys.indexes i
+            JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+            JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+            WHERE i.object_id = OBJECT_ID('PrimaryDataBase') AND i.is_primary_key = 1 AND c.name = 'datayear'
+        )
+        BEGIN
+            UPDATE PrimaryDataBase
+            SET datayear = 'UNKNOWN'
+            WHERE datayear IS NULL;
+
+            DECLARE @pk_name NVARCHAR(128);
+            SELECT @pk_name = kc.name
+            FROM sys.key_constraints kc
+            JOIN sys.tables t ON kc.parent_object_id = t.object_id
+            WHERE kc.[type] = 'PK' AND t.name = 'PrimaryDataBase';
+
+            IF @pk_name IS NOT NULL
+                EXEC('ALTER TABLE PrimaryDataBase DROP CONSTRAINT [' + @pk_name + ']');
+
+            ALTER TABLE PrimaryDataBase ALTER COLUMN datayear NVARCHAR(100) NOT NULL;
+            ALTER TABLE PrimaryDataBase ADD CONSTRAINT PK_PrimaryDataBase PRIMARY KEY (espmid, datayear);
+        END
+        """,
+    ]),
+    (3, "Numeric PrimaryDataBase report columns", [
+        retype_column('sqfootage', 'INT', "TRY_CONVERT(INT, TRY_CONVERT(FLOAT, REPLACE(sqfootage, ',', '')))"),
+        retype_column('siteeui', 'FLOAT', "TRY_CONVERT(FLOAT, REPLACE(siteeui, ',', ''))"),
+        retype_column('weathernormalizedsiteeui', 'FLOAT', "TRY_CONVERT(FLOAT, REPLACE(weathernormalizedsiteeui, ',', ''))"),
+        retype_column('energystarscore', 'INT', "TRY_CONVERT(INT, TRY_CONVERT(FLOAT, REPLACE(energystarscore, ',', '')))"),
+        retype_column('yearcreatedinespm', 'INT', "TRY_CONVERT(INT, TRY_CONVERT(FLOAT, REPLACE(yearcreatedinespm, ',', '')))"),
+        retype_column('pmparentid', 'INT', "TRY_CONVERT(INT, pmparentid)"),
+    ]),
+    (4, "PrimaryDataBase rowhash and has_issue", [
+        add_column('PrimaryDataBase', 'rowhash', 'BINARY(32)'),
+        add_column('PrimaryDataBase', 'has_issue', 'BIT'),
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_espm_issue')
+            EXEC('CREATE INDEX ix_espm_issue ON PrimaryDataBase (espmid, datayear DESC) WHERE has_issue = 1')
+        """,
+    ]),
+    (5, "Consumption tables", [
+        statement for table_name in ORIGINAL_CONSUMPTION_TABLES for statement in consumption_table(table_name)
+    ]),
+    (6, "metercatalog table", [
+        """
+        IF OBJECT_ID('metercatalog') IS NULL
+        BEGIN
+            CREATE TABLE metercatalog (
+                meterid NVARCHAR(100) PRIMARY KEY,
+                espmid INT,
+                type NVARCHAR(100),
+                inuse NVARCHAR(10),
+                inactivedate DATE,
+                metername NVARCHAR(200),
+                refreshedat DATETIME2
+            );
+            CREATE INDEX ix_metercatalog_espmid ON metercatalog (espmid);
+        END
+        """,
+    ]),
+    (7, "Typed numeric columns", [
+        add_column(table_name, typed_column, sql_type)
+        for table_name in ['PrimaryDataBase'] + ORIGINAL_CONSUMPTION_TABLES
+        for typed_column, sql_type in TYPED_COLUMNS[table_name].values()
+    ]),
+    (8, "Backfill typed numeric columns", [
+        functools.partial(backfill_typed_columns, tables=['PrimaryDataBase'] + ORIGINAL_CONSUMPTION_TABLES),
+    ]),
+    # datayear stays the NVARCHAR key; the dashboards filter and group on datayear_num
+    (9, "Integer datayear_num on PrimaryDataBase", [
+        add_column('PrimaryDataBase', 'datayear_num', 'INT'),
+        add_column('PrimaryDataBase', 'donotinclude', 'BIT'),
+    ]),
+    (10, "Backfill and index datayear_num", [
+        functools.partial(backfill_in_batches, table_name='PrimaryDataBase', key='espmid', assignments=f"datayear_num = {typed_value('datayear', 'INT')}"),
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_primarydatabase_datayear_num')
+            CREATE INDEX ix_primarydatabase_datayear_num ON PrimaryDataBase (datayear_num, espmid) INCLUDE (pmparentid, donotinclude)
+        """,
+    ]),
+    # Written by portfolio_queries.refresh_rollups at the end of every espmreportingapproach.py run
+    (11, "Portfolio rollup tables", [
+        """
+        IF OBJECT_ID('rollup_refresh') IS NULL
+            CREATE TABLE rollup_refresh (
+                tenant NVARCHAR(100) PRIMARY KEY,
+                report_year INT,
+                refreshedat DATETIME2
+            )
+        """,
+        rollup_table('rollup_summary', [('total_sqft', 'FLOAT'), ('avg_siteeui', 'FLOAT'), ('building_count', 'FLOAT')]),
+        rollup_table('rollup_energy_ok_buildings', [('energy_ok_buildings', 'FLOAT')]),
+        rollup_table('rollup_water_ok_buildings', [('water_ok_buildings', 'FLOAT')]),
+        rollup_table('rollup_buildings_by_year', [('year', 'INT'), ('buildings', 'FLOAT'), ('total_sqft', 'FLOAT')]),
+        rollup_table('rollup_usetype_pie', [('datayear', 'INT'), ('usetype', 'NVARCHAR(100)'), ('building_count', 'INT'), ('building_sum', 'FLOAT')]),
+        rollup_table('rollup_eui_by_year', [('datayear', 'INT'), ('total_sqft', 'FLOAT'), ('avg_siteeui', 'FLOAT'), ('baseline', 'FLOAT'), ('target', 'FLOAT')]),
+        rollup_table('rollup_wui_by_year', [('datayear', 'INT'), ('avg_wui', 'FLOAT'), ('baseline', 'FLOAT'), ('target', 'FLOAT')]),
+        rollup_table('rollup_wui_by_usetype', [('usetype', 'NVARCHAR(100)'), ('averagewui', 'FLOAT'), ('numproperties', 'INT'), ('numberofbuildingswithuse', 'FLOAT')]),
+        rollup_table('rollup_solar_by_year', [('datayear', 'INT'), ('renewablesum', 'FLOAT')]),
+        rollup_table('rollup_ghg_by_year', [
+            ('datayear', 'INT'),
+            ('building_count', 'INT'),
+            ('total_grid_purchase_kwh', 'FLOAT'),
+            ('total_natural_gas', 'FLOAT'),
+            ('total_sqft', 'FLOAT'),
+            ('electricity_emissions_factor_actual', 'FLOAT'),
+            ('electricity_emissions_actual', 'FLOAT'),
+            ('natural_gas_emissions_actual', 'FLOAT'),
+            ('total_calculated_emissions_actual', 'FLOAT'),
+            ('total_calculated_emissions_actual_per_sqft', 'FLOAT'),
+            ('electricity_emissions_factor_baseline', 'FLOAT'),
+            ('electricity_emissions_baseline', 'FLOAT'),
+            ('natural_gas_emissions_baseline', 'FLOAT'),
+            ('total_calculated_emissions_baseline', 'FLOAT'),
+            ('total_calculated_emissions_baseline_per_sqft', 'FLOAT'),
+            ('ghg_target_reduction_pct', 'FLOAT'),
+            ('ghg_emissions_target', 'FLOAT'),
+        ]),
+    ]),
+    # Filled and kept current by portfolio_queries.resolve_year_joined, by the DASHBOARD_TENANT's
+    # rule, after both ingesters write PrimaryDataBase
+    (12, "Resolved year_joined on PrimaryDataBase", [
+        add_column('PrimaryDataBase', 'year_joined', 'INT'),
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_primarydatabase_year_joined')
+            CREATE INDEX ix_primarydatabase_year_joined ON PrimaryDataBase (year_joined, datayear_num) INCLUDE (pmparentid, donotinclude)
+        """,
+    ]),
+    # full update.py deletes the bills older runs misfiled in naturalgas by meterid after every load
+    (13, "meterid index on naturalgas", [
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_naturalgas_meterid')
+            CREATE INDEX ix_naturalgas_meterid ON naturalgas (meterid)
+        """,
+    ]),
+    # Bumped by portfolio_queries.bump_data_version with every ingester write the rollups depend
+    # on; rollup_version is the data_version of the last refresh, NULL until then
+    (14, "Data versions on rollup_refresh", [
+        """
+        IF COL_LENGTH('rollup_refresh', 'data_version') IS NULL
+            ALTER TABLE rollup_refresh ADD data_version BIGINT NOT NULL CONSTRAINT DF_rollup_refresh_data_version DEFAULT 0
+        """,
+        add_column('rollup_refresh', 'rollup_version', 'BIGINT'),
+    ]),
+]